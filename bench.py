@@ -0,0 +1,4 @@
+from cli.benchmark import benchmark_cli
+
+if __name__ == "__main__":
+    benchmark_cli()
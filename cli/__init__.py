@@ -1,31 +1,527 @@
+import hashlib
 import os
 import shutil
-import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from functools import partial
 from pathlib import Path
-from typing import Literal
+from typing import Callable, Collection, Literal, Optional
 from uuid import uuid4
 
 import click
 
-from cli.config import get_project_config
-from cli.github import get_project_folder
-from cli.patcher import apply_patch_file, generate_patch, is_file_equal
+from cli.artifacts import (
+    LOCAL_ARTIFACTS_DIR,
+    REPLACE_SCRIPT,
+    ArtifactBackend,
+    LocalArtifactBackend,
+    fetch_artifact,
+    get_artifact_backend,
+    get_build_key,
+    store_artifact,
+)
+from cli.asar import AsarBackend, pack_asar
+from cli.bundle import (
+    LoosePatchStore,
+    PatchBundle,
+    PatchStore,
+    get_bundle_path,
+    get_patch_kind,
+    has_patches,
+    open_patch_store,
+    save_patches,
+    unpack_bundle,
+    update_patches,
+    write_bundle,
+)
+from cli.cache import (
+    cache_options,
+    collect_garbage,
+    evict_objects,
+    find_edited_objects,
+    format_size,
+    get_cache_stats,
+    parse_size,
+    read_version_manifest,
+)
+from cli.classify import classify_file
+from cli.config import ProjectConfig, get_project_config, get_project_names, set_project_version
+from cli.diff import DiffAlgorithm
+from cli.github import download_options, get_project_files, get_project_folder
+from cli.manifest import build_manifest, is_stat_unchanged, list_files, read_manifest, write_manifest
+from cli.materialize import MaterializeMode, copy_file, materialize_tree
+from cli.patcher import (
+    FileDiff,
+    PatchBackend,
+    PatchError,
+    PatchTarget,
+    RebasedPatch,
+    apply_patch_targets,
+    check_patches,
+    describe_hunk_result,
+    diff_files,
+    is_check_failed,
+    make_binary_patch,
+    rebase_patches,
+)
+from cli.sync import sync_file, sync_tree
+from cli.trace import span, tracer
 from cli.utils import (
     CACHE_DIR,
     PROJECT_DIR,
+    ensure_cache_dir,
     error,
     is_windows,
     log,
-    read_lines,
+    log_prefix,
     success,
     warning,
-    write_lines,
 )
+from cli.workspace import (
+    DEPENDENCY_FILES,
+    WorkspaceState,
+    get_workspace_dir,
+    get_workspace_state_path,
+    hash_dependency_files,
+    is_patched_file_unchanged,
+    new_workspace_state,
+    read_workspace_state,
+    write_workspace_state,
+)
+
+# Options shared by several commands
+
+patch_backend_option = click.option(
+    "--patch-backend",
+    type=click.Choice(["python", "gnu"]),
+    default="python",
+    help="Engine used to apply patches - the built-in one or GNU patch.",
+)
+jobs_option = click.option(
+    "-j",
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=os.cpu_count() or 1,
+    show_default="CPU count",
+    help="Number of files to process in parallel (patches to apply, files to diff...).",
+)
+materialize_option = click.option(
+    "--materialize",
+    type=click.Choice(["auto", "reflink", "hardlink", "copy"]),
+    default="auto",
+    help="How to copy cached versions: reflinks when supported (auto), hardlinks (build workspaces only) or copies.",
+)
+diff_algorithm_option = click.option(
+    "--diff-algorithm",
+    type=click.Choice(["patience", "myers", "difflib"]),
+    default="patience",
+    help="Line diff engine used to generate the patches.",
+)
+
+
+def asar_build_options(command: Callable[..., None]) -> Callable[..., None]:
+    """Options of the ASAR build, shared by generate-asar and build-all."""
+    for option in reversed(
+        [
+            click.option("--fresh", is_flag=True, help="Discard the build workspace and build from a clean copy."),
+            click.option(
+                "--artifact-cache",
+                envvar="MIM_ARTIFACT_CACHE",
+                help="Shared cache of built ASARs to use besides the local one: a directory or an http(s) URL.",
+            ),
+            click.option(
+                "--rebuild",
+                is_flag=True,
+                help="Build again, even if a cached ASAR or the last build of the workspace has the same inputs.",
+            ),
+            click.option(
+                "--asar-backend",
+                type=click.Choice(["python", "npx"]),
+                default="python",
+                help="Packer used to create the ASAR - the built-in one or @electron/asar through npx.",
+            ),
+            click.option("--unpack", multiple=True, help="Leave the files matching this glob out of the ASAR."),
+            click.option("--unpack-dir", multiple=True, help="Leave the folders matching this glob out of the ASAR."),
+        ]
+    ):
+        command = option(command)
+    return command
 
 
 @click.group
-def cli_instance() -> None:
-    pass
+@click.option(
+    "--keep-archives/--no-keep-archives",
+    default=False,
+    help="Keep downloaded release archives in cache next to their extracted contents.",
+)
+@click.option(
+    "--cache-size-limit",
+    envvar="MIM_CACHE_SIZE_LIMIT",
+    callback=lambda _, __, value: None if value is None else parse_size(value),
+    help="Evict the least recently used versions from cache past this size (e.g. 20G).",
+)
+@click.option(
+    "--download-chunks",
+    type=click.IntRange(1, 16),
+    default=1,
+    help="Download release archives in this many parallel ranges, when the server supports it.",
+)
+@click.option("--offline", is_flag=True, help="Never use the network; only use versions already in cache.")
+@click.option(
+    "--trace",
+    "trace_file",
+    type=click.Path(dir_okay=False, writable=True, path_type=Path),
+    help="Write the time spent in each phase and on each file to this file, as a Chrome trace.",
+)
+@click.option("--timings", is_flag=True, help="Print the time spent in each phase at the end of the run.")
+@click.pass_context
+def cli_instance(
+    ctx: click.Context,
+    keep_archives: bool,
+    cache_size_limit: Optional[int],
+    download_chunks: int,
+    offline: bool,
+    trace_file: Optional[Path],
+    timings: bool,
+) -> None:
+    ensure_cache_dir()
+    download_options["keep_archive"] = keep_archives
+    download_options["chunks"] = download_chunks
+    download_options["offline"] = offline
+    cache_options["size_limit"] = cache_size_limit
+
+    # Report once the command is done, even if it failed
+    tracer.reset()
+    ctx.call_on_close(lambda: report_timings(trace_file, timings))
+    if ctx.invoked_subcommand is not None:
+        ctx.with_resource(span(ctx.invoked_subcommand))
+
+
+def report_timings(trace_file: Optional[Path], timings: bool) -> None:
+    if trace_file is not None:
+        tracer.write(trace_file)
+        log(f"Trace written to '{trace_file.as_posix()}'.")
+    if timings:
+        log("Timings:", bold=True)
+        for line in tracer.summary():
+            log(line)
+
+
+def load_project_configs(projects: list[str]) -> list[ProjectConfig]:
+    project_configs: list[ProjectConfig] = []
+    for project in projects:
+        try:
+            project_configs.append(get_project_config(project))
+        except Exception as e:
+            error(f"Failed to retrieve project '{project}' from config file.")
+            raise click.Abort() from e
+    return project_configs
+
+
+def confirm_local_dirs(project_configs: list[ProjectConfig], sync: bool, yes: bool) -> None:
+    """Ask once for every existing local copy that `init` would overwrite."""
+    existing = [
+        project_config["local_dir"] for project_config in project_configs if project_config["local_dir"].exists()
+    ]
+    if not existing or yes:
+        return
+    for local_dir in existing:
+        warning(f"Local folder found at '{local_dir.as_posix()}'.")
+    action = (
+        "Any changes to their project files will be overwritten." if sync else "This will delete all their contents."
+    )
+    click.confirm(f"{action} {click.style('Are you sure you want to proceed?', bold=True)}", abort=True)
+
+
+def _run_project_task(name: str, task: Callable[[], object]) -> object:
+    with log_prefix(f"[{name}] "):
+        return task()
+
+
+def run_projects(tasks: list[tuple[ProjectConfig, Callable[[], object]]]) -> None:
+    """
+    Run a task for each project in parallel. Tasks are mostly downloads, file copies and subprocesses, so threads are
+    enough. Their messages are prefixed with the project's name, as they are interleaved. Cache eviction is held back
+    until every task is done, so that it can't evict a version another one is using.
+    """
+    size_limit = cache_options["size_limit"]
+    cache_options["size_limit"] = None
+    failed: list[str] = []
+    try:
+        with ThreadPoolExecutor(max_workers=len(tasks)) as executor:
+            futures = [
+                (
+                    project_config["name"],
+                    executor.submit(_run_project_task, project_config["name"], span(project_config["name"])(task)),
+                )
+                for project_config, task in tasks
+            ]
+            for name, future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    error(f"{name} failed{f': {e}' if str(e) else '.'}")
+                    failed.append(name)
+    finally:
+        cache_options["size_limit"] = size_limit
+
+    if size_limit is not None:
+        keep = {(project_config["name"], project_config["version"]) for project_config, _ in tasks}
+        for evicted in collect_garbage(size_limit, keep=keep)["evicted"]:
+            warning(f"Evicted {evicted['name']} version '{evicted['version']}' from cache.", bold=False)
+    if failed:
+        raise click.Abort()
+
+
+def report_patch_failure(relative_path: Path, exception: Exception) -> None:
+    """Print which hunks of a patch failed, when the backend is able to tell."""
+    error(f"Patch for '{relative_path.as_posix()}' failed: {exception}")
+    if not isinstance(exception, PatchError):
+        return
+    for result in exception.failed_hunks():
+        error(f"  {describe_hunk_result(result)}", bold=False)
+
+
+def collect_patch_targets(
+    store: PatchStore, target_dir: Path, paths: Optional[Collection[str]] = None
+) -> list[PatchTarget]:
+    """
+    List the patches to apply over `target_dir` (only for the given relative `paths`, if any), sorted so that they are
+    always reported in the same order.
+    """
+    targets: list[PatchTarget] = []
+    for patch_path in store.paths():
+        # Find the corresponding project file
+        if not patch_path.endswith(".patch"):
+            warning(f"File '{patch_path}' is not a patch. Skipping.")
+            continue
+        unsuffixed = Path(patch_path.removesuffix(".patch"))
+        if paths is not None and unsuffixed.as_posix() not in paths:
+            continue
+        local_file = target_dir / unsuffixed
+
+        if not local_file.exists():
+            error(f"File '{unsuffixed.as_posix()}' missing from local project while patch exists. Skipping.")
+            continue
+
+        targets.append({"relative_path": unsuffixed, "store": store, "patch_path": patch_path, "file": local_file})
+    return targets
+
+
+def apply_project_patches(
+    project_config: ProjectConfig,
+    target_dir: Path,
+    backend: PatchBackend,
+    jobs: int,
+    *,
+    skip_bad_patches: bool = False,
+    verbose: bool = True,
+    paths: Optional[Collection[str]] = None,
+) -> None:
+    """
+    Apply the project patches over `target_dir` (all of them, or those of the given relative `paths`), aborting on the
+    first failure unless asked to skip them.
+    """
+    if not has_patches(project_config["patches_dir"]):
+        warning("Patches folder not found. Skipping.")
+        return
+
+    with open_patch_store(project_config["patches_dir"]) as store:
+        outcomes = apply_patch_targets(collect_patch_targets(store, target_dir, paths), backend, jobs)
+    count = 0
+    skipped = 0
+    for outcome in outcomes:
+        relative_path = outcome["relative_path"]
+        if outcome["error"] is not None:
+            report_patch_failure(relative_path, outcome["error"])
+            if not skip_bad_patches:
+                raise outcome["error"]
+            skipped += 1
+            warning(f"Failed to apply patch to {relative_path.as_posix()} - keeping original file.")
+            continue
+
+        count += 1
+        if verbose:
+            log(f"Applied patch to '{relative_path.as_posix()}'.")
+
+    if skipped == 0:
+        success(f"Applied {count} patches successfully.")
+    else:
+        warning(f"Applied {count} patches successfully ({skipped} skipped).")
+
+
+def read_project_patches(project_config: ProjectConfig) -> tuple[list[str], list[bytes], list[bool]]:
+    """
+    Read every patch of the project, returning the relative paths of the files they patch, their contents and whether
+    they are binary.
+    """
+    relative_paths: list[str] = []
+    patches: list[bytes] = []
+    binary: list[bool] = []
+    with open_patch_store(project_config["patches_dir"]) as store:
+        for patch_path in store.paths():
+            if not patch_path.endswith(".patch"):
+                warning(f"File '{patch_path}' is not a patch. Skipping.")
+                continue
+            relative_paths.append(patch_path.removesuffix(".patch"))
+            patches.append(store.read(patch_path))
+            binary.append(store.is_binary(patch_path))
+    return relative_paths, patches, binary
+
+
+def list_written_files(project_config: ProjectConfig) -> list[str]:
+    """Relative paths of the project files that get written to after copying it: patched and linked files."""
+    paths = [relative_dest for _, relative_dest, _ in project_config["link_files"]]
+    with open_patch_store(project_config["patches_dir"]) as store:
+        paths.extend(path.removesuffix(".patch") for path in store.paths())
+    return paths
+
+
+def sync_local_dir(
+    project_config: ProjectConfig,
+    project_dir: Path,
+    project_files: list[str],
+    backend: PatchBackend,
+    jobs: int,
+    skip_bad_patches: bool,
+) -> None:
+    """
+    Bring an existing local copy up to date with the cached version and the patches, without touching files that
+    already match nor anything that didn't come from the cached version (such as `node_modules`).
+    """
+    local_dir = project_config["local_dir"]
+    previous_manifest = read_manifest(project_config, any_version=True)
+    if previous_manifest is None:
+        warning("No manifest found for the local copy - files removed from the project won't be deleted.")
+
+    # Patched files are generated in a temporary dir first, so they can be compared with the local ones
+    staging_dir = CACHE_DIR / str(uuid4())
+    staging_dir.ensure()
+    try:
+        with open_patch_store(project_config["patches_dir"]) as store:
+            patched = [path.removesuffix(".patch") for path in store.paths() if path.endswith(".patch")]
+        for relative_path in patched:
+            if (project_dir / relative_path).is_file():
+                (staging_dir / relative_path).parent.mkdir(parents=True, exist_ok=True)
+                copy_file(project_dir / relative_path, staging_dir / relative_path)
+        apply_project_patches(
+            project_config, staging_dir, backend, jobs, skip_bad_patches=skip_bad_patches, verbose=False
+        )
+
+        result = sync_tree(
+            project_dir,
+            local_dir,
+            project_files,
+            overlay_dir=staging_dir,
+            previous_paths=previous_manifest["files"] if previous_manifest is not None else (),
+            excluded=[relative_dest for _, relative_dest, _ in project_config["link_files"]],
+            jobs=jobs,
+        )
+    finally:
+        shutil.rmtree(staging_dir)
+
+    for deleted_path in result["deleted"]:
+        warning(f"Deleted '{deleted_path}'.", bold=False)
+    success(
+        f"Synced version {project_config['name']} '{project_config['version']}' to '{local_dir.as_posix()}' "
+        f"({len(result['written'])} files written, {len(result['deleted'])} deleted, {result['unchanged']} unchanged)."
+    )
+
+
+@span("stage workspace")
+def stage_workspace(
+    project_config: ProjectConfig,
+    project_dir: Path,
+    backend: PatchBackend,
+    jobs: int,
+    materialize: MaterializeMode,
+) -> tuple[Path, WorkspaceState, list[str]]:
+    """
+    Bring the build workspace of the project version up to date with the cached version, the patches and the link
+    files. Returns the workspace, its state and the relative paths that were written to it.
+    """
+    name = project_config["name"]
+    version = project_config["version"]
+    workspace_dir = get_workspace_dir(project_config)
+    project_files = list_files(project_dir)
+    written: list[str] = []
+
+    state = read_workspace_state(project_config)
+    if state is None or not workspace_dir.exists():
+        if workspace_dir.exists():
+            shutil.rmtree(workspace_dir)
+        # The dependency files may be rewritten by yarn
+        detached = [*list_written_files(project_config), *DEPENDENCY_FILES]
+        used_mode = materialize_tree(project_dir, workspace_dir, materialize, detached=detached, jobs=jobs)
+        log(f"Copied version {name} '{version}' to a new build workspace ({used_mode}).")
+        state = new_workspace_state()
+        written.extend(project_files)
+
+    # Only apply the patches that changed, or whose file was touched since
+    with open_patch_store(project_config["patches_dir"]) as store:
+        patches = {path.removesuffix(".patch"): store.hash(path) for path in store.paths() if path.endswith(".patch")}
+    unchanged = {
+        path
+        for path, digest in patches.items()
+        if path in state["patched"]
+        and state["patched"][path]["patch"] == digest
+        and is_patched_file_unchanged(state["patched"][path], workspace_dir / path)
+    }
+    outdated = [path for path in patches if path not in unchanged]
+
+    staging_dir = CACHE_DIR / str(uuid4())
+    staging_dir.ensure()
+    try:
+        for relative_path in outdated:
+            if (project_dir / relative_path).is_file():
+                (staging_dir / relative_path).parent.mkdir(parents=True, exist_ok=True)
+                copy_file(project_dir / relative_path, staging_dir / relative_path)
+        if outdated:
+            apply_project_patches(project_config, staging_dir, backend, jobs, verbose=False, paths=set(outdated))
+
+        # Files that are no longer patched get their original contents back
+        result = sync_tree(
+            project_dir,
+            workspace_dir,
+            project_files,
+            overlay_dir=staging_dir,
+            excluded=[*(relative_dest for _, relative_dest, _ in project_config["link_files"]), *unchanged],
+            jobs=jobs,
+        )
+    finally:
+        shutil.rmtree(staging_dir)
+    written.extend(result["written"])
+
+    state["patched"] = {path: patched for path, patched in state["patched"].items() if path in unchanged}
+    for relative_path in outdated:
+        if (workspace_dir / relative_path).is_file():
+            stat = os.stat(workspace_dir / relative_path)
+            state["patched"][relative_path] = {
+                "patch": patches[relative_path],
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+            }
+
+    # Copy the link files, only rewriting what changed
+    for src, relative_dest, _ in project_config["link_files"]:
+        dest = workspace_dir / relative_dest
+        if src.is_dir():
+            if dest.is_symlink() or dest.is_file():
+                dest.unlink()
+            link_paths = list_files(src)
+            link_result = sync_tree(
+                src, dest, link_paths, previous_paths=state["links"].get(relative_dest, ()), jobs=jobs
+            )
+            state["links"][relative_dest] = link_paths
+            written.extend(f"{relative_dest}/{path}" for path in link_result["written"] + link_result["deleted"])
+        else:
+            state["links"].pop(relative_dest, None)
+            if sync_file(src, dest):
+                written.append(relative_dest)
+
+    write_workspace_state(project_config, state)
+    success(f"Build workspace up to date ({len(set(written))} files written, {len(outdated)} patches applied).")
+    return workspace_dir, state, written
 
 
 @cli_instance.command
@@ -35,39 +531,115 @@ def cli_instance() -> None:
     default="symlink",
     help="How to handle overrides MiM folder",
 )
+@patch_backend_option
+@jobs_option
+@materialize_option
+@click.option(
+    "--sync",
+    is_flag=True,
+    help="Update an existing local copy in place, only rewriting the files that change.",
+)
 @click.option("-s", "--skip-bad-patches", is_flag=True, help="If a patch fails, do not abort.")
 @click.option("-y", "--yes", is_flag=True, help="Yes to all prompts.")
-@click.argument("project")
-def init(project: str, link_mode: Literal["symlink", "copy"], yes: bool, skip_bad_patches: bool) -> None:
+@click.option("--all", "all_projects", is_flag=True, help="Initialize every project of the config file, in parallel.")
+@click.argument("project", required=False)
+def init(
+    project: Optional[str],
+    link_mode: Literal["symlink", "copy"],
+    patch_backend: PatchBackend,
+    jobs: int,
+    materialize: MaterializeMode,
+    sync: bool,
+    yes: bool,
+    skip_bad_patches: bool,
+    all_projects: bool,
+) -> None:
     """Initialize the local copy of the specified project."""
-    try:
-        project_config = get_project_config(project)
-    except Exception as e:
-        error(f"Failed to retrieve project '{project}' from config file.")
-        raise click.Abort() from e
+    if all_projects == (project is not None):
+        raise click.UsageError("Pass either a project or --all.")
+    if materialize == "hardlink":
+        raise click.BadParameter(
+            "local copies are edited, so their files can't be hardlinked to the cache.", param_hint="'--materialize'"
+        )
+    project_configs = load_project_configs(get_project_names() if project is None else [project])
 
+    if len(project_configs) == 1:
+        init_project(project_configs[0], link_mode, patch_backend, jobs, materialize, sync, yes, skip_bad_patches)
+        return
+    # Every prompt is asked before starting, as they can't be answered while the projects are set up in parallel
+    confirm_local_dirs(project_configs, sync, yes)
+    run_projects(
+        [
+            (
+                project_config,
+                partial(
+                    init_project,
+                    project_config,
+                    link_mode,
+                    patch_backend,
+                    jobs,
+                    materialize,
+                    sync,
+                    True,
+                    skip_bad_patches,
+                ),
+            )
+            for project_config in project_configs
+        ]
+    )
+
+
+def init_project(
+    project_config: ProjectConfig,
+    link_mode: Literal["symlink", "copy"],
+    patch_backend: PatchBackend,
+    jobs: int,
+    materialize: MaterializeMode,
+    sync: bool,
+    yes: bool,
+    skip_bad_patches: bool,
+) -> None:
     log(f"Initializing repository for {project_config['name']} version '{project_config['version']}'.")
 
     # Load the project version into cache
     try:
         project_dir = get_project_folder(project_config)
     except Exception as e:
-        error(f"Failed to retrieve {project} version '{project_config['version']}'.")
+        error(f"Failed to retrieve {project_config['name']} version '{project_config['version']}'.")
         raise click.Abort() from e
 
     local_dir = project_config["local_dir"]
+    project_files = list_files(project_dir)
 
-    # Copy it
-    if local_dir.exists():
+    sync = sync and local_dir.exists()
+    if sync:
+        # Update it in place
         warning(f"Local folder found at '{local_dir.as_posix()}'.")
         if not yes:
             click.confirm(
-                f"This will delete all it's contents. {click.style('Are you sure you want to proceed?', bold=True)}",
+                "Any changes to the project files will be overwritten. "
+                + click.style("Are you sure you want to proceed?", bold=True),
                 abort=True,
             )
-        shutil.rmtree(local_dir.resolve())
-    shutil.copytree(project_dir, local_dir)
-    success(f"Copied version {project_config['name']} '{project_config['version']}' to '{local_dir.as_posix()}'.")
+        sync_local_dir(project_config, project_dir, project_files, patch_backend, jobs, skip_bad_patches)
+    else:
+        # Copy it
+        if local_dir.exists():
+            warning(f"Local folder found at '{local_dir.as_posix()}'.")
+            if not yes:
+                click.confirm(
+                    f"This will delete all it's contents. {click.style('Are you sure you want to proceed?', bold=True)}",
+                    abort=True,
+                )
+            shutil.rmtree(local_dir.resolve())
+        # Editing a hardlinked file in place would edit the cache too, so only build workspaces use them
+        used_mode = materialize_tree(
+            project_dir, local_dir, "auto" if materialize == "hardlink" else materialize, jobs=jobs
+        )
+        success(
+            f"Copied version {project_config['name']} '{project_config['version']}' to '{local_dir.as_posix()}' "
+            f"({used_mode})."
+        )
 
     # Check for fallbacks on link files
     for src, _, fallback in project_config["link_files"]:
@@ -82,6 +654,15 @@ def init(project: str, link_mode: Literal["symlink", "copy"], yes: bool, skip_ba
                 else:
                     shutil.copy(fallback, src)
 
+    # Links are always created from scratch
+    if sync:
+        for _, relative_dest, _ in project_config["link_files"]:
+            dest = local_dir / relative_dest
+            if dest.is_symlink() or dest.is_file():
+                dest.unlink()
+            elif dest.is_dir():
+                shutil.rmtree(dest)
+
     # Attempt to link / copy files
     def copy_linked_files_aux() -> None:
         for src, relative_dest, _ in project_config["link_files"]:
@@ -111,56 +692,26 @@ def init(project: str, link_mode: Literal["symlink", "copy"], yes: bool, skip_ba
         case "copy":
             copy_linked_files_aux()
 
-    # Apply the patches
-    if not project_config["patches_dir"].exists():
-        warning("Patches folder not found. Skipping.")
-    else:
-        count = 0
-        skipped = 0
-        for file_path in project_config["patches_dir"].rglob("*"):
-            if file_path.is_dir():
-                continue
-            # Find the corresponding project file
-            relative_path = file_path.relative_to(project_config["patches_dir"])
-            if file_path.suffix != ".patch":
-                warning(f"File '{file_path.as_posix()}' is not a patch. Skipping.")
-                continue
-            unsuffixed = relative_path.with_suffix("")  # remove .patch
-            patch_file = project_config["patches_dir"] / unsuffixed.with_suffix(unsuffixed.suffix + ".patch")
-            local_file = project_config["local_dir"] / unsuffixed
+    # Apply the patches (already done when syncing)
+    if not sync:
+        apply_project_patches(project_config, local_dir, patch_backend, jobs, skip_bad_patches=skip_bad_patches)
 
-            if not local_file.exists():
-                error(f"File '{unsuffixed.as_posix()}' missing from local project while patch exists. Skipping.")
-                continue
-
-            try:
-                read_lines(file_path)
-                try:
-                    apply_patch_file(patch_file, local_file)
-                except Exception:
-                    if skip_bad_patches:
-                        skipped += 1
-                        warning(f"Failed to apply patch to {unsuffixed.as_posix()} - keeping original file.")
-                        continue
-                    raise
-            except UnicodeDecodeError:
-                # It's binary; copy it instead
-                shutil.copy(patch_file, local_file)
-
-            count += 1
-
-            log(f"Applied patch to '{unsuffixed.as_posix()}'.")
-        if skipped == 0:
-            success(f"Applied {count} patches successfully.")
-        else:
-            warning(f"Applied {count} patches successfully ({skipped} skipped).")
+    # Record the state of the local copy so that generate-patches only has to diff what gets edited
+    write_manifest(project_config, build_manifest(project_config, project_files, jobs))
 
     success(f"Project {project_config['name']} version '{project_config['version']}' successfully initialized.")
 
 
 @cli_instance.command
+@jobs_option
+@diff_algorithm_option
+@click.option(
+    "--binary-deltas",
+    is_flag=True,
+    help="Save binary files as deltas against their upstream version, when smaller than the whole file.",
+)
 @click.argument("project")
-def generate_patches(project: str) -> None:
+def generate_patches(project: str, jobs: int, diff_algorithm: DiffAlgorithm, binary_deltas: bool) -> None:
     """Generate patches from the local copy of the specified project."""
     try:
         project_config = get_project_config(project)
@@ -182,90 +733,249 @@ def generate_patches(project: str) -> None:
         error("Local directory not found. Aborting.")
         raise click.Abort()
 
-    # Create a temporary dir in cache to generate the patches there first
-    temporary_dir = CACHE_DIR / str(uuid4())
-    temporary_dir.ensure()
+    patches_dir = project_config["patches_dir"]
+    store = open_patch_store(patches_dir)
 
-    # Iterate over the original files to compare with the local files
-    for file_path in project_dir.rglob("*"):
-        if file_path.is_dir():
-            continue
-        relative_path = file_path.relative_to(project_dir)
-        element_file = project_dir / relative_path
-        local_file = local_dir / relative_path
+    # Only diff the files that changed since the local copy was initialized; the rest keep their current patch
+    manifest = read_manifest(project_config)
+    if manifest is None:
+        warning("No manifest found for the local copy - comparing every file.")
+        relative_paths = list_files(project_dir)
+    else:
+        relative_paths = sorted(manifest["files"])
 
-        if not local_file.exists():
+    changed: list[str] = []
+    kept: set[str] = set()
+    for relative_file in relative_paths:
+        try:
+            stat = os.stat(local_dir / relative_file)
+        except FileNotFoundError:
             # Local file was deleted?
-            error(f"File {relative_path} not found in the local project.")
-            continue
-        if is_file_equal(element_file, local_file):
-            # Nothing to patch
+            error(f"File {relative_file} not found in the local project.")
             continue
 
-        patch_file = (temporary_dir / relative_path).with_suffix(relative_path.suffix + ".patch")
-        patch_file.parent.ensure()
+        fingerprint = manifest["files"].get(relative_file) if manifest is not None else None
+        if fingerprint is None or (
+            not is_stat_unchanged(fingerprint, stat)
+            and (
+                fingerprint["size"] != stat.st_size
+                or fingerprint["hash"] != classify_file(local_dir / relative_file)["hash"]
+            )
+        ):
+            changed.append(relative_file)
+        else:
+            kept.add(f"{relative_file}.patch")
 
-        try:
-            patch = generate_patch(element_file, local_file)
-            if "".join(patch).strip() == "":
-                # Files are considered different but no patch?
-                continue
-            write_lines(patch_file, patch)
-        except UnicodeDecodeError:
-            # File is binary - simply copy it
-            shutil.copy(local_file, patch_file)
+    if manifest is not None:
+        log(f"Comparing {len(changed)} changed files out of {len(relative_paths)}.")
+    check_cache_links(project_config, local_dir, changed)
+    patches = make_patches(
+        diff_files(changed, project_dir, local_dir, jobs, diff_algorithm), project_dir, local_dir, binary_deltas
+    )
+    # Patches of files that are gone from the local copy (or from upstream) are deleted
+    for patch_path in store.paths():
+        if patch_path not in kept and patch_path not in patches:
+            patches[patch_path] = None
 
-    patches_dir = project_config["patches_dir"]
-    patches_dir.ensure()
+    # Only the patches that change are written, each replaced atomically
+    with store:
+        changes = report_patch_changes(store, patches)
+    update_patches(patches_dir, changes)
 
-    # Update the user on changes - creates / updated
-    for file_path in temporary_dir.rglob("*"):
-        if file_path.is_dir():
-            continue
-        relative_path = file_path.relative_to(temporary_dir)
-        patch_path = patches_dir / relative_path
+    # The patches now match the local copy, so its changed files won't need diffing next time
+    if manifest is None:
+        manifest = build_manifest(project_config, relative_paths, jobs)
+    else:
+        manifest["files"].update(build_manifest(project_config, changed, jobs)["files"])
+    write_manifest(project_config, manifest)
 
-        is_binary = False
-        try:
-            read_lines(file_path)
-        except UnicodeDecodeError:
-            is_binary = True
+    success("Finished generating patches.")
 
-        if patch_path.exists() and not is_file_equal(file_path, patch_path):
-            warning(
-                f"Patch for '{relative_path.with_suffix('').as_posix()}' {'(binary) ' if is_binary else ''}was updated."
-            )
-        elif not patch_path.exists():
-            success(
-                f"Patch for '{relative_path.with_suffix('').as_posix()}' {'(binary) ' if is_binary else ''}was created."
+
+def check_cache_links(project_config: ProjectConfig, local_dir: Path, relative_paths: list[str]) -> None:
+    """
+    Abort if any of the given files is hardlinked to the cache and was edited in place. Its upstream contents were
+    edited as well, so there is nothing left to diff it against: the affected versions are evicted from cache instead.
+    """
+    version_manifest = read_version_manifest(project_config["name"], project_config["version"])
+    if version_manifest is None:
+        return
+    edited = find_edited_objects(version_manifest, local_dir, relative_paths)
+    if not edited:
+        return
+
+    for relative_file in edited:
+        error(f"'{relative_file}' is hardlinked to the cache and was edited in place.", bold=False)
+    for evicted in evict_objects({version_manifest["files"][relative_file] for relative_file in edited}):
+        warning(f"Evicted corrupted {evicted['name']} version '{evicted['version']}' from cache.", bold=False)
+    error(
+        "The cached versions were edited along with these files, so their patches can't be generated. Your edits are "
+        "still in the local copy: back them up, run init again and reapply them."
+    )
+    raise click.Abort()
+
+
+def make_patches(
+    file_diffs: list[FileDiff], project_dir: Path, local_dir: Path, binary_deltas: bool
+) -> dict[str, Optional[bytes]]:
+    """Patches of the diffed files, by patch path. Files that no longer differ from upstream get None."""
+    patches: dict[str, Optional[bytes]] = {}
+    for file_diff in file_diffs:
+        relative_file = file_diff["relative_path"]
+        patch_path = f"{relative_file}.patch"
+        if file_diff["binary"]:
+            patches[patch_path] = make_binary_patch(
+                project_dir / relative_file, local_dir / relative_file, binary_deltas
             )
+        elif file_diff["patch"]:
+            patches[patch_path] = "".join(file_diff["patch"]).encode()
+        else:
+            patches[patch_path] = None
+    return patches
+
 
-    # Update the user on changes - deletes
-    for file_path in patches_dir.rglob("*"):
-        if file_path.is_dir():
+def report_patch_changes(store: PatchStore, patches: dict[str, Optional[bytes]]) -> dict[str, Optional[bytes]]:
+    """Tell the user how the patches change the store, returning only the ones that change anything."""
+    current_patches = set(store.paths())
+    changes: dict[str, Optional[bytes]] = {}
+    for patch_path, data in sorted(patches.items()):
+        label = f"Patch for '{patch_path.removesuffix('.patch')}'"
+        if data is None:
+            if patch_path in current_patches:
+                warning(f"{label} {'(binary) ' if store.is_binary(patch_path) else ''}was deleted.")
+                changes[patch_path] = data
             continue
-        relative_path = file_path.relative_to(patches_dir)
+        binary = get_patch_kind(data) != "text"
+        if patch_path not in current_patches:
+            success(f"{label} {'(binary) ' if binary else ''}was created.")
+        elif store.hash(patch_path) != hashlib.sha256(data).hexdigest():
+            warning(f"{label} {'(binary) ' if binary else ''}was updated.")
+        else:
+            continue
+        changes[patch_path] = data
+    return changes
 
-        is_binary = False
-        try:
-            read_lines(file_path)
-        except UnicodeDecodeError:
-            is_binary = True
 
-        if not (temporary_dir / relative_path).exists():
-            warning(
-                f"Patch for '{relative_path.with_suffix('').as_posix()}' {'(binary) ' if is_binary else ''}was deleted."
-            )
+@cli_instance.command
+@jobs_option
+@diff_algorithm_option
+@click.option(
+    "--binary-deltas",
+    is_flag=True,
+    help="Save binary files as deltas against their upstream version, when smaller than the whole file.",
+)
+@click.option("--poll", is_flag=True, help="Poll the files for changes instead of using inotify.")
+@click.option(
+    "--debounce",
+    type=click.FloatRange(min=0),
+    default=0.5,
+    show_default=True,
+    help="Seconds without changes to wait for before updating the patches.",
+)
+@click.argument("project")
+def watch(
+    project: str, jobs: int, diff_algorithm: DiffAlgorithm, binary_deltas: bool, poll: bool, debounce: float
+) -> None:
+    """Keep the patches of the specified project up to date while its local copy is edited."""
+    try:
+        project_config = get_project_config(project)
+    except Exception as e:
+        error(f"Failed to retrieve project '{project}' from config file.")
+        raise click.Abort() from e
+
+    # Load the project version into cache
+    try:
+        project_dir = get_project_folder(project_config)
+    except Exception as e:
+        error(f"Failed to retrieve {project} version '{project_config['version']}'.")
+        raise click.Abort() from e
 
-    # Copy the patches from the temporary dir to the patches dir
-    shutil.rmtree(patches_dir)
-    shutil.copytree(temporary_dir, patches_dir)
-    shutil.rmtree(temporary_dir)
+    # Only imported when watching, as it loads ctypes
+    from cli.watch import get_watcher, wait_for_changes
 
-    success("Finished generating patches.")
+    local_dir = project_config["local_dir"]
+    if not local_dir.exists():
+        error("Local directory not found. Aborting.")
+        raise click.Abort()
+    patches_dir = project_config["patches_dir"]
+
+    # Only upstream files can be patched; linked files are not saved as patches
+    link_dests = tuple(relative_dest for _, relative_dest, _ in project_config["link_files"])
+    project_files = [
+        path
+        for path in list_files(project_dir)
+        if path not in link_dests and not path.startswith(tuple(f"{dest}/" for dest in link_dests))
+    ]
+
+    def update_changed_patches(relative_paths: list[str]) -> None:
+        existing: list[str] = []
+        missing: list[str] = []
+        for relative_file in relative_paths:
+            (existing if (local_dir / relative_file).is_file() else missing).append(relative_file)
+
+        check_cache_links(project_config, local_dir, existing)
+        patches = make_patches(
+            diff_files(existing, project_dir, local_dir, jobs, diff_algorithm), project_dir, local_dir, binary_deltas
+        )
+        patches.update({f"{relative_file}.patch": None for relative_file in missing})
+        with open_patch_store(patches_dir) as store:
+            changes = report_patch_changes(store, patches)
+        if changes:
+            update_patches(patches_dir, changes)
+
+        # The patches now match these files, so generate-patches won't need to diff them
+        manifest = read_manifest(project_config)
+        if manifest is not None:
+            for relative_file in missing:
+                manifest["files"].pop(relative_file, None)
+            manifest["files"].update(build_manifest(project_config, existing, jobs)["files"])
+            write_manifest(project_config, manifest)
+
+    def find_stale_files() -> list[str]:
+        # Files whose stat changed since their patch was last generated
+        manifest = read_manifest(project_config)
+        if manifest is None:
+            return project_files
+        stale: list[str] = []
+        for relative_file in project_files:
+            fingerprint = manifest["files"].get(relative_file)
+            try:
+                if fingerprint is None or not is_stat_unchanged(fingerprint, os.stat(local_dir / relative_file)):
+                    stale.append(relative_file)
+            except FileNotFoundError:
+                stale.append(relative_file)
+        return stale
+
+    # Catch up with what was edited since the last run
+    if read_manifest(project_config) is None:
+        warning("No manifest found for the local copy - only files changed from now on will be saved.")
+    else:
+        stale = find_stale_files()
+        if stale:
+            log(f"Updating the patches of {len(stale)} files changed since the last run.")
+            update_changed_patches(stale)
+
+    watcher = get_watcher(local_dir, project_files, poll)
+    success(f"Watching '{local_dir.as_posix()}' for changes. Press Ctrl+C to stop.")
+    try:
+        while True:
+            changed = wait_for_changes(watcher, debounce)
+            if changed is None:
+                warning("Some changes were missed - checking every file.")
+                update_changed_patches(find_stale_files())
+            else:
+                update_changed_patches(sorted(changed))
+    except KeyboardInterrupt:
+        success("Stopped watching.")
+    finally:
+        watcher.close()
 
 
 @cli_instance.command
+@patch_backend_option
+@jobs_option
+@materialize_option
+@asar_build_options
 @click.option("-y", "--yes", is_flag=True, help="Yes to all prompts.")
 @click.option(
     "-o",
@@ -274,7 +984,20 @@ def generate_patches(project: str) -> None:
     default=PROJECT_DIR / "webapp.asar",
 )
 @click.argument("element-project", default="element-web")
-def generate_asar(element_project: str, output: Path, yes: bool) -> None:
+def generate_asar(
+    element_project: str,
+    output: Path,
+    patch_backend: PatchBackend,
+    jobs: int,
+    materialize: MaterializeMode,
+    fresh: bool,
+    artifact_cache: Optional[str],
+    rebuild: bool,
+    asar_backend: AsarBackend,
+    unpack: tuple[str, ...],
+    unpack_dir: tuple[str, ...],
+    yes: bool,
+) -> None:
     """Generate an ASAR from the Element-Web fork base."""
 
     try:
@@ -289,19 +1012,45 @@ def generate_asar(element_project: str, output: Path, yes: bool) -> None:
             abort=True,
         )
 
+    build_asar(
+        project_config,
+        output,
+        patch_backend,
+        jobs,
+        materialize,
+        fresh,
+        artifact_cache,
+        rebuild,
+        asar_backend,
+        unpack,
+        unpack_dir,
+    )
+
+
+def build_asar(
+    project_config: ProjectConfig,
+    output: Path,
+    patch_backend: PatchBackend,
+    jobs: int,
+    materialize: MaterializeMode,
+    fresh: bool,
+    artifact_cache: Optional[str],
+    rebuild: bool,
+    asar_backend: AsarBackend,
+    unpack: tuple[str, ...],
+    unpack_dir: tuple[str, ...],
+) -> None:
+    import subprocess
+
     log(f"Generating ASAR file for {project_config['name']} version '{project_config['version']}'.")
 
     # Load the project version into cache
     try:
         project_dir = get_project_folder(project_config)
     except Exception as e:
-        error(f"Failed to retrieve {element_project} version '{project_config['version']}'.")
+        error(f"Failed to retrieve {project_config['name']} version '{project_config['version']}'.")
         raise click.Abort() from e
 
-    # Copy it to a temporary folder
-    temporary_dir = CACHE_DIR / str(uuid4())
-    shutil.copytree(project_dir, temporary_dir)
-
     # Check for fallbacks on link files
     for src, _, fallback in project_config["link_files"]:
         if not src.exists():
@@ -315,80 +1064,453 @@ def generate_asar(element_project: str, output: Path, yes: bool) -> None:
                 else:
                     shutil.copy(fallback, src)
 
-    # Copy the link files
-    for src, relative_dest, _ in project_config["link_files"]:
-        dest = temporary_dir / relative_dest
-        if src.is_dir():
-            shutil.copytree(src, dest)
-        else:
-            shutil.copy(src, dest)
-    success("Successfully copied link files.")
+    # Reuse a previous build of the exact same inputs
+    backends: list[ArtifactBackend] = [LocalArtifactBackend(LOCAL_ARTIFACTS_DIR)]
+    if artifact_cache is not None:
+        backends.append(get_artifact_backend(artifact_cache))
+    version_manifest = read_version_manifest(project_config["name"], project_config["version"])
+    # Only the archive is cached, so builds with unpacked files can't be reused
+    unpacked = bool(unpack or unpack_dir)
+    build_key = None
+    if version_manifest is not None and not unpacked:
+        build_key = get_build_key(project_config, version_manifest["files"], asar_backend)
+    if build_key is not None and not rebuild:
+        found = fetch_artifact(backends, build_key, output)
+        if found is not None:
+            success(f"Found a build of the same inputs in {found}.")
+            if found is not backends[0]:
+                store_artifact(backends[:1], build_key, output)
+            success(f"Finished generating ASAR at '{output.relative_to(PROJECT_DIR).as_posix()}'!")
+            return
 
-    # Apply the patches
-    if not project_config["patches_dir"].exists():
-        warning("Patches folder not found. Skipping.")
+    # Build in the persistent workspace of this version, so that dependencies and build caches are kept between runs
+    if fresh:
+        shutil.rmtree(get_workspace_dir(project_config), ignore_errors=True)
+        get_workspace_state_path(project_config).unlink(missing_ok=True)
+    workspace_dir, state, written = stage_workspace(project_config, project_dir, patch_backend, jobs, materialize)
+    replace_script = classify_file(REPLACE_SCRIPT)["hash"]
+    needs_build = (
+        rebuild
+        or not state["built"]
+        or not (workspace_dir / "webapp").exists()
+        or any(path not in DEPENDENCY_FILES for path in written)
+        # Missing from the state of older workspaces
+        or state.get("replace_script") != replace_script
+    )
+
+    # Install dependencies, unless they are the same as last time
+    dependencies = hash_dependency_files(workspace_dir)
+    if state["dependencies"] == dependencies and (workspace_dir / "node_modules").exists():
+        success("Dependencies unchanged. Skipping install.")
     else:
-        count = 0
-        for file_path in project_config["patches_dir"].rglob("*"):
-            if file_path.is_dir():
-                continue
-            # Find the corresponding project file
-            relative_path = file_path.relative_to(project_config["patches_dir"])
-            if file_path.suffix != ".patch":
-                warning(f"File '{file_path.as_posix()}' is not a patch. Skipping.")
-                continue
-            unsuffixed = relative_path.with_suffix("")  # remove .patch
-            patch_file = project_config["patches_dir"] / unsuffixed.with_suffix(unsuffixed.suffix + ".patch")
-            local_file = temporary_dir / unsuffixed
+        log("Installing dependencies with yarn...")
+        state["dependencies"] = None
+        write_workspace_state(project_config, state)
+        with span("yarn install"):
+            subprocess.run(["yarn"], check=True, stdout=subprocess.DEVNULL, cwd=workspace_dir, shell=is_windows)
+        state["dependencies"] = dependencies
+        write_workspace_state(project_config, state)
+        success("Successfully installed dependencies.")
+        needs_build = True
 
-            if not local_file.exists():
-                error(f"File '{unsuffixed.as_posix()}' missing from local project while patch exists. Skipping.")
-                continue
+    if not needs_build:
+        success("Nothing changed since the last build. Reusing the webapp folder.")
+    else:
+        state["built"] = False
+        write_workspace_state(project_config, state)
 
-            try:
-                read_lines(file_path)
-                apply_patch_file(patch_file, local_file)
-            except UnicodeDecodeError:
-                # It's binary; copy it instead
-                shutil.copy(patch_file, local_file)
+        log("Building webapp folder...")
+        with span("yarn build"):
+            subprocess.run(
+                ["yarn", "build"], check=True, stdout=subprocess.DEVNULL, cwd=workspace_dir, shell=is_windows
+            )
+        success("Successfully built webapp folder.")
 
-            count += 1
+        # Also apply the replace script on the generated folder
+        log("Applying replace_vars.sh script...")
+        env_file = workspace_dir / ".env"
+        target = workspace_dir / "webapp" / "index.html"
 
-        success(f"Applied {count} patches successfully.")
+        with span("replace_vars.sh"):
+            subprocess.run(
+                ["bash", "./replace_vars.sh", "-e", env_file.as_posix(), target.as_posix()],
+                check=True,
+                stdout=subprocess.DEVNULL,
+                cwd=REPLACE_SCRIPT.parent,
+                shell=is_windows,
+            )
+        success("Successfully applied")
 
-    # Install dependencies and build the project
-    log("Installing dependencies with yarn...")
-    subprocess.run(["yarn"], check=True, stdout=subprocess.DEVNULL, cwd=temporary_dir, shell=is_windows)
-    success("Successfully installed dependencies.")
-    log("Building webapp folder...")
-    subprocess.run(["yarn", "build"], check=True, stdout=subprocess.DEVNULL, cwd=temporary_dir, shell=is_windows)
-    success("Successfully built webapp folder.")
-
-    # Also apply the replace script on the generated folder
-    log("Applying replace_vars.sh script...")
-    env_file = temporary_dir / ".env"
-    target = temporary_dir / "webapp" / "index.html"
-
-    subprocess.run(
-        ["bash", "./replace_vars.sh", "-e", env_file.as_posix(), target.as_posix()],
-        check=True,
-        stdout=subprocess.DEVNULL,
-        cwd=(PROJECT_DIR / "projects" / "element-web" / "scripts"),
-        shell=is_windows,
-    )
-    success("Successfully applied")
+        state["built"] = True
+        state["replace_script"] = replace_script
+        write_workspace_state(project_config, state)
 
     log("Packaging ASAR...")
     filename = "webapp.asar"
-    subprocess.run(
-        ["npx", "--yes", "@electron/asar", "pack", "webapp", filename],
-        check=True,
-        stdout=subprocess.DEVNULL,
-        cwd=temporary_dir,
-        shell=is_windows,
-    )
+    match asar_backend:
+        case "python":
+            header_hash = pack_asar(
+                workspace_dir / "webapp", workspace_dir / filename, unpack=unpack, unpack_dirs=unpack_dir, jobs=jobs
+            )
+            log(f"ASAR header hash: {header_hash}", bold=False)
+        case "npx":
+            unpack_args = [*(f"--unpack={pattern}" for pattern in unpack), *(f"--unpack-dir={d}" for d in unpack_dir)]
+            with span("asar pack"):
+                subprocess.run(
+                    ["npx", "--yes", "@electron/asar", "pack", *unpack_args, "webapp", filename],
+                    check=True,
+                    stdout=subprocess.DEVNULL,
+                    cwd=workspace_dir,
+                    shell=is_windows,
+                )
     success("Successfully packaged with ASAR.")
     log(f"Copying to '{output.relative_to(PROJECT_DIR).as_posix()}'...")
-    shutil.copy(temporary_dir / filename, output)
+    shutil.copy(workspace_dir / filename, output)
+    unpacked_dir = workspace_dir / f"{filename}.unpacked"
+    output_unpacked_dir = output.with_name(f"{output.name}.unpacked")
+    if output_unpacked_dir.exists():
+        shutil.rmtree(output_unpacked_dir)
+    if unpacked and unpacked_dir.exists():
+        shutil.copytree(unpacked_dir, output_unpacked_dir)
+    # A reused webapp folder may be older than the inputs the key was made from, so only fresh builds are shared
+    if build_key is not None and needs_build:
+        store_artifact(backends, build_key, workspace_dir / filename)
     success("Finished generating ASAR!")
-    shutil.rmtree(temporary_dir)  # Delete the temporary folder
+
+
+@cli_instance.command("build-all")
+@patch_backend_option
+@jobs_option
+@materialize_option
+@click.option(
+    "--link-mode",
+    type=click.Choice(["symlink", "copy"]),
+    default="symlink",
+    help="How to handle the linked files of the desktop project.",
+)
+@click.option(
+    "--sync",
+    is_flag=True,
+    help="Update an existing desktop local copy in place, only rewriting the files that change.",
+)
+@click.option("-s", "--skip-bad-patches", is_flag=True, help="If a desktop patch fails, do not abort.")
+@asar_build_options
+@click.option("-y", "--yes", is_flag=True, help="Yes to all prompts.")
+@click.argument("web-project", default="element-web")
+@click.argument("desktop-project", default="element-desktop")
+def build_all(
+    web_project: str,
+    desktop_project: str,
+    patch_backend: PatchBackend,
+    jobs: int,
+    materialize: MaterializeMode,
+    link_mode: Literal["symlink", "copy"],
+    sync: bool,
+    skip_bad_patches: bool,
+    fresh: bool,
+    artifact_cache: Optional[str],
+    rebuild: bool,
+    asar_backend: AsarBackend,
+    unpack: tuple[str, ...],
+    unpack_dir: tuple[str, ...],
+    yes: bool,
+) -> None:
+    """
+    Build the web ASAR and set up the desktop local copy at the same time, then place the ASAR in the desktop copy.
+    """
+    web_config, desktop_config = load_project_configs([web_project, desktop_project])
+    if not yes and "element-hq/element-web" not in web_config["tags_url"]:
+        click.confirm(
+            "This project does not look like it points to a version of element-web. Are you sure you selected the right project?",
+            abort=True,
+        )
+    confirm_local_dirs([desktop_config], sync, yes)
+
+    # The desktop copy only needs the ASAR at the very end, so it is downloaded and patched during the web build
+    output = PROJECT_DIR / "webapp.asar"
+    run_projects(
+        [
+            (
+                web_config,
+                partial(
+                    build_asar,
+                    web_config,
+                    output,
+                    patch_backend,
+                    jobs,
+                    materialize,
+                    fresh,
+                    artifact_cache,
+                    rebuild,
+                    asar_backend,
+                    unpack,
+                    unpack_dir,
+                ),
+            ),
+            (
+                desktop_config,
+                partial(
+                    init_project,
+                    desktop_config,
+                    link_mode,
+                    patch_backend,
+                    jobs,
+                    materialize,
+                    sync,
+                    True,
+                    skip_bad_patches,
+                ),
+            ),
+        ]
+    )
+
+    destination = desktop_config["local_dir"] / output.name
+    shutil.copy(output, destination)
+    unpacked_dir = output.with_name(f"{output.name}.unpacked")
+    destination_unpacked_dir = destination.with_name(f"{destination.name}.unpacked")
+    if destination_unpacked_dir.exists():
+        shutil.rmtree(destination_unpacked_dir)
+    if unpacked_dir.exists():
+        shutil.copytree(unpacked_dir, destination_unpacked_dir)
+    success(f"Placed the ASAR at '{destination.as_posix()}'. The desktop version is ready to be built.")
+
+
+@cli_instance.command("check-patches")
+@jobs_option
+@click.option("-v", "--verbose", is_flag=True, help="Also show the hunks of patches that apply.")
+@click.argument("project")
+def check_project_patches(project: str, jobs: int, verbose: bool) -> None:
+    """Check that every patch of the specified project applies, without setting up a local copy."""
+    try:
+        project_config = get_project_config(project)
+    except Exception as e:
+        error(f"Failed to retrieve project '{project}' from config file.")
+        raise click.Abort() from e
+    log(f"Checking patches for {project_config['name']} version '{project_config['version']}'.")
+
+    # Load the patches, then only the upstream files they apply to
+    relative_paths, patches, binary = read_project_patches(project_config)
+    try:
+        project_files = get_project_files(project_config, relative_paths)
+    except Exception as e:
+        error(f"Failed to retrieve {project} version '{project_config['version']}'.")
+        raise click.Abort() from e
+
+    source_files = [project_files.get(relative_path) for relative_path in relative_paths]
+    failed = 0
+    for check in check_patches(relative_paths, patches, binary, source_files, jobs):
+        relative_path = check["relative_path"]
+        hunks = [describe_hunk_result(result) for result in check["hunks"]]
+        if is_check_failed(check):
+            failed += 1
+            error(f"Patch for '{relative_path}' {'(binary) ' if check['binary'] else ''}failed.")
+            if check["error"] is not None:
+                error(f"  {check['error']}", bold=False)
+            for description in hunks:
+                error(f"  {description}", bold=False)
+        elif any(result["fuzz"] for result in check["hunks"]):
+            warning(f"Patch for '{relative_path}' applies with fuzz.")
+            for description in hunks:
+                warning(f"  {description}", bold=False)
+        elif verbose:
+            log(f"Patch for '{relative_path}' applies.")
+            for description in hunks:
+                log(f"  {description}")
+
+    if failed:
+        error(f"{failed} out of {len(relative_paths)} patches failed.")
+        raise click.exceptions.Exit(1)
+    success(f"All {len(relative_paths)} patches apply.")
+
+
+@cli_instance.command
+@jobs_option
+@diff_algorithm_option
+@click.option("-y", "--yes", is_flag=True, help="Yes to all prompts.")
+@click.argument("project")
+@click.argument("new-version")
+def rebase(project: str, new_version: str, jobs: int, diff_algorithm: DiffAlgorithm, yes: bool) -> None:
+    """Move the patches of the specified project to a new upstream version."""
+    try:
+        project_config = get_project_config(project)
+    except Exception as e:
+        error(f"Failed to retrieve project '{project}' from config file.")
+        raise click.Abort() from e
+
+    old_version = project_config["version"]
+    if new_version == old_version:
+        error(f"{project} is already on version '{old_version}'.")
+        raise click.Abort()
+    new_config: ProjectConfig = {**project_config, "version": new_version}
+    log(f"Rebasing patches for {project} from version '{old_version}' to '{new_version}'.")
+
+    # Load the patches, then only the files they apply to from both versions
+    relative_paths, patches, binary = read_project_patches(project_config)
+    old_files: dict[str, Path] = {}
+    new_files: dict[str, Path] = {}
+    for config, files in ((project_config, old_files), (new_config, new_files)):
+        try:
+            files.update(get_project_files(config, relative_paths))
+        except Exception as e:
+            error(f"Failed to retrieve {project} version '{config['version']}'.")
+            raise click.Abort() from e
+
+    results = rebase_patches(
+        relative_paths,
+        patches,
+        binary,
+        [old_files.get(relative_path) for relative_path in relative_paths],
+        [new_files.get(relative_path) for relative_path in relative_paths],
+        labels=(f"patched ({old_version})", f"upstream ({new_version})"),
+        jobs=jobs,
+        algorithm=diff_algorithm,
+    )
+
+    # Only the patches that can't be moved cleanly need looking at
+    rebased = dropped = 0
+    conflicted: list[RebasedPatch] = []
+    for result in results:
+        if result["error"] is not None or result["conflicts"]:
+            conflicted.append(result)
+        elif result["patch"] is None:
+            dropped += 1
+        else:
+            rebased += 1
+    for result in conflicted:
+        relative_path = result["relative_path"]
+        if result["error"] is not None:
+            error(f"Patch for '{relative_path}' could not be rebased, keeping it as is: {result['error']}")
+        elif result["binary"]:
+            error(f"Patch for '{relative_path}' (binary) conflicts, keeping the patched file.")
+        else:
+            conflicts = result["conflicts"]
+            error(f"Patch for '{relative_path}' has {conflicts} conflict{'' if conflicts == 1 else 's'}.")
+
+    if conflicted and not yes:
+        click.confirm(
+            f"{len(conflicted)} patches have conflicts, which will be left in the patched files between conflict "
+            f"markers. {click.style('Save the rebased patches anyway?', bold=True)}",
+            abort=True,
+        )
+
+    # Write the new patches next to the files that aren't patches, then replace the current ones
+    temporary_dir = CACHE_DIR / str(uuid4())
+    temporary_dir.ensure()
+    try:
+        with open_patch_store(project_config["patches_dir"]) as store:
+            for path in store.paths():
+                if not path.endswith(".patch"):
+                    (temporary_dir / path).parent.mkdir(parents=True, exist_ok=True)
+                    (temporary_dir / path).write_bytes(store.read(path))
+        for result in results:
+            if result["patch"] is not None:
+                patch_file = temporary_dir / f"{result['relative_path']}.patch"
+                patch_file.parent.mkdir(parents=True, exist_ok=True)
+                patch_file.write_bytes(result["patch"])
+        save_patches(project_config["patches_dir"], temporary_dir)
+    finally:
+        shutil.rmtree(temporary_dir)
+    set_project_version(project, new_version)
+
+    message = (
+        f"Rebased {rebased} patches to version '{new_version}' ({dropped} no longer needed, "
+        f"{len(conflicted)} with conflicts)."
+    )
+    if conflicted:
+        warning(message)
+        warning("Run init, resolve the conflict markers in the local copy and generate the patches again.")
+        raise click.exceptions.Exit(1)
+    success(message)
+
+
+@cli_instance.command("bundle")
+@click.option("--keep", is_flag=True, help="Keep the patches folder after packing it.")
+@click.argument("project")
+def bundle_patches(project: str, keep: bool) -> None:
+    """Pack the patches of the specified project into a single bundle file."""
+    try:
+        project_config = get_project_config(project)
+    except Exception as e:
+        error(f"Failed to retrieve project '{project}' from config file.")
+        raise click.Abort() from e
+
+    patches_dir = project_config["patches_dir"]
+    if not patches_dir.exists():
+        error(f"Patches folder '{patches_dir.as_posix()}' not found. Aborting.")
+        raise click.Abort()
+
+    bundle_path = get_bundle_path(patches_dir)
+    count = write_bundle(bundle_path, LoosePatchStore(patches_dir))
+    if not keep:
+        shutil.rmtree(patches_dir)
+    success(f"Packed {count} patches into '{bundle_path.as_posix()}'.")
+
+
+@cli_instance.command("unbundle")
+@click.option("--keep", is_flag=True, help="Keep the bundle file after unpacking it.")
+@click.option("-y", "--yes", is_flag=True, help="Yes to all prompts.")
+@click.argument("project")
+def unbundle_patches(project: str, keep: bool, yes: bool) -> None:
+    """Unpack the patch bundle of the specified project into loose patch files."""
+    try:
+        project_config = get_project_config(project)
+    except Exception as e:
+        error(f"Failed to retrieve project '{project}' from config file.")
+        raise click.Abort() from e
+
+    patches_dir = project_config["patches_dir"]
+    bundle_path = get_bundle_path(patches_dir)
+    if not bundle_path.exists():
+        error(f"Patch bundle '{bundle_path.as_posix()}' not found. Aborting.")
+        raise click.Abort()
+
+    if patches_dir.exists():
+        warning(f"Patches folder found at '{patches_dir.as_posix()}'.")
+        if not yes:
+            click.confirm(
+                f"This will delete all it's contents. {click.style('Are you sure you want to proceed?', bold=True)}",
+                abort=True,
+            )
+        shutil.rmtree(patches_dir)
+
+    with PatchBundle(bundle_path) as patch_bundle:
+        count = unpack_bundle(patch_bundle, patches_dir)
+    if not keep:
+        bundle_path.unlink()
+    success(f"Unpacked {count} patches into '{patches_dir.as_posix()}'.")
+
+
+@cli_instance.group
+def cache() -> None:
+    """Manage the cache of downloaded versions."""
+
+
+@cache.command
+@click.option("--max-size", help="Evict the least recently used versions until the cache fits this size (e.g. 20G).")
+def gc(max_size: Optional[str]) -> None:
+    """Remove unused files from the cache, evicting old versions if needed."""
+    size_limit = parse_size(max_size) if max_size is not None else cache_options["size_limit"]
+    collected = collect_garbage(size_limit)
+    for evicted in collected["evicted"]:
+        warning(f"Evicted {evicted['name']} version '{evicted['version']}'.")
+    success(f"Removed {collected['removed_objects']} unused files ({format_size(collected['freed'])} freed).")
+
+
+@cache.command
+def stats() -> None:
+    """Show the size of the cache and the versions it holds."""
+    cache_stats = get_cache_stats()
+    for manifest in sorted(cache_stats["versions"], key=lambda manifest: -manifest["last_used"]):
+        last_used = datetime.fromtimestamp(manifest["last_used"]).strftime("%Y-%m-%d %H:%M")
+        log(
+            f"{manifest['name']} '{manifest['version']}': {len(manifest['files'])} files, "
+            f"{format_size(manifest['size'])} (last used {last_used})"
+        )
+    log(f"{len(cache_stats['versions'])} versions, {cache_stats['objects']} unique files.", bold=True)
+    log(
+        f"Stored size: {format_size(cache_stats['store_size'])} "
+        f"(would be {format_size(cache_stats['logical_size'])} without deduplication).",
+        bold=True,
+    )
+    if cache_options["size_limit"] is not None:
+        log(f"Size limit: {format_size(cache_options['size_limit'])}.", bold=True)
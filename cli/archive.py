@@ -0,0 +1,230 @@
+import queue
+import struct
+import threading
+import zipfile
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path, PurePosixPath
+from typing import BinaryIO, Generator, Iterable, Iterator, Optional
+
+from cli.trace import span
+
+"""
+Release archives are zipballs with a single top-level folder, which is stripped when extracting.
+
+Zip archives are meant to be read from their central directory at the end of the file, but every entry is also
+preceded by a local header. GitHub's zipballs can be extracted from those local headers alone, so we can extract the
+archive while it is still being downloaded instead of waiting for the whole file first.
+"""
+
+LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+DATA_DESCRIPTOR_SIGNATURE = b"PK\x07\x08"
+LOCAL_HEADER = struct.Struct("<HHHHHIIIHH")
+ZIP64_EXTRA_ID = 0x0001
+CHUNK_SIZE = 1024 * 1024
+
+
+class ArchiveError(Exception):
+    """The archive is malformed, or uses features that can't be read from a stream."""
+
+
+def strip_top_folder(name: str) -> Optional[str]:
+    """Remove the top-level folder from an archive path. Returns None if nothing is left or the path is unsafe."""
+    parts = PurePosixPath(name).parts[1:]
+    if not parts or any(part in ("..", "") or ":" in part for part in parts) or name.startswith("/"):
+        return None
+    return "/".join(parts)
+
+
+class ChunkReader:
+    """Byte reader over an iterator of chunks, which can give back bytes it read too far."""
+
+    def __init__(self, chunks: Iterator[bytes]) -> None:
+        self._chunks = chunks
+        self._buffer = bytearray()
+
+    def read(self, size: int) -> bytes:
+        while len(self._buffer) < size:
+            chunk = next(self._chunks, b"")
+            if not chunk:
+                break
+            self._buffer += chunk
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    def read_exactly(self, size: int) -> bytes:
+        data = self.read(size)
+        if len(data) != size:
+            raise ArchiveError("Unexpected end of archive.")
+        return data
+
+    def read_some(self, limit: int = CHUNK_SIZE) -> bytes:
+        if not self._buffer:
+            self._buffer += next(self._chunks, b"")
+        return self.read(min(limit, len(self._buffer)))
+
+    def unread(self, data: bytes) -> None:
+        self._buffer[:0] = data
+
+    def drain(self) -> None:
+        self._buffer.clear()
+        for _ in self._chunks:
+            pass
+
+
+def prefetch(chunks: Iterable[bytes], tee: Optional[BinaryIO] = None, depth: int = 64) -> Generator[bytes, None, None]:
+    """
+    Pull the chunks from a background thread, so that the network keeps being read while the consumer writes to
+    disk. Chunks are also written to `tee` as they arrive. Once the generator is closed, nothing more is written.
+    """
+    pending: queue.Queue[bytes | BaseException | None] = queue.Queue(maxsize=depth)
+    stopped = threading.Event()
+
+    def produce() -> None:
+        try:
+            for chunk in chunks:
+                if stopped.is_set():
+                    return
+                if tee is not None:
+                    tee.write(chunk)
+                pending.put(chunk)
+            pending.put(None)
+        except BaseException as e:
+            pending.put(e)
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = pending.get()
+            if item is None:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stopped.set()
+        # Unblock the producer if it is waiting on a full queue
+        while thread.is_alive():
+            try:
+                pending.get(timeout=0.1)
+            except queue.Empty:
+                pass
+        thread.join()
+
+
+def _zip64_sizes(extra: bytes, compressed_size: int, size: int) -> tuple[int, int, bool]:
+    offset = 0
+    while offset + 4 <= len(extra):
+        header_id, length = struct.unpack_from("<HH", extra, offset)
+        if header_id == ZIP64_EXTRA_ID:
+            values = list(struct.unpack_from(f"<{length // 8}Q", extra, offset + 4))
+            if size == 0xFFFFFFFF and values:
+                size = values.pop(0)
+            if compressed_size == 0xFFFFFFFF and values:
+                compressed_size = values.pop(0)
+            return compressed_size, size, True
+        offset += 4 + length
+    return compressed_size, size, False
+
+
+def _write_entry(reader: ChunkReader, output: Optional[BinaryIO], method: int, compressed_size: int) -> int:
+    """Copy the entry's data into the output, returning its CRC-32."""
+    crc = 0
+    if method == zipfile.ZIP_STORED:
+        left = compressed_size
+        while left > 0:
+            data = reader.read_some(min(left, CHUNK_SIZE))
+            if not data:
+                raise ArchiveError("Unexpected end of archive.")
+            left -= len(data)
+            crc = zlib.crc32(data, crc)
+            if output is not None:
+                output.write(data)
+        return crc
+
+    # Deflate streams mark their own end, so the compressed size is not needed
+    decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+    while not decompressor.eof:
+        data = reader.read_some()
+        if not data:
+            raise ArchiveError("Unexpected end of archive.")
+        try:
+            decompressed = decompressor.decompress(data)
+        except zlib.error as e:
+            raise ArchiveError(f"Corrupted entry data: {e}") from e
+        crc = zlib.crc32(decompressed, crc)
+        if output is not None:
+            output.write(decompressed)
+    reader.unread(decompressor.unused_data)
+    return crc
+
+
+@span("extract")
+def stream_extract(chunks: Iterable[bytes], destination: Path) -> int:
+    """Extract a zipball from its chunks as they come, returning the number of extracted files."""
+    reader = ChunkReader(iter(chunks))
+    count = 0
+    while True:
+        signature = reader.read(4)
+        if signature != LOCAL_HEADER_SIGNATURE:
+            # Central directory (or end of archive): every entry has been seen
+            reader.drain()
+            break
+
+        _, flags, method, _, _, crc, compressed_size, size, name_length, extra_length = LOCAL_HEADER.unpack(
+            reader.read_exactly(LOCAL_HEADER.size)
+        )
+        raw_name = reader.read_exactly(name_length)
+        extra = reader.read_exactly(extra_length)
+        name = raw_name.decode("utf-8" if flags & 0x800 else "cp437")
+        compressed_size, size, is_zip64 = _zip64_sizes(extra, compressed_size, size)
+        has_descriptor = bool(flags & 0x08)
+
+        if flags & 0x01:
+            raise ArchiveError(f"Encrypted entry '{name}' is not supported.")
+        if method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            raise ArchiveError(f"Compression method {method} of entry '{name}' is not supported.")
+        if method == zipfile.ZIP_STORED and has_descriptor:
+            raise ArchiveError(f"Stored entry '{name}' has no size and can't be streamed.")
+
+        relative_path = strip_top_folder(name)
+        if relative_path is None or name.endswith("/"):
+            _write_entry(reader, None, method, compressed_size)
+            actual_crc = None
+        else:
+            file_path = destination / relative_path
+            file_path.parent.mkdir(parents=True, exist_ok=True)
+            with open(file_path, "wb") as output:
+                actual_crc = _write_entry(reader, output, method, compressed_size)
+            count += 1
+
+        if has_descriptor:
+            descriptor = reader.read_exactly(4)
+            if descriptor != DATA_DESCRIPTOR_SIGNATURE:
+                reader.unread(descriptor)
+            crc = struct.unpack("<I", reader.read_exactly(4))[0]
+            reader.read_exactly(16 if is_zip64 else 8)
+        if actual_crc is not None and actual_crc != crc:
+            raise ArchiveError(f"CRC mismatch for entry '{name}'.")
+    return count
+
+
+@span("extract")
+def extract_archive(zip_path: Path, destination: Path, jobs: int = 1) -> int:
+    """Extract a finished zipball across `jobs` threads, returning the number of extracted files."""
+    with zipfile.ZipFile(zip_path, "r") as zip_file:
+        entries = [entry for entry in zip_file.infolist() if not entry.is_dir() and strip_top_folder(entry.filename)]
+
+    def extract(batch: list[zipfile.ZipInfo]) -> None:
+        # Each worker reads through its own handle
+        with zipfile.ZipFile(zip_path, "r") as zip_file:
+            for entry in batch:
+                entry.filename = strip_top_folder(entry.filename) or entry.filename
+                zip_file.extract(entry, destination)
+
+    workers = max(1, min(jobs, len(entries)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(extract, [entries[index::workers] for index in range(workers)]))
+    return len(entries)
@@ -0,0 +1,153 @@
+import hashlib
+import json
+import os
+import shutil
+from pathlib import Path
+from typing import Optional, Protocol
+
+from cli.bundle import open_patch_store
+from cli.classify import classify_file
+from cli.config import ProjectConfig
+from cli.download import CHUNK_SIZE, TIMEOUT, get_session
+from cli.manifest import list_files
+from cli.trace import span
+from cli.utils import CACHE_DIR, PROJECT_DIR, warning
+
+"""
+Built ASARs are cached by a key made from everything that goes into them: the upstream files, the patches, the link
+files and the replace script. Two builds with the same key produce the same ASAR, so a cached one can be copied into
+place instead of building it again.
+
+Artifacts are looked up in a local directory, and optionally in a shared backend (another directory, such as a network
+mount, or an HTTP server answering GET / PUT on `<url>/<key>.asar`) so that runners and branches can share builds.
+"""
+
+# Bump when the build process changes in a way that changes its output for the same inputs
+BUILD_KEY_VERSION = "1"
+LOCAL_ARTIFACTS_DIR = CACHE_DIR / ".artifacts"
+REPLACE_SCRIPT = PROJECT_DIR / "projects" / "element-web" / "scripts" / "replace_vars.sh"
+# Sent as a bearer token to HTTP backends, if set
+TOKEN_ENV_VAR = "MIM_ARTIFACT_CACHE_TOKEN"
+
+
+class ArtifactBackend(Protocol):
+    def fetch(self, key: str, destination: Path) -> bool:
+        """Copy the artifact into `destination`, returning whether it was found."""
+        ...
+
+    def store(self, key: str, source: Path) -> None: ...
+
+
+class LocalArtifactBackend:
+    def __init__(self, directory: Path) -> None:
+        self.directory = directory
+
+    def __str__(self) -> str:
+        return self.directory.as_posix()
+
+    def _path(self, key: str) -> Path:
+        return self.directory / key[:2] / f"{key}.asar"
+
+    def fetch(self, key: str, destination: Path) -> bool:
+        path = self._path(key)
+        if not path.exists():
+            return False
+        temporary_path = destination.with_name(f".{destination.name}.partial")
+        shutil.copyfile(path, temporary_path)
+        os.replace(temporary_path, destination)
+        return True
+
+    def store(self, key: str, source: Path) -> None:
+        path = self._path(key)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        temporary_path = path.with_name(f"{path.name}.partial")
+        shutil.copyfile(source, temporary_path)
+        os.replace(temporary_path, path)
+
+
+class HttpArtifactBackend:
+    def __init__(self, url: str) -> None:
+        self.url = url.rstrip("/")
+        token = os.environ.get(TOKEN_ENV_VAR)
+        self.headers = {"Authorization": f"Bearer {token}"} if token else {}
+
+    def __str__(self) -> str:
+        return self.url
+
+    def fetch(self, key: str, destination: Path) -> bool:
+        temporary_path = destination.with_name(f".{destination.name}.partial")
+        try:
+            with get_session().get(
+                f"{self.url}/{key}.asar", headers=self.headers, stream=True, timeout=TIMEOUT
+            ) as res:
+                if res.status_code == 404:
+                    return False
+                res.raise_for_status()
+                with open(temporary_path, "wb") as out_file:
+                    for chunk in res.iter_content(chunk_size=CHUNK_SIZE):
+                        out_file.write(chunk)
+            os.replace(temporary_path, destination)
+        finally:
+            temporary_path.unlink(missing_ok=True)
+        return True
+
+    def store(self, key: str, source: Path) -> None:
+        with open(source, "rb") as source_file:
+            res = get_session().put(f"{self.url}/{key}.asar", data=source_file, headers=self.headers, timeout=TIMEOUT)
+        res.raise_for_status()
+
+
+def get_artifact_backend(location: str) -> ArtifactBackend:
+    """Backend for a directory path or an http(s) URL."""
+    if location.startswith(("http://", "https://")):
+        return HttpArtifactBackend(location)
+    return LocalArtifactBackend(Path(location))
+
+
+def _hash_tree(digest: "hashlib._Hash", label: str, path: Path) -> None:
+    digest.update(f"{label}\0".encode())
+    if path.is_dir():
+        for relative_path in list_files(path):
+            digest.update(f"{relative_path}\0{classify_file(path / relative_path)['hash']}\0".encode())
+    elif path.exists():
+        digest.update(f"{classify_file(path)['hash']}\0".encode())
+
+
+@span("build key")
+def get_build_key(project_config: ProjectConfig, upstream_files: dict[str, str], packer: str) -> str:
+    """
+    Hash everything the ASAR is built from. `upstream_files` maps the relative paths of the cached version to their
+    hashes, as recorded in its store manifest.
+    """
+    digest = hashlib.sha256()
+    digest.update(f"mim-asar-{BUILD_KEY_VERSION}\0{packer}\0".encode())
+    digest.update(json.dumps(sorted(upstream_files.items())).encode())
+    # Hashed the same way whether the patches are loose or bundled
+    digest.update(b"patches\0")
+    with open_patch_store(project_config["patches_dir"]) as store:
+        for path in store.paths():
+            digest.update(f"{path}\0{store.hash(path)}\0".encode())
+    for src, relative_dest, _ in project_config["link_files"]:
+        _hash_tree(digest, f"link:{relative_dest}", src)
+    _hash_tree(digest, "replace_vars.sh", REPLACE_SCRIPT)
+    return digest.hexdigest()
+
+
+def fetch_artifact(backends: list[ArtifactBackend], key: str, destination: Path) -> Optional[ArtifactBackend]:
+    """Look for the artifact in every backend in order, returning the one it was found in."""
+    for backend in backends:
+        try:
+            if backend.fetch(key, destination):
+                return backend
+        except OSError as e:  # requests' errors included
+            warning(f"Could not look up the build in {backend}: {e}", bold=False)
+    return None
+
+
+def store_artifact(backends: list[ArtifactBackend], key: str, source: Path) -> None:
+    """Store the artifact in every backend. Failing to do so only warns, as the build itself succeeded."""
+    for backend in backends:
+        try:
+            backend.store(key, source)
+        except OSError as e:  # requests' errors included
+            warning(f"Could not store the build in {backend}: {e}", bold=False)
@@ -0,0 +1,200 @@
+import fnmatch
+import hashlib
+import json
+import os
+import shutil
+import struct
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, BinaryIO, Literal, Sequence, TypedDict
+
+from cli.trace import span
+
+AsarBackend = Literal["python", "npx"]
+# Header index node: a folder ({"files": ...}), a file ({"size": ..., "offset": ...}) or a link ({"link": ...})
+AsarNode = dict[str, Any]
+
+"""
+ASAR archives, as read by Electron: a header with the JSON index of every file, followed by the contents of the files
+one after the other. The header is wrapped in two Chromium pickles: the first one holds the size of the second one,
+which holds the JSON string.
+
+Every packed file records its integrity (SHA-256 of the whole file and of each 4 MiB block), which Electron checks
+when ASAR integrity is enabled; the hash of the header itself is what goes in the application's integrity fuse.
+Files matching the `unpack` globs are left out of the archive, in a `<archive>.unpacked` folder next to it.
+"""
+
+INTEGRITY_BLOCK_SIZE = 4 * 1024 * 1024
+COPY_BUFFER_SIZE = 8 * 1024 * 1024
+
+
+class AsarIntegrity(TypedDict):
+    algorithm: Literal["SHA256"]
+    hash: str
+    blockSize: int
+    blocks: list[str]
+
+
+class AsarEntry(TypedDict):
+    path: Path
+    # Its node in the header index, filled in once the integrity is known
+    node: AsarNode
+    size: int
+    unpacked: bool
+    executable: bool
+
+
+def file_integrity(path: Path) -> AsarIntegrity:
+    """Integrity of a file, computed the same way as @electron/asar."""
+    file_hash = hashlib.sha256()
+    blocks: list[str] = []
+    with open(path, "rb") as file:
+        while True:
+            block = file.read(INTEGRITY_BLOCK_SIZE)
+            file_hash.update(block)
+            # The last block is always hashed, even when empty
+            blocks.append(hashlib.sha256(block).hexdigest())
+            if len(block) < INTEGRITY_BLOCK_SIZE:
+                break
+    return {"algorithm": "SHA256", "hash": file_hash.hexdigest(), "blockSize": INTEGRITY_BLOCK_SIZE, "blocks": blocks}
+
+
+def _pickle(payload: bytes) -> bytes:
+    return struct.pack("<I", len(payload)) + payload
+
+
+def encode_header(header: AsarNode) -> tuple[bytes, str]:
+    """Encode the header index, returning it with its hash."""
+    header_string = json.dumps(header, separators=(",", ":"), ensure_ascii=False)
+    encoded = header_string.encode()
+    padding = -len(encoded) % 4
+    header_pickle = _pickle(struct.pack("<i", len(encoded)) + encoded + b"\0" * padding)
+    size_pickle = _pickle(struct.pack("<I", len(header_pickle)))
+    return size_pickle + header_pickle, hashlib.sha256(encoded).hexdigest()
+
+
+def _matches(relative_path: str, patterns: Sequence[str]) -> bool:
+    # Patterns without a slash match the file name anywhere, like minimatch's `matchBase`
+    name = relative_path.rsplit("/", 1)[-1]
+    return any(fnmatch.fnmatch(relative_path if "/" in pattern else name, pattern) for pattern in patterns)
+
+
+def _is_in_unpacked_dir(relative_path: str, unpack_dirs: Sequence[str]) -> bool:
+    parents = relative_path.split("/")[:-1]
+    ancestors = ["/".join(parents[:index]) for index in range(1, len(parents) + 1)]
+    return any(fnmatch.fnmatch(ancestor, pattern.rstrip("/")) for ancestor in ancestors for pattern in unpack_dirs)
+
+
+def _add_node(root: AsarNode, relative_path: str, node: AsarNode) -> None:
+    directory = root
+    *parents, name = relative_path.split("/")
+    for parent in parents:
+        directory = directory["files"].setdefault(parent, {"files": {}})
+    directory["files"][name] = node
+
+
+def _copy_contents(source: Path, out_file: BinaryIO, size: int) -> None:
+    """Append the file to the archive, through sendfile when possible so that its contents never go through Python."""
+    copied = 0
+    with open(source, "rb") as source_file:
+        if sys.platform == "linux":
+            try:
+                while copied < size:
+                    sent = os.sendfile(out_file.fileno(), source_file.fileno(), copied, size - copied)
+                    if sent == 0:
+                        break
+                    copied += sent
+            except OSError:
+                # Not supported between these files: copy the rest
+                pass
+        source_file.seek(copied)
+        while copied < size:
+            block = source_file.read(min(COPY_BUFFER_SIZE, size - copied))
+            if not block:
+                break
+            out_file.write(block)
+            copied += len(block)
+    if copied != size:
+        raise OSError(f"'{source.as_posix()}' changed while being packed.")
+
+
+@span("asar pack")
+def pack_asar(
+    source_dir: Path,
+    output: Path,
+    *,
+    unpack: Sequence[str] = (),
+    unpack_dirs: Sequence[str] = (),
+    jobs: int = 1,
+) -> str:
+    """
+    Pack `source_dir` into the `output` archive, returning the hash of its header. Files are added in sorted order, so
+    the same folder always gives the same archive.
+    """
+    root: AsarNode = {"files": {}}
+    entries: list[AsarEntry] = []
+    for current_dir, directories, filenames in os.walk(source_dir):
+        directories.sort()
+        relative_dir = Path(current_dir).relative_to(source_dir)
+        for name in sorted([*directories, *filenames]):
+            path = Path(current_dir) / name
+            relative_path = (relative_dir / name).as_posix()
+            if path.is_symlink():
+                target = path.resolve()
+                if not target.is_relative_to(source_dir.resolve()):
+                    raise ValueError(f"'{relative_path}' links out of the packed folder.")
+                _add_node(root, relative_path, {"link": target.relative_to(source_dir.resolve()).as_posix()})
+                if name in directories:
+                    directories.remove(name)
+                continue
+            if path.is_dir():
+                _add_node(root, relative_path, {"files": {}})
+                continue
+            stat = os.stat(path)
+            node: AsarNode = {"size": stat.st_size}
+            _add_node(root, relative_path, node)
+            entries.append(
+                {
+                    "path": path,
+                    "node": node,
+                    "size": stat.st_size,
+                    "unpacked": _matches(relative_path, unpack) or _is_in_unpacked_dir(relative_path, unpack_dirs),
+                    "executable": sys.platform != "win32" and bool(stat.st_mode & 0o100),
+                }
+            )
+
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        integrities = list(executor.map(lambda entry: file_integrity(entry["path"]), entries))
+
+    offset = 0
+    for entry, integrity in zip(entries, integrities, strict=True):
+        node = entry["node"]
+        if entry["unpacked"]:
+            node["unpacked"] = True
+        else:
+            node["offset"] = str(offset)
+            offset += entry["size"]
+        if entry["executable"]:
+            node["executable"] = True
+        node["integrity"] = integrity
+
+    header, header_hash = encode_header(root)
+    temporary_output = output.with_name(f"{output.name}.partial")
+    # Unbuffered, as sendfile writes to the file behind Python's back
+    with open(temporary_output, "wb", buffering=0) as out_file:
+        out_file.write(header)
+        for entry in entries:
+            if not entry["unpacked"]:
+                _copy_contents(entry["path"], out_file, entry["size"])
+    os.replace(temporary_output, output)
+
+    unpacked_dir = output.with_name(f"{output.name}.unpacked")
+    if unpacked_dir.exists():
+        shutil.rmtree(unpacked_dir)
+    for entry in entries:
+        if entry["unpacked"]:
+            destination = unpacked_dir / entry["path"].relative_to(source_dir)
+            destination.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copy2(entry["path"], destination)
+    return header_hash
@@ -0,0 +1,599 @@
+import contextlib
+import functools
+import http.server
+import io
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zipfile
+from datetime import datetime
+from pathlib import Path
+from types import ModuleType
+from typing import Callable, Iterator, Optional, TypedDict
+
+import click
+from click.testing import CliRunner
+
+import cli.config
+from cli import cli_instance, stage_workspace
+from cli.archive import extract_archive
+from cli.cache import collect_garbage, evict_version, read_version_manifest
+from cli.config import ProjectConfig, get_project_config
+from cli.github import get_project_folder
+from cli.manifest import get_manifest_path
+from cli.patcher import diff_files, generate_patch
+from cli.utils import CACHE_DIR, PROJECT_DIR, error, log, success, warning
+from cli.workspace import get_workspace_dir, get_workspace_state_path
+
+"""
+Benchmarks of the CLI pipeline, on a synthetic project shaped like Element: thousands of source files in nested
+folders, large translation JSONs, a lockfile and binary icons, with a patch set touching a given ratio of its files.
+The release archive is served by a local HTTP server standing in for Github.
+
+Every phase is timed on its own, several times, and the results are stored as JSON so that two runs can be compared:
+- `download`: fetching and extracting the release into an empty cache.
+- `extract`: extracting the release archive alone.
+- `init`: setting up the local copy from the cache, patches included.
+- `diff`: diffing the files edited in the local copy.
+- `generate-patches`: the whole command, after editing the local copy.
+- `check-patches`: the whole command.
+- `asar-patch-cold` / `asar-patch-warm`: the patch phase of `generate-asar` (staging its workspace), from scratch and
+  with nothing changed.
+
+The startup of the CLI is timed as well, in fresh interpreters: importing it, and printing the help of the CLI and of a
+command, which is the cost of every invocation that has (almost) nothing to do.
+"""
+
+# Number of files of each scale
+SCALES = {"small": 2_000, "medium": 10_000, "large": 40_000}
+LANGUAGES = 30
+VERSION = "v1.0.0"
+RESULTS_FORMAT = 1
+
+# Arguments given to the interpreter, from the repository root
+STARTUP_COMMANDS = {
+    "import": ["-c", "import cli"],
+    "help": ["make.py", "--help"],
+    "command-help": ["make.py", "generate-patches", "--help"],
+}
+
+WORDS = (
+    "room member event timeline message space thread reply state power level key device session call widget "
+    "avatar name topic alias server client sync filter notification receipt presence typing encryption"
+).split()
+
+
+class PhaseResult(TypedDict):
+    # Seconds of every run
+    runs: list[float]
+    median: float
+    min: float
+
+
+class BenchmarkResults(TypedDict):
+    format: int
+    created: str
+    commit: Optional[str]
+    python: str
+    platform: str
+    cpu_count: Optional[int]
+    jobs: int
+    repeat: int
+    seed: int
+    # `<scale>/<phase>` or `<scale>/<ratio>/<phase>` -> timings
+    results: dict[str, PhaseResult]
+
+
+# Synthetic project
+
+
+def _sentence(rng: random.Random, words: int) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(words))
+
+
+def _source_file(rng: random.Random, index: int) -> str:
+    lines = [f'import {{ {rng.choice(WORDS).title()}Store }} from "../../stores/{rng.choice(WORDS)}";\n', "\n"]
+    for function in range(rng.randint(3, 30)):
+        name = f"{rng.choice(WORDS)}{rng.choice(WORDS).title()}{index}_{function}"
+        lines.append(f"export function {name}(props: Props): JSX.Element {{\n")
+        for statement in range(rng.randint(3, 12)):
+            lines.append(f'    const {rng.choice(WORDS)}{statement} = _t("{_sentence(rng, 4)}");\n')
+        lines.append(f'    return <div className="mx_{name}">{{{rng.choice(WORDS)}0}}</div>;\n')
+        lines.append("}\n\n")
+    return "".join(lines)
+
+
+def _translations(rng: random.Random, keys: int) -> str:
+    strings = {f"{rng.choice(WORDS)}|{key}": _sentence(rng, rng.randint(3, 15)) for key in range(keys)}
+    return json.dumps(strings, indent=4) + "\n"
+
+
+def _lockfile(rng: random.Random, entries: int) -> str:
+    lines = ["# THIS IS AN AUTOGENERATED FILE. DO NOT EDIT THIS FILE DIRECTLY.\n", "# yarn lockfile v1\n", "\n"]
+    for entry in range(entries):
+        package = f"{rng.choice(WORDS)}-{rng.choice(WORDS)}-{entry}"
+        version = f"{rng.randint(0, 9)}.{rng.randint(0, 30)}.{rng.randint(0, 99)}"
+        lines.append(f'"{package}@^{version}":\n')
+        lines.append(f'  version "{version}"\n')
+        lines.append(f'  resolved "https://registry.yarnpkg.com/{package}/-/{package}-{version}.tgz"\n')
+        lines.append(f"  integrity sha512-{rng.randbytes(48).hex()}\n\n")
+    return "".join(lines)
+
+
+def _icon(rng: random.Random) -> bytes:
+    return b"\x89PNG\r\n\x1a\n" + rng.randbytes(rng.randint(512, 8192))
+
+
+def generate_tree(root: Path, files: int, seed: int) -> list[str]:
+    """Write a synthetic Element-like project of about `files` files, returning their relative paths."""
+    rng = random.Random(seed)
+    contents: dict[str, bytes] = {
+        "package.json": (json.dumps({"name": "element-web", "version": VERSION}, indent=2) + "\n").encode(),
+        "yarn.lock": _lockfile(rng, max(100, files // 8)).encode(),
+    }
+    for language in range(LANGUAGES):
+        contents[f"src/i18n/strings/lang_{language}.json"] = _translations(rng, max(200, files // 8)).encode()
+    for icon in range(max(10, files // 40)):
+        contents[f"res/img/icons/{rng.choice(WORDS)}_{icon}.png"] = _icon(rng)
+    index = 0
+    while len(contents) < files:
+        folder = f"src/components/{WORDS[index // 500 % len(WORDS)]}/{WORDS[index // 25 % len(WORDS)]}{index // 25}"
+        contents[f"{folder}/{rng.choice(WORDS).title()}View{index}.tsx"] = _source_file(rng, index).encode()
+        index += 1
+
+    for relative_path, data in contents.items():
+        path = root / relative_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(data)
+    return sorted(contents)
+
+
+def edit_file(rng: random.Random, path: Path) -> None:
+    """Edit a file the way a patch would: a few lines inserted and replaced, or a whole new icon."""
+    if path.suffix == ".png":
+        path.write_bytes(_icon(rng))
+        return
+    lines = path.read_text().splitlines(keepends=True)
+    for _ in range(rng.randint(1, 3)):
+        position = rng.randint(0, len(lines))
+        lines[position:position] = [f"// MiM: {_sentence(rng, 6)}\n"]
+    position = rng.randrange(len(lines))
+    lines[position] = f"{lines[position].rstrip()} // {_sentence(rng, 2)}\n"
+    path.write_text("".join(lines))
+
+
+def generate_patches(
+    upstream_dir: Path, patches_dir: Path, relative_paths: list[str], ratio: float, seed: int
+) -> list[str]:
+    """Write patches for a `ratio` of the files, returning the relative paths of the patched files."""
+    rng = random.Random(seed)
+    patched = sorted(rng.sample(relative_paths, max(1, int(len(relative_paths) * ratio))))
+    with tempfile.TemporaryDirectory() as temporary_dir:
+        for relative_path in patched:
+            edited = Path(temporary_dir) / f"edited{Path(relative_path).suffix}"
+            shutil.copy(upstream_dir / relative_path, edited)
+            edit_file(rng, edited)
+            patch_file = patches_dir / f"{relative_path}.patch"
+            patch_file.parent.mkdir(parents=True, exist_ok=True)
+            if edited.suffix == ".png":
+                shutil.copy(edited, patch_file)
+                continue
+            patch_file.write_text("".join(generate_patch(upstream_dir / relative_path, edited)))
+    return patched
+
+
+def write_zipball(source_dir: Path, zip_path: Path) -> None:
+    """Zip the project the way Github serves releases, under a top folder."""
+    with zipfile.ZipFile(zip_path, "w", zipfile.ZIP_DEFLATED) as zip_file:
+        for root, directories, filenames in os.walk(source_dir):
+            directories.sort()
+            for filename in sorted(filenames):
+                path = Path(root) / filename
+                zip_file.write(path, f"element-hq-element-web-0000000/{path.relative_to(source_dir).as_posix()}")
+
+
+class _QuietHandler(http.server.SimpleHTTPRequestHandler):
+    def log_message(self, format: str, *args: object) -> None:
+        pass
+
+
+@contextlib.contextmanager
+def serve_directory(directory: Path) -> Iterator[str]:
+    """Serve the directory over HTTP on a free local port, yielding its base URL."""
+    server = http.server.ThreadingHTTPServer(
+        ("127.0.0.1", 0), functools.partial(_QuietHandler, directory=directory.as_posix())
+    )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{server.server_address[1]}"
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+# Timing
+
+
+@contextlib.contextmanager
+def _quiet() -> Iterator[io.StringIO]:
+    output = io.StringIO()
+    with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+        yield output
+
+
+def time_phase(run: Callable[[], object], repeat: int, setup: Optional[Callable[[], object]] = None) -> PhaseResult:
+    """Time `repeat` runs of a phase, calling `setup` (untimed) before each one."""
+    runs: list[float] = []
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        with _quiet() as output:
+            start = time.perf_counter()
+            try:
+                run()
+            except BaseException:
+                sys.stderr.write(output.getvalue())
+                raise
+            runs.append(time.perf_counter() - start)
+    return {"runs": runs, "median": statistics.median(runs), "min": min(runs)}
+
+
+def _invoke(*args: str) -> None:
+    result = CliRunner().invoke(cli_instance, list(args), catch_exceptions=False)
+    if result.exit_code != 0:
+        raise RuntimeError(f"'{' '.join(args)}' failed:\n{result.output}")
+
+
+@contextlib.contextmanager
+def isolated_cache(work_dir: Path) -> Iterator[None]:
+    """
+    Point the cache and the configuration of the CLI to the work folder, so that benchmarks never evict the cached
+    versions of the real projects. Every path the CLI modules derive from the cache folder is redirected.
+    """
+    cache_dir = work_dir / ".cache"
+    saved: list[tuple[ModuleType, str, object]] = [(cli.config, "CONFIG_FILE", cli.config.CONFIG_FILE)]
+    for module_name, module in list(sys.modules.items()):
+        if module_name != "cli" and not module_name.startswith("cli."):
+            continue
+        for attribute, value in list(vars(module).items()):
+            if isinstance(value, Path) and value.is_relative_to(CACHE_DIR):
+                saved.append((module, attribute, value))
+                setattr(module, attribute, type(value)(cache_dir, value.relative_to(CACHE_DIR)))
+    cli.config.CONFIG_FILE = work_dir / "build_config.yml"
+    try:
+        yield
+    finally:
+        for module, attribute, value in saved:
+            setattr(module, attribute, value)
+
+
+def _clear_version(project_config: ProjectConfig) -> None:
+    manifest = read_version_manifest(project_config["name"], project_config["version"])
+    if manifest is not None:
+        evict_version(manifest)
+    shutil.rmtree(CACHE_DIR / project_config["name"], ignore_errors=True)
+    collect_garbage()
+
+
+def _format_ratio(ratio: float) -> str:
+    return f"{ratio:g}"
+
+
+def benchmark_ratio(
+    project_config: ProjectConfig,
+    project_dir: Path,
+    upstream_dir: Path,
+    relative_paths: list[str],
+    ratio: float,
+    prefix: str,
+    work_dir: Path,
+    jobs: int,
+    repeat: int,
+    seed: int,
+) -> dict[str, PhaseResult]:
+    results: dict[str, PhaseResult] = {}
+    name = project_config["name"]
+    patches_dir = project_config["patches_dir"]
+    local_dir = project_config["local_dir"]
+    shutil.rmtree(patches_dir, ignore_errors=True)
+    generate_patches(upstream_dir, patches_dir, relative_paths, ratio, seed)
+
+    log(f"Timing {prefix}/init...")
+    results[f"{prefix}/init"] = time_phase(
+        lambda: _invoke("init", "-y", "-j", str(jobs), name),
+        repeat,
+        lambda: shutil.rmtree(local_dir, ignore_errors=True),
+    )
+
+    # Edit another share of the files, then keep the state to go back to before each run
+    rng = random.Random(seed + 1)
+    edited = sorted(rng.sample(relative_paths, max(1, int(len(relative_paths) * ratio))))
+    for relative_path in edited:
+        edit_file(rng, local_dir / relative_path)
+    manifest_path = get_manifest_path(project_config)
+    saved_manifest = manifest_path.read_bytes()
+    saved_patches = work_dir / "saved_patches"
+    shutil.copytree(patches_dir, saved_patches)
+
+    def restore() -> None:
+        manifest_path.write_bytes(saved_manifest)
+        shutil.rmtree(patches_dir, ignore_errors=True)
+        shutil.copytree(saved_patches, patches_dir)
+
+    log(f"Timing {prefix}/diff...")
+    results[f"{prefix}/diff"] = time_phase(lambda: diff_files(edited, project_dir, local_dir, jobs), repeat)
+    log(f"Timing {prefix}/generate-patches...")
+    results[f"{prefix}/generate-patches"] = time_phase(
+        lambda: _invoke("generate-patches", "-j", str(jobs), name), repeat, restore
+    )
+    restore()
+    shutil.rmtree(saved_patches)
+
+    log(f"Timing {prefix}/check-patches...")
+    results[f"{prefix}/check-patches"] = time_phase(lambda: _invoke("check-patches", "-j", str(jobs), name), repeat)
+
+    def stage() -> object:
+        return stage_workspace(project_config, project_dir, "python", jobs, "auto")
+
+    def clear_workspace() -> None:
+        shutil.rmtree(get_workspace_dir(project_config), ignore_errors=True)
+        get_workspace_state_path(project_config).unlink(missing_ok=True)
+
+    log(f"Timing {prefix}/asar-patch-cold...")
+    results[f"{prefix}/asar-patch-cold"] = time_phase(stage, repeat, clear_workspace)
+    log(f"Timing {prefix}/asar-patch-warm...")
+    results[f"{prefix}/asar-patch-warm"] = time_phase(stage, repeat)
+    clear_workspace()
+    shutil.rmtree(local_dir, ignore_errors=True)
+    return results
+
+
+def benchmark_scale(
+    scale: str, ratios: list[float], work_dir: Path, jobs: int, repeat: int, seed: int
+) -> dict[str, PhaseResult]:
+    files = SCALES[scale]
+    results: dict[str, PhaseResult] = {}
+    name = f"mim-benchmark-{scale}"
+
+    log(f"Generating the {scale} project ({files} files)...")
+    upstream_dir = work_dir / "upstream"
+    relative_paths = generate_tree(upstream_dir, files, seed)
+    serve_dir = work_dir / "serve"
+    serve_dir.mkdir()
+    write_zipball(upstream_dir, serve_dir / "release.zip")
+
+    with serve_directory(serve_dir) as url:
+        tags = [{"name": VERSION, "zipball_url": f"{url}/release.zip", "commit": {"sha": "0" * 40, "url": ""}}]
+        (serve_dir / "tags.json").write_text(json.dumps(tags))
+        (work_dir / "build_config.yml").write_text(
+            f"{name}:\n  tags_url: {url}/tags.json\n  version: {VERSION}\n"
+            "  local_dir: ./local\n  patches_dir: ./patches\n  link_files: []\n"
+        )
+        with isolated_cache(work_dir):
+            project_config = get_project_config(name)
+            log(f"Timing {scale}/download...")
+            results[f"{scale}/download"] = time_phase(
+                lambda: get_project_folder(project_config), repeat, lambda: _clear_version(project_config)
+            )
+            extracted_dir = work_dir / "extracted"
+            log(f"Timing {scale}/extract...")
+            results[f"{scale}/extract"] = time_phase(
+                lambda: extract_archive(serve_dir / "release.zip", extracted_dir, jobs),
+                repeat,
+                lambda: shutil.rmtree(extracted_dir, ignore_errors=True),
+            )
+            shutil.rmtree(extracted_dir, ignore_errors=True)
+            with _quiet():
+                project_dir = get_project_folder(project_config)
+
+            for ratio in ratios:
+                results.update(
+                    benchmark_ratio(
+                        project_config,
+                        project_dir,
+                        upstream_dir,
+                        relative_paths,
+                        ratio,
+                        f"{scale}/{_format_ratio(ratio)}",
+                        work_dir,
+                        jobs,
+                        repeat,
+                        seed,
+                    )
+                )
+    return results
+
+
+def benchmark_startup(repeat: int) -> dict[str, PhaseResult]:
+    results: dict[str, PhaseResult] = {}
+    for name, args in STARTUP_COMMANDS.items():
+        log(f"Timing startup/{name}...")
+
+        start = functools.partial(
+            subprocess.run, [sys.executable, *args], cwd=PROJECT_DIR, check=True, stdout=subprocess.DEVNULL
+        )
+        # Not timed, so that bytecode is compiled and cached
+        start()
+        results[f"startup/{name}"] = time_phase(start, repeat)
+    return results
+
+
+def _get_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=PROJECT_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def new_results(jobs: int, repeat: int, seed: int) -> BenchmarkResults:
+    return {
+        "format": RESULTS_FORMAT,
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "commit": _get_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "jobs": jobs,
+        "repeat": repeat,
+        "seed": seed,
+        "results": {},
+    }
+
+
+def save_results(benchmark: BenchmarkResults, output: Path) -> None:
+    print_results(benchmark["results"])
+    with open(output, "w") as output_file:
+        json.dump(benchmark, output_file, indent=2)
+    success(f"Results saved to '{output.resolve().as_posix()}'.")
+
+
+def print_results(results: dict[str, PhaseResult]) -> None:
+    width = max(len(name) for name in results)
+    for name, result in results.items():
+        log(f"{name.ljust(width)}  {result['median'] * 1000:10.1f} ms  (min {result['min'] * 1000:.1f} ms)")
+
+
+# Commands
+
+
+@click.group
+def benchmark_cli() -> None:
+    """Benchmarks of the CLI pipeline."""
+
+
+@benchmark_cli.command
+@click.option(
+    "--scale",
+    "scales",
+    type=click.Choice(list(SCALES)),
+    multiple=True,
+    default=["small", "medium"],
+    show_default=True,
+    help="Project sizes to run the benchmarks on.",
+)
+@click.option(
+    "--ratio",
+    "ratios",
+    type=click.FloatRange(0, 1, min_open=True),
+    multiple=True,
+    default=[0.01, 0.1],
+    show_default=True,
+    help="Share of the files that are patched, and then edited.",
+)
+@click.option("--startup/--no-startup", default=True, help="Also time the startup of the CLI.")
+@click.option("--repeat", type=click.IntRange(min=1), default=3, show_default=True, help="Runs of every phase.")
+@click.option(
+    "-j",
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=os.cpu_count() or 1,
+    show_default="CPU count",
+    help="Jobs given to the commands.",
+)
+@click.option("--seed", type=int, default=0, show_default=True, help="Seed of the synthetic project.")
+@click.option(
+    "-o",
+    "--output",
+    type=click.Path(dir_okay=False, writable=True, path_type=Path),
+    default="benchmark.json",
+    show_default=True,
+)
+def run(
+    scales: tuple[str, ...],
+    ratios: tuple[float, ...],
+    startup: bool,
+    repeat: int,
+    jobs: int,
+    seed: int,
+    output: Path,
+) -> None:
+    """Run the benchmarks and store their results as JSON."""
+    benchmark = new_results(jobs, repeat, seed)
+    if startup:
+        benchmark["results"].update(benchmark_startup(repeat))
+    current_dir = os.getcwd()
+    for scale in scales:
+        with tempfile.TemporaryDirectory(prefix="mim-benchmark-") as work_dir:
+            os.chdir(work_dir)
+            try:
+                benchmark["results"].update(benchmark_scale(scale, list(ratios), Path(work_dir), jobs, repeat, seed))
+            finally:
+                os.chdir(current_dir)
+    save_results(benchmark, output)
+
+
+@benchmark_cli.command
+@click.option("--repeat", type=click.IntRange(min=1), default=10, show_default=True, help="Runs of every command.")
+@click.option(
+    "-o",
+    "--output",
+    type=click.Path(dir_okay=False, writable=True, path_type=Path),
+    default="benchmark-startup.json",
+    show_default=True,
+)
+def startup(repeat: int, output: Path) -> None:
+    """Only time the startup of the CLI, and store the results as JSON."""
+    benchmark = new_results(1, repeat, 0)
+    benchmark["results"].update(benchmark_startup(repeat))
+    save_results(benchmark, output)
+
+
+@benchmark_cli.command
+@click.option(
+    "--threshold",
+    type=click.FloatRange(min=0),
+    default=0.1,
+    show_default=True,
+    help="Relative slowdown of the median past which a phase is a regression.",
+)
+@click.option(
+    "--min-delta",
+    type=click.FloatRange(min=0),
+    default=0.01,
+    show_default=True,
+    help="Slowdowns under this many seconds are never regressions, as they are mostly noise.",
+)
+@click.argument("baseline", type=click.Path(exists=True, dir_okay=False, path_type=Path))
+@click.argument("current", type=click.Path(exists=True, dir_okay=False, path_type=Path))
+def compare(baseline: Path, current: Path, threshold: float, min_delta: float) -> None:
+    """Compare two benchmark results, failing if any phase got slower."""
+    with open(baseline, "r") as baseline_file:
+        baseline_results: BenchmarkResults = json.load(baseline_file)
+    with open(current, "r") as current_file:
+        current_results: BenchmarkResults = json.load(current_file)
+    if baseline_results["jobs"] != current_results["jobs"] or baseline_results["seed"] != current_results["seed"]:
+        warning("The results were run with different jobs or seeds, and may not be comparable.")
+
+    regressions = 0
+    names = [name for name in current_results["results"] if name in baseline_results["results"]]
+    width = max((len(name) for name in names), default=0)
+    for name in names:
+        before = baseline_results["results"][name]["median"]
+        after = current_results["results"][name]["median"]
+        change = (after - before) / before if before else 0.0
+        line = f"{name.ljust(width)}  {before * 1000:10.1f} ms -> {after * 1000:10.1f} ms  ({change:+.1%})"
+        if change > threshold and after - before > min_delta:
+            regressions += 1
+            error(f"{line}  REGRESSION", bold=False)
+        elif change < -threshold and before - after > min_delta:
+            success(line, bold=False)
+        else:
+            log(line)
+
+    for name in sorted(set(baseline_results["results"]).symmetric_difference(current_results["results"])):
+        warning(f"{name} is only in one of the results.", bold=False)
+    if regressions:
+        error(f"{regressions} phases got slower.")
+        raise click.exceptions.Exit(1)
+    success("No regressions.")
@@ -0,0 +1,283 @@
+import hashlib
+import json
+import mmap
+import os
+import shutil
+import struct
+import zlib
+from pathlib import Path
+from types import TracebackType
+from typing import Iterable, Literal, Optional, Protocol, TypedDict
+
+from cli.classify import classify_file
+from cli.delta import is_delta
+from cli.manifest import list_files
+
+PatchKind = Literal["text", "binary", "delta"]
+Compression = Literal["none", "zlib"]
+
+"""
+Patches are kept either loose, one file per patched file under the patches folder, or packed in a single bundle file
+next to it (`<patches_dir>.bundle`). Loose patches are easier to review in git; a bundle is read with a single open and
+an index lookup per patch, which is much faster on network filesystems and Windows runners.
+
+Bundle layout:
+- `MAGIC`, then the size of the index (unsigned 32 bits, little endian).
+- The index: a JSON list of entries, with the path, offset, length, kind and SHA-256 of every patch.
+- The payloads, one after the other. Payloads are zlib-compressed when it makes them smaller, and stored as-is
+  otherwise (binary files and deltas, usually), so that they can be read straight from the memory map.
+
+Both layouts are read through the same `PatchStore` interface, with paths relative to the patches folder (including
+the `.patch` suffix).
+"""
+
+MAGIC = b"MIMBUNDLE\x00\x01"
+HEADER = struct.Struct(f"<{len(MAGIC)}sI")
+
+
+class BundleError(Exception):
+    """The bundle is malformed or corrupted."""
+
+
+class BundleEntry(TypedDict):
+    path: str
+    # Position of the payload, from the end of the index
+    offset: int
+    # Size of the payload, and of the patch once decompressed
+    length: int
+    size: int
+    kind: PatchKind
+    compression: Compression
+    # SHA-256 of the patch, the same as for its loose file
+    hash: str
+
+
+class PatchStore(Protocol):
+    def paths(self) -> list[str]:
+        """Every patch path, sorted."""
+        ...
+
+    def hash(self, path: str) -> str: ...
+
+    def is_binary(self, path: str) -> bool: ...
+
+    def read(self, path: str) -> bytes: ...
+
+    def close(self) -> None: ...
+
+    def __enter__(self) -> "PatchStore": ...
+
+    def __exit__(
+        self,
+        exc_type: Optional[type[BaseException]],
+        exc_value: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None: ...
+
+
+class LoosePatchStore:
+    def __init__(self, directory: Path) -> None:
+        self.directory = directory
+
+    def __enter__(self) -> "LoosePatchStore":
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[type[BaseException]],
+        exc_value: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        self.close()
+
+    def paths(self) -> list[str]:
+        return list_files(self.directory)
+
+    def hash(self, path: str) -> str:
+        return classify_file(self.directory / path)["hash"]
+
+    def is_binary(self, path: str) -> bool:
+        return classify_file(self.directory / path)["binary"]
+
+    def read(self, path: str) -> bytes:
+        return (self.directory / path).read_bytes()
+
+    def close(self) -> None:
+        pass
+
+
+class PatchBundle:
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        with open(path, "rb") as bundle_file:
+            header = bundle_file.read(HEADER.size)
+            if len(header) < HEADER.size or not header.startswith(MAGIC):
+                raise BundleError(f"'{path.as_posix()}' is not a patch bundle.")
+            _, index_size = HEADER.unpack(header)
+            try:
+                entries: list[BundleEntry] = json.loads(bundle_file.read(index_size))
+            except ValueError as e:
+                raise BundleError(f"Corrupted bundle index in '{path.as_posix()}': {e}") from e
+            self.payloads_start = HEADER.size + index_size
+            self.map = mmap.mmap(bundle_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.entries = {entry["path"]: entry for entry in entries}
+
+    def __enter__(self) -> "PatchBundle":
+        return self
+
+    def __exit__(
+        self,
+        exc_type: Optional[type[BaseException]],
+        exc_value: Optional[BaseException],
+        traceback: Optional[TracebackType],
+    ) -> None:
+        self.close()
+
+    def paths(self) -> list[str]:
+        return sorted(self.entries)
+
+    def hash(self, path: str) -> str:
+        return self.entries[path]["hash"]
+
+    def is_binary(self, path: str) -> bool:
+        return self.entries[path]["kind"] != "text"
+
+    def read(self, path: str) -> bytes:
+        entry = self.entries[path]
+        start = self.payloads_start + entry["offset"]
+        if start + entry["length"] > len(self.map):
+            raise BundleError(f"Bundle '{self.path.as_posix()}' is truncated.")
+        data = self.map[start : start + entry["length"]]
+        if entry["compression"] == "zlib":
+            try:
+                data = zlib.decompress(data)
+            except zlib.error as e:
+                raise BundleError(f"Corrupted patch '{path}' in bundle: {e}") from e
+        if len(data) != entry["size"] or hashlib.sha256(data).hexdigest() != entry["hash"]:
+            raise BundleError(f"Patch '{path}' does not match its checksum in the bundle.")
+        return data
+
+    def close(self) -> None:
+        self.map.close()
+
+
+def get_bundle_path(patches_dir: Path) -> Path:
+    return patches_dir.with_name(f"{patches_dir.name}.bundle")
+
+
+def has_patches(patches_dir: Path) -> bool:
+    return patches_dir.exists() or get_bundle_path(patches_dir).exists()
+
+
+def is_bundled(patches_dir: Path) -> bool:
+    """Whether the patches are read from a bundle: it exists, and there is no loose patches folder to prefer."""
+    return not patches_dir.exists() and get_bundle_path(patches_dir).exists()
+
+
+def open_patch_store(patches_dir: Path) -> PatchStore:
+    """Open the patches in whichever layout they are in. A missing patches folder is an empty store."""
+    if is_bundled(patches_dir):
+        return PatchBundle(get_bundle_path(patches_dir))
+    return LoosePatchStore(patches_dir)
+
+
+def get_patch_kind(data: bytes) -> PatchKind:
+    if is_delta(data):
+        return "delta"
+    try:
+        data.decode()
+    except UnicodeDecodeError:
+        return "binary"
+    return "text"
+
+
+def write_bundle(output: Path, store: PatchStore) -> int:
+    """Pack every patch of the store into a bundle at `output`, returning how many were packed."""
+    return pack_bundle(output, ((path, store.read(path)) for path in store.paths()))
+
+
+def pack_bundle(output: Path, patches: Iterable[tuple[str, bytes]]) -> int:
+    """Pack the given (path, contents) patches, in that order, into a bundle at `output`."""
+    entries: list[BundleEntry] = []
+    payloads: list[bytes] = []
+    offset = 0
+    for path, data in patches:
+        stored = zlib.compress(data, 9)
+        compression: Compression = "zlib"
+        if len(stored) >= len(data):
+            stored, compression = data, "none"
+        entries.append(
+            {
+                "path": path,
+                "offset": offset,
+                "length": len(stored),
+                "size": len(data),
+                "kind": get_patch_kind(data),
+                "compression": compression,
+                "hash": hashlib.sha256(data).hexdigest(),
+            }
+        )
+        payloads.append(stored)
+        offset += len(stored)
+
+    index = json.dumps(entries, separators=(",", ":")).encode()
+    temporary_output = output.with_name(f"{output.name}.partial")
+    with open(temporary_output, "wb") as out_file:
+        out_file.write(HEADER.pack(MAGIC, len(index)))
+        out_file.write(index)
+        out_file.writelines(payloads)
+    os.replace(temporary_output, output)
+    return len(entries)
+
+
+def unpack_bundle(bundle: PatchBundle, patches_dir: Path) -> int:
+    """Write every patch of the bundle as a loose file under `patches_dir`, returning how many were written."""
+    for path in bundle.paths():
+        patch_file = patches_dir / path
+        patch_file.parent.mkdir(parents=True, exist_ok=True)
+        patch_file.write_bytes(bundle.read(path))
+    return len(bundle.paths())
+
+
+def save_patches(patches_dir: Path, source_dir: Path) -> None:
+    """Replace the patches with the loose ones in `source_dir`, packing them instead if the patches are bundled."""
+    if is_bundled(patches_dir):
+        write_bundle(get_bundle_path(patches_dir), LoosePatchStore(source_dir))
+        return
+    if patches_dir.exists():
+        shutil.rmtree(patches_dir)
+    shutil.copytree(source_dir, patches_dir)
+
+
+def update_patches(patches_dir: Path, changes: dict[str, Optional[bytes]]) -> None:
+    """
+    Write the given patches, deleting those set to None, in whichever layout the patches are in. Loose patches are
+    written one by one, each replaced atomically; a bundle is rewritten as a whole.
+    """
+    if is_bundled(patches_dir):
+        bundle_path = get_bundle_path(patches_dir)
+        # Everything is read before writing, as the bundle can't be replaced while mapped on Windows
+        with PatchBundle(bundle_path) as bundle:
+            patches = {path: bundle.read(path) for path in bundle.paths()}
+        for path, data in changes.items():
+            if data is None:
+                patches.pop(path, None)
+            else:
+                patches[path] = data
+        pack_bundle(bundle_path, sorted(patches.items()))
+        return
+
+    for path, data in changes.items():
+        patch_file = patches_dir / path
+        if data is None:
+            patch_file.unlink(missing_ok=True)
+            # Don't leave empty folders behind
+            parent = patch_file.parent
+            while parent != patches_dir and parent.is_dir() and not any(parent.iterdir()):
+                parent.rmdir()
+                parent = parent.parent
+            continue
+        patch_file.parent.mkdir(parents=True, exist_ok=True)
+        temporary_file = patch_file.with_name(f".{patch_file.name}.partial")
+        temporary_file.write_bytes(data)
+        os.replace(temporary_file, patch_file)
@@ -0,0 +1,328 @@
+import json
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+from typing import Iterable, Optional, TypedDict
+
+from cli.manifest import hash_file
+from cli.trace import span
+from cli.utils import CACHE_DIR, EnsurePath, is_windows
+
+"""
+Downloaded versions are kept in a content-addressed store: every unique file is stored once under its SHA-256, and each
+version has a manifest mapping its relative paths to those hashes. Consecutive versions share most of their files, so
+the store only grows by what changed between them.
+
+The usual `<name>/<version>` folder is still available to every command, but its files are hardlinks to the store
+objects (or copies, where hardlinks are not supported), so they take no extra space. Objects are read-only, as writing
+to one in place would change every version sharing it.
+"""
+
+STORE_DIR = CACHE_DIR / ".store"
+OBJECTS_DIR = STORE_DIR / "objects"
+VERSIONS_DIR = STORE_DIR / "versions"
+# Age after which a partial file or folder is taken as abandoned
+STALE_PARTIAL_AGE = 24 * 60 * 60
+
+
+class VersionManifest(TypedDict):
+    name: str
+    version: str
+    # Relative POSIX path -> SHA-256
+    files: dict[str, str]
+    # Total size of the version's files, counting shared ones
+    size: int
+    last_used: float
+
+
+class CacheOptions(TypedDict):
+    # Maximum size of the store objects in bytes, or None for no limit
+    size_limit: Optional[int]
+
+
+class CacheStats(TypedDict):
+    versions: list[VersionManifest]
+    objects: int
+    # Actual disk usage of the store objects
+    store_size: int
+    # Sum of the sizes of every version, as if nothing was shared
+    logical_size: int
+
+
+class GarbageCollection(TypedDict):
+    evicted: list[VersionManifest]
+    removed_objects: int
+    freed: int
+
+
+cache_options: CacheOptions = {"size_limit": None}
+
+
+def parse_size(text: str) -> int:
+    """Parse a size such as `512M`, `20G` or `1048576` (bytes)."""
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+    text = text.strip().upper().removesuffix("B").removesuffix("I")
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def format_size(size: float) -> str:
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            return f"{size:.1f} {unit}" if unit != "B" else f"{int(size)} B"
+        size /= 1024
+    return f"{size:.1f} TiB"
+
+
+def object_path(digest: str) -> Path:
+    return OBJECTS_DIR / digest[:2] / digest
+
+
+def get_version_manifest_path(name: str, version: str) -> EnsurePath:
+    return VERSIONS_DIR / name / f"{version}.json"
+
+
+def get_version_folder(name: str, version: str) -> EnsurePath:
+    return CACHE_DIR / name / version
+
+
+def read_version_manifest(name: str, version: str) -> Optional[VersionManifest]:
+    manifest_path = get_version_manifest_path(name, version)
+    try:
+        with open(manifest_path, "r") as manifest_file:
+            manifest: VersionManifest = json.load(manifest_file)
+    except (OSError, ValueError):
+        return None
+    return manifest
+
+
+def write_version_manifest(manifest: VersionManifest) -> None:
+    manifest_path = get_version_manifest_path(manifest["name"], manifest["version"])
+    manifest_path.parent.ensure()
+    temporary_path = manifest_path.with_suffix(".tmp")
+    with open(temporary_path, "w") as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(temporary_path, manifest_path)
+
+
+def list_version_manifests() -> list[VersionManifest]:
+    manifests: list[VersionManifest] = []
+    if not VERSIONS_DIR.exists():
+        return manifests
+    for manifest_path in sorted(VERSIONS_DIR.glob("*/*.json")):
+        manifest = read_version_manifest(manifest_path.parent.name, manifest_path.stem)
+        if manifest is not None:
+            manifests.append(manifest)
+    return manifests
+
+
+def _link_or_copy(source: Path, destination: Path) -> None:
+    """Hardlink `source` to `destination`, or copy it where hardlinks can't be made. Raises if `destination` exists."""
+    try:
+        os.link(source, destination)
+    except FileExistsError:
+        raise
+    except OSError:
+        # Copied aside first, so that another writer of the same object never sees or truncates a partial copy
+        temporary_path = destination.with_name(f".{destination.name}.{os.getpid()}-{threading.get_ident()}.copy")
+        shutil.copy2(source, temporary_path)
+        os.replace(temporary_path, destination)
+
+
+def _protect_object(path: Path) -> None:
+    # Read-only files can't be deleted on Windows, which would break evictions
+    if not is_windows:
+        os.chmod(path, 0o444)
+
+
+@span("cache ingest")
+def ingest_version(name: str, version: str, folder: Path) -> VersionManifest:
+    """Move the files of an extracted version into the store, leaving links to the stored objects in their place."""
+    files: dict[str, str] = {}
+    size = 0
+    for root, _, filenames in os.walk(folder):
+        for filename in filenames:
+            file_path = Path(root) / filename
+            if file_path.is_symlink():
+                continue
+            digest = hash_file(file_path)
+            stored = object_path(digest)
+            is_new = False
+            if not stored.exists():
+                stored.parent.mkdir(parents=True, exist_ok=True)
+                try:
+                    _link_or_copy(file_path, stored)
+                    is_new = True
+                except FileExistsError:
+                    # Stored by another version (or another run) in the meantime
+                    pass
+            if not is_new and not os.path.samefile(stored, file_path):
+                # Already stored by another version: share it
+                temporary_path = file_path.with_name(f".{filename}.link")
+                temporary_path.unlink(missing_ok=True)
+                _link_or_copy(stored, temporary_path)
+                os.replace(temporary_path, file_path)
+            _protect_object(stored)
+            files[file_path.relative_to(folder).as_posix()] = digest
+            size += os.stat(file_path).st_size
+
+    manifest: VersionManifest = {
+        "name": name,
+        "version": version,
+        "files": files,
+        "size": size,
+        "last_used": time.time(),
+    }
+    write_version_manifest(manifest)
+    return manifest
+
+
+def is_version_stored(manifest: VersionManifest) -> bool:
+    return all(object_path(digest).exists() for digest in set(manifest["files"].values()))
+
+
+@span("cache restore")
+def restore_version(manifest: VersionManifest) -> EnsurePath:
+    """Rebuild a version's folder from the store objects."""
+    folder = get_version_folder(manifest["name"], manifest["version"])
+    partial_folder = folder.with_name(f"{folder.name}.partial")
+    if partial_folder.exists():
+        shutil.rmtree(partial_folder)
+    for relative_path, digest in manifest["files"].items():
+        destination = partial_folder / relative_path
+        destination.parent.mkdir(parents=True, exist_ok=True)
+        _link_or_copy(object_path(digest), destination)
+    partial_folder.ensure()
+    os.replace(partial_folder, folder)
+    return folder
+
+
+def touch_version(manifest: VersionManifest) -> None:
+    manifest["last_used"] = time.time()
+    write_version_manifest(manifest)
+
+
+def _object_sizes() -> dict[str, int]:
+    sizes: dict[str, int] = {}
+    if not OBJECTS_DIR.exists():
+        return sizes
+    for object_file in OBJECTS_DIR.glob("*/*"):
+        sizes[object_file.name] = object_file.stat().st_size
+    return sizes
+
+
+def get_cache_stats() -> CacheStats:
+    sizes = _object_sizes()
+    versions = list_version_manifests()
+    return {
+        "versions": versions,
+        "objects": len(sizes),
+        "store_size": sum(sizes.values()),
+        "logical_size": sum(version["size"] for version in versions),
+    }
+
+
+def evict_version(manifest: VersionManifest) -> None:
+    name = manifest["name"]
+    version = manifest["version"]
+    folder = get_version_folder(name, version)
+    if folder.exists():
+        shutil.rmtree(folder)
+    (CACHE_DIR / name / f"{version}.zip").unlink(missing_ok=True)
+    # The generate-asar workspace built from it
+    shutil.rmtree(CACHE_DIR / name / f"{version}.workspace", ignore_errors=True)
+    (CACHE_DIR / name / f"{version}.workspace.json").unlink(missing_ok=True)
+    get_version_manifest_path(name, version).unlink(missing_ok=True)
+
+
+def find_edited_objects(manifest: VersionManifest, directory: Path, relative_paths: Iterable[str]) -> list[str]:
+    """
+    The given files of `directory` that are hardlinks to store objects, and no longer match their hash: they were edited
+    in place, and so was every version sharing them.
+    """
+    edited: list[str] = []
+    for relative_path in relative_paths:
+        digest = manifest["files"].get(relative_path)
+        if digest is None:
+            continue
+        file_path = directory / relative_path
+        try:
+            if os.path.samefile(file_path, object_path(digest)) and hash_file(file_path) != digest:
+                edited.append(relative_path)
+        except OSError:
+            continue
+    return edited
+
+
+def evict_objects(digests: set[str]) -> list[VersionManifest]:
+    """Evict every version using one of the objects, and remove them. Returns the evicted versions."""
+    evicted: list[VersionManifest] = []
+    for manifest in list_version_manifests():
+        if not digests.isdisjoint(manifest["files"].values()):
+            evict_version(manifest)
+            evicted.append(manifest)
+    for digest in digests:
+        object_path(digest).unlink(missing_ok=True)
+    return evicted
+
+
+@span("cache gc")
+def collect_garbage(
+    size_limit: Optional[int] = None, keep: Optional[set[tuple[str, str]]] = None
+) -> GarbageCollection:
+    """
+    Evict the least recently used versions until the store fits in `size_limit` (never evicting the `keep` ones), then
+    remove the objects that no version references anymore.
+    """
+    keep = keep or set()
+    sizes = _object_sizes()
+    versions = sorted(list_version_manifests(), key=lambda manifest: manifest["last_used"])
+    references: dict[str, int] = {}
+    for manifest in versions:
+        for digest in set(manifest["files"].values()):
+            references[digest] = references.get(digest, 0) + 1
+
+    # Objects only referenced by evicted versions can be removed
+    evicted: list[VersionManifest] = []
+    store_size = sum(size for digest, size in sizes.items() if digest in references)
+    for manifest in versions:
+        if size_limit is None or store_size <= size_limit:
+            break
+        if (manifest["name"], manifest["version"]) in keep:
+            continue
+        evict_version(manifest)
+        evicted.append(manifest)
+        for digest in set(manifest["files"].values()):
+            references[digest] -= 1
+            if references[digest] == 0:
+                store_size -= sizes.get(digest, 0)
+
+    removed_objects = 0
+    freed = 0
+    for digest, size in sizes.items():
+        if references.get(digest, 0) > 0:
+            continue
+        object_path(digest).unlink(missing_ok=True)
+        removed_objects += 1
+        freed += size
+
+    # Leftovers of interrupted extractions and writes, once they are too old to be in use by another run. Interrupted
+    # archive downloads (and their ranges) are left to download_archive, which resumes them.
+    now = time.time()
+    for partial in CACHE_DIR.glob("*/*.partial"):
+        if ".zip." in partial.name:
+            continue
+        try:
+            if now - partial.stat().st_mtime < STALE_PARTIAL_AGE:
+                continue
+        except FileNotFoundError:
+            continue
+        if partial.is_dir():
+            shutil.rmtree(partial, ignore_errors=True)
+        else:
+            partial.unlink(missing_ok=True)
+
+    return {"evicted": evicted, "removed_objects": removed_objects, "freed": freed}
@@ -0,0 +1,80 @@
+import codecs
+import hashlib
+import os
+import threading
+from pathlib import Path
+from typing import TypedDict
+
+"""
+Commands need to know several things about the same files: whether they are text or binary (binary files are copied
+whole instead of patched), their size and their hash. Everything is found in a single read of the file, and kept for
+the rest of the run as long as the file's size and modification time don't change.
+
+A file is text if it decodes as UTF-8, which is how `read_lines` reads it.
+"""
+
+READ_SIZE = 1024 * 1024
+
+
+class FileInfo(TypedDict):
+    binary: bool
+    size: int
+    mtime_ns: int
+    # SHA-256 of the contents
+    hash: str
+
+
+_cache: dict[tuple[str, int, int], FileInfo] = {}
+_cache_lock = threading.Lock()
+
+
+def _read_file_info(path: Path, stat: os.stat_result) -> FileInfo:
+    digest = hashlib.sha256()
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    binary = False
+    with open(path, "rb") as file:
+        while chunk := file.read(READ_SIZE):
+            digest.update(chunk)
+            if not binary:
+                try:
+                    decoder.decode(chunk)
+                except UnicodeDecodeError:
+                    binary = True
+    if not binary:
+        try:
+            # Fails if the file ends in the middle of a character
+            decoder.decode(b"", final=True)
+        except UnicodeDecodeError:
+            binary = True
+    return {"binary": binary, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "hash": digest.hexdigest()}
+
+
+def classify_file(path: Path) -> FileInfo:
+    """Text / binary status, size and hash of a file, only reading it the first time it is asked for."""
+    stat = os.stat(path)
+    key = (os.path.abspath(path), stat.st_size, stat.st_mtime_ns)
+    with _cache_lock:
+        info = _cache.get(key)
+    if info is None:
+        info = _read_file_info(path, stat)
+        with _cache_lock:
+            _cache[key] = info
+    return info
+
+
+def is_binary_file(path: Path) -> bool:
+    return classify_file(path)["binary"]
+
+
+def is_content_equal(file1: Path, file2: Path) -> bool:
+    """
+    Whether both files have the same contents. Like `filecmp.cmp`, files with the same size and modification time are
+    taken as equal without reading them.
+    """
+    stat1 = os.stat(file1)
+    stat2 = os.stat(file2)
+    if stat1.st_size != stat2.st_size:
+        return False
+    if stat1.st_mtime_ns == stat2.st_mtime_ns:
+        return True
+    return classify_file(file1)["hash"] == classify_file(file2)["hash"]
@@ -1,11 +1,13 @@
+import os
+import re
 from pathlib import Path
 from typing import Optional, TypedDict
 
-from yaml import safe_load
-
 from cli.utils import EnsurePath
 
 CONFIG_FILE = Path(__file__).parent.parent / "build_config.yml"
+# `version:` line of a project, keeping its indentation and line ending
+VERSION_LINE = re.compile(r"^(\s+version:\s*).*?(\s*)$", re.DOTALL)
 
 
 class RawProjectConfig(TypedDict):
@@ -27,11 +29,37 @@ class ProjectConfig(TypedDict):
     link_files: list[tuple[EnsurePath, str, Optional[EnsurePath]]]
 
 
-def get_project_config(project_key: str) -> ProjectConfig:
-    if not CONFIG_FILE.exists():
-        raise FileNotFoundError("No config file found.")
+# Parsed config file, along with the path, modification time and size it was parsed from
+_config_cache: Optional[tuple[tuple[Path, int, int], dict[str, RawProjectConfig]]] = None
+
+
+def read_config_file() -> dict[str, RawProjectConfig]:
+    """Parse the config file, or reuse the last parse if the file did not change since."""
+    global _config_cache
+    try:
+        stat = os.stat(CONFIG_FILE)
+    except FileNotFoundError as e:
+        raise FileNotFoundError("No config file found.") from e
+    key = (CONFIG_FILE, stat.st_mtime_ns, stat.st_size)
+    if _config_cache is not None and _config_cache[0] == key:
+        return _config_cache[1]
+
+    # Only imported when the config is first read, as it is slow to import
+    from yaml import safe_load
+
     with open(CONFIG_FILE, "r") as config_file:
         data: dict[str, RawProjectConfig] = safe_load(config_file)
+    _config_cache = (key, data)
+    return data
+
+
+def get_project_names() -> list[str]:
+    """Every project of the config file, in the order they are defined."""
+    return list(read_config_file())
+
+
+def get_project_config(project_key: str) -> ProjectConfig:
+    data = read_config_file()
     project = data.get(project_key)
     if project is None:
         raise ValueError(f"Project {project_key} not found.")
@@ -55,3 +83,29 @@ def get_project_config(project_key: str) -> ProjectConfig:
         "patches_dir": EnsurePath(project["patches_dir"]),
         "link_files": link_files,
     }
+
+
+def set_project_version(project_key: str, version: str) -> None:
+    """Change the version of a project in the config file, leaving the rest of the file (and its comments) untouched."""
+    global _config_cache
+    with open(CONFIG_FILE, "r") as config_file:
+        lines = config_file.readlines()
+
+    in_project = False
+    for index, line in enumerate(lines):
+        if line.strip() == "" or line.lstrip().startswith("#"):
+            continue
+        if not line[0].isspace():
+            in_project = line.split(":", 1)[0].strip() == project_key
+            continue
+        match = VERSION_LINE.match(line)
+        if in_project and match is not None:
+            lines[index] = f"{match.group(1)}{version}{match.group(2)}"
+            break
+    else:
+        raise ValueError(f"Version of project {project_key} not found.")
+
+    with open(CONFIG_FILE, "w") as config_file:
+        config_file.writelines(lines)
+    # Rewritten within the same tick, the file could keep its modification time
+    _config_cache = None
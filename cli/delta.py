@@ -0,0 +1,136 @@
+import hashlib
+import struct
+import zlib
+
+"""
+Binary deltas, for binary files that only change a little from their upstream version.
+
+A delta is a list of instructions that rebuild the target file from the source one: copy a range of the source, or add
+new bytes. Matches are found by indexing the source in fixed-size blocks and looking every position of the target up
+in that index, extending the matches forwards and backwards from there.
+
+File layout:
+- `MAGIC`.
+- SHA-256 of the source and of the target (32 bytes each), so that a delta is never applied over the wrong file.
+- Size of the target (unsigned 64 bits, little endian).
+- The zlib-compressed instructions: `COPY` + offset + length, or `ADD` + length + bytes, with varint numbers.
+"""
+
+MAGIC = b"MIMDELTA\x00\x01"
+HEADER = struct.Struct(f"<{len(MAGIC)}s32s32sQ")
+BLOCK_SIZE = 32
+COPY = 1
+ADD = 2
+
+
+class DeltaError(Exception):
+    """The delta is malformed, or does not belong to the given source."""
+
+
+def _write_varint(out: bytearray, value: int) -> None:
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data: bytes, position: int) -> tuple[int, int]:
+    value = 0
+    shift = 0
+    while True:
+        if position >= len(data):
+            raise DeltaError("Truncated delta.")
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+
+def is_delta(data: bytes) -> bool:
+    return data.startswith(MAGIC)
+
+
+def make_delta(source: bytes, target: bytes) -> bytes:
+    index: dict[bytes, int] = {}
+    for offset in range(0, len(source) - BLOCK_SIZE + 1, BLOCK_SIZE):
+        index.setdefault(source[offset : offset + BLOCK_SIZE], offset)
+
+    instructions = bytearray()
+    pending_start = 0
+
+    def flush(end: int) -> None:
+        if end > pending_start:
+            instructions.append(ADD)
+            _write_varint(instructions, end - pending_start)
+            instructions.extend(target[pending_start:end])
+
+    position = 0
+    while position + BLOCK_SIZE <= len(target):
+        source_offset = index.get(target[position : position + BLOCK_SIZE])
+        if source_offset is None:
+            position += 1
+            continue
+        # Extend the match backwards over the bytes not emitted yet, then forwards
+        start = position
+        while start > pending_start and source_offset > 0 and target[start - 1] == source[source_offset - 1]:
+            start -= 1
+            source_offset -= 1
+        end = position + BLOCK_SIZE
+        source_end = source_offset + (end - start)
+        while end < len(target) and source_end < len(source):
+            # Compare whole slices first, as long matches are the common case
+            step = min(4096, len(target) - end, len(source) - source_end)
+            if target[end : end + step] == source[source_end : source_end + step]:
+                end += step
+                source_end += step
+                continue
+            while target[end] == source[source_end]:
+                end += 1
+                source_end += 1
+            break
+
+        flush(start)
+        instructions.append(COPY)
+        _write_varint(instructions, source_offset)
+        _write_varint(instructions, end - start)
+        pending_start = position = end
+    flush(len(target))
+
+    header = HEADER.pack(MAGIC, hashlib.sha256(source).digest(), hashlib.sha256(target).digest(), len(target))
+    return header + zlib.compress(bytes(instructions), 9)
+
+
+def apply_delta(source: bytes, delta: bytes) -> bytes:
+    if len(delta) < HEADER.size or not is_delta(delta):
+        raise DeltaError("Not a binary delta.")
+    _, source_hash, target_hash, target_size = HEADER.unpack_from(delta)
+    if hashlib.sha256(source).digest() != source_hash:
+        raise DeltaError("The delta was made against a different version of the file.")
+    try:
+        instructions = zlib.decompress(delta[HEADER.size :])
+    except zlib.error as e:
+        raise DeltaError(f"Corrupted delta: {e}") from e
+
+    target = bytearray()
+    position = 0
+    while position < len(instructions):
+        operation = instructions[position]
+        position += 1
+        if operation == COPY:
+            offset, position = _read_varint(instructions, position)
+            length, position = _read_varint(instructions, position)
+            if offset + length > len(source):
+                raise DeltaError("Delta copies past the end of the source.")
+            target += source[offset : offset + length]
+        elif operation == ADD:
+            length, position = _read_varint(instructions, position)
+            target += instructions[position : position + length]
+            position += length
+        else:
+            raise DeltaError(f"Unknown delta instruction {operation}.")
+
+    if len(target) != target_size or hashlib.sha256(target).digest() != target_hash:
+        raise DeltaError("The rebuilt file does not match the delta's checksum.")
+    return bytes(target)
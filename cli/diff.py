@@ -0,0 +1,276 @@
+import difflib
+from typing import Iterator, Literal, Optional, Sequence
+
+DiffAlgorithm = Literal["patience", "myers", "difflib"]
+
+# (tag, i1, i2, j1, j2), as given by difflib's SequenceMatcher.get_opcodes
+Opcode = tuple[str, int, int, int, int]
+# (a_start, b_start, size)
+Block = tuple[int, int, int]
+
+"""
+Line diff engines for patch generation.
+
+Lines are interned to integers first so that every comparison is an integer comparison. On top of that:
+- `myers` runs Myers' O((N + M)D) algorithm in linear space, after trimming the common prefix / suffix.
+- `patience` first anchors the diff on lines that are unique to both sides, falling back to Myers between anchors.
+  This keeps large, heavily edited files such as lockfiles and translations close to linear time.
+- `difflib` is the standard library's SequenceMatcher, which is what patches were originally generated with.
+
+All the engines output unified diffs formatted exactly like `difflib.unified_diff`.
+"""
+
+
+def intern_lines(a: Sequence[str], b: Sequence[str]) -> tuple[list[int], list[int]]:
+    ids: dict[str, int] = {}
+    return [ids.setdefault(line, len(ids)) for line in a], [ids.setdefault(line, len(ids)) for line in b]
+
+
+def _middle_snake(
+    a: list[int], b: list[int], left: int, top: int, right: int, bottom: int
+) -> Optional[tuple[int, int, int, int]]:
+    """Find the middle snake of the box as (x1, y1, x2, y2), walking forwards and backwards at the same time."""
+    width = right - left
+    height = bottom - top
+    size = width + height
+    if size == 0:
+        return None
+    delta = width - height
+    max_d = (size + 1) // 2
+    # Negative diagonals wrap around the end of the lists
+    forward = [0] * (2 * max_d + 3)
+    backward = [0] * (2 * max_d + 3)
+    forward[1] = left
+    backward[1] = bottom
+
+    for d in range(max_d + 1):
+        for k in range(d, -d - 1, -2):
+            c = k - delta
+            if k == -d or (k != d and forward[k - 1] < forward[k + 1]):
+                px = x = forward[k + 1]
+            else:
+                px = forward[k - 1]
+                x = px + 1
+            y = top + (x - left) - k
+            py = y if d == 0 or x != px else y - 1
+            while x < right and y < bottom and a[x] == b[y]:
+                x += 1
+                y += 1
+            forward[k] = x
+            if delta & 1 and -(d - 1) <= c <= d - 1 and y >= backward[c]:
+                return px, py, x, y
+
+        for c in range(d, -d - 1, -2):
+            k = c + delta
+            if c == -d or (c != d and backward[c - 1] > backward[c + 1]):
+                py = y = backward[c + 1]
+            else:
+                py = backward[c - 1]
+                y = py - 1
+            x = left + (y - top) + k
+            px = x if d == 0 or y != py else x + 1
+            while x > left and y > top and a[x - 1] == b[y - 1]:
+                x -= 1
+                y -= 1
+            backward[c] = y
+            if not delta & 1 and -d <= k <= d and x <= forward[k]:
+                return x, y, px, py
+    return None
+
+
+def _myers_blocks(a: list[int], b: list[int], a_lo: int, a_hi: int, b_lo: int, b_hi: int) -> list[Block]:
+    """Matching blocks between `a[a_lo:a_hi]` and `b[b_lo:b_hi]`, in no particular order."""
+    blocks: list[Block] = []
+    boxes = [(a_lo, b_lo, a_hi, b_hi)]
+    while boxes:
+        left, top, right, bottom = boxes.pop()
+        # Common prefix / suffix are matched directly, which keeps the boxes small
+        start = left
+        while left < right and top < bottom and a[left] == b[top]:
+            left += 1
+            top += 1
+        if left > start:
+            blocks.append((start, top - (left - start), left - start))
+        end = right
+        while right > left and bottom > top and a[right - 1] == b[bottom - 1]:
+            right -= 1
+            bottom -= 1
+        if end > right:
+            blocks.append((right, bottom, end - right))
+
+        if left == right or top == bottom:
+            continue
+        snake = _middle_snake(a, b, left, top, right, bottom)
+        if snake is None:
+            continue
+        x1, y1, x2, y2 = snake
+        if (x1, y1) == (left, top) and (x2, y2) == (right, bottom):
+            # A single edit plus a diagonal: no smaller box to split into
+            diagonal = min(x2 - x1, y2 - y1)
+            if diagonal:
+                blocks.append((x2 - diagonal, y2 - diagonal, diagonal))
+            continue
+        boxes.append((left, top, x1, y1))
+        boxes.append((x1, y1, x2, y2))
+        boxes.append((x2, y2, right, bottom))
+    return blocks
+
+
+def _unique_anchors(a: list[int], b: list[int], a_lo: int, a_hi: int, b_lo: int, b_hi: int) -> list[tuple[int, int]]:
+    """Longest increasing sequence of lines that appear exactly once on each side, as (a_index, b_index) pairs."""
+    counts: dict[int, list[int]] = {}
+    for i in range(a_lo, a_hi):
+        entry = counts.get(a[i])
+        if entry is None:
+            counts[a[i]] = [1, i, 0, -1]
+        else:
+            entry[0] += 1
+    for j in range(b_lo, b_hi):
+        entry = counts.get(b[j])
+        if entry is not None:
+            entry[2] += 1
+            entry[3] = j
+    pairs = sorted((i, j) for count_a, i, count_b, j in counts.values() if count_a == 1 and count_b == 1)
+    if not pairs:
+        return []
+
+    # Patience sorting over the b indexes, keeping back-references to rebuild the sequence
+    tails: list[int] = []
+    tail_pairs: list[int] = []
+    previous: list[int] = [-1] * len(pairs)
+    for index, (_, j) in enumerate(pairs):
+        low, high = 0, len(tails)
+        while low < high:
+            middle = (low + high) // 2
+            if tails[middle] < j:
+                low = middle + 1
+            else:
+                high = middle
+        if low > 0:
+            previous[index] = tail_pairs[low - 1]
+        if low == len(tails):
+            tails.append(j)
+            tail_pairs.append(index)
+        else:
+            tails[low] = j
+            tail_pairs[low] = index
+
+    anchors: list[tuple[int, int]] = []
+    index = tail_pairs[-1]
+    while index != -1:
+        anchors.append(pairs[index])
+        index = previous[index]
+    anchors.reverse()
+    return anchors
+
+
+def _patience_blocks(a: list[int], b: list[int]) -> list[Block]:
+    blocks: list[Block] = []
+    regions = [(0, len(a), 0, len(b))]
+    while regions:
+        a_lo, a_hi, b_lo, b_hi = regions.pop()
+        if a_lo == a_hi or b_lo == b_hi:
+            continue
+        anchors = _unique_anchors(a, b, a_lo, a_hi, b_lo, b_hi)
+        if not anchors:
+            blocks.extend(_myers_blocks(a, b, a_lo, a_hi, b_lo, b_hi))
+            continue
+        i, j = a_lo, b_lo
+        for anchor_i, anchor_j in anchors:
+            regions.append((i, anchor_i, j, anchor_j))
+            blocks.append((anchor_i, anchor_j, 1))
+            i, j = anchor_i + 1, anchor_j + 1
+        regions.append((i, a_hi, j, b_hi))
+    return blocks
+
+
+def _merge_blocks(blocks: list[Block]) -> list[Block]:
+    merged: list[Block] = []
+    for block in sorted(blocks):
+        if merged and merged[-1][0] + merged[-1][2] == block[0] and merged[-1][1] + merged[-1][2] == block[1]:
+            merged[-1] = (merged[-1][0], merged[-1][1], merged[-1][2] + block[2])
+        else:
+            merged.append(block)
+    return merged
+
+
+def matching_blocks(a: Sequence[str], b: Sequence[str], algorithm: DiffAlgorithm = "patience") -> list[Block]:
+    """Sorted, non-adjacent matching blocks between both sequences, without difflib's trailing sentinel."""
+    if algorithm == "difflib":
+        matcher = difflib.SequenceMatcher(None, a, b)
+        return [(block.a, block.b, block.size) for block in matcher.get_matching_blocks()[:-1]]
+    a_ids, b_ids = intern_lines(a, b)
+    if algorithm == "myers":
+        return _merge_blocks(_myers_blocks(a_ids, b_ids, 0, len(a_ids), 0, len(b_ids)))
+    return _merge_blocks(_patience_blocks(a_ids, b_ids))
+
+
+def get_opcodes(blocks: list[Block], a_length: int, b_length: int) -> list[Opcode]:
+    """Turn matching blocks into opcodes, the same way difflib's SequenceMatcher does."""
+    opcodes: list[Opcode] = []
+    i = j = 0
+    for ai, bj, size in [*blocks, (a_length, b_length, 0)]:
+        if i < ai and j < bj:
+            opcodes.append(("replace", i, ai, j, bj))
+        elif i < ai:
+            opcodes.append(("delete", i, ai, j, bj))
+        elif j < bj:
+            opcodes.append(("insert", i, ai, j, bj))
+        i, j = ai + size, bj + size
+        if size:
+            opcodes.append(("equal", ai, i, bj, j))
+    return opcodes
+
+
+def group_opcodes(opcodes: list[Opcode], n: int = 3) -> Iterator[list[Opcode]]:
+    """Group opcodes into hunks with up to `n` lines of context, like SequenceMatcher.get_grouped_opcodes."""
+    codes = list(opcodes) or [("equal", 0, 1, 0, 1)]
+    if codes[0][0] == "equal":
+        tag, i1, i2, j1, j2 = codes[0]
+        codes[0] = tag, max(i1, i2 - n), i2, max(j1, j2 - n), j2
+    if codes[-1][0] == "equal":
+        tag, i1, i2, j1, j2 = codes[-1]
+        codes[-1] = tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)
+
+    group: list[Opcode] = []
+    for tag, i1, i2, j1, j2 in codes:
+        if tag == "equal" and i2 - i1 > n * 2:
+            group.append((tag, i1, min(i2, i1 + n), j1, min(j2, j1 + n)))
+            yield group
+            group = []
+            i1, j1 = max(i1, i2 - n), max(j1, j2 - n)
+        group.append((tag, i1, i2, j1, j2))
+    if group and not (len(group) == 1 and group[0][0] == "equal"):
+        yield group
+
+
+def _format_range(start: int, stop: int) -> str:
+    beginning = start + 1
+    length = stop - start
+    if length == 1:
+        return str(beginning)
+    if not length:
+        beginning -= 1
+    return f"{beginning},{length}"
+
+
+def unified_diff(a: Sequence[str], b: Sequence[str], algorithm: DiffAlgorithm = "patience", n: int = 3) -> list[str]:
+    """Unified diff between both sequences of lines, formatted like `difflib.unified_diff(a, b, n=n)`."""
+    if algorithm == "difflib":
+        return list(difflib.unified_diff(a, b, n=n))
+
+    diff: list[str] = []
+    for group in group_opcodes(get_opcodes(matching_blocks(a, b, algorithm), len(a), len(b)), n):
+        if not diff:
+            diff += ["--- \n", "+++ \n"]
+        first, last = group[0], group[-1]
+        diff.append(f"@@ -{_format_range(first[1], last[2])} +{_format_range(first[3], last[4])} @@\n")
+        for tag, i1, i2, j1, j2 in group:
+            if tag == "equal":
+                diff.extend(" " + line for line in a[i1:i2])
+                continue
+            if tag in ("replace", "delete"):
+                diff.extend("-" + line for line in a[i1:i2])
+            if tag in ("replace", "insert"):
+                diff.extend("+" + line for line in b[j1:j2])
+    return diff
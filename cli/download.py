@@ -0,0 +1,231 @@
+import glob
+import re
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import TYPE_CHECKING, Iterator, Optional
+
+from cli.manifest import hash_file
+
+if TYPE_CHECKING:
+    import requests
+
+"""
+Release archives are downloaded through a single pooled session, so that connections are reused between the tags API,
+the redirect to the archive host and the archive itself.
+
+Downloads are written to a `.partial` file and only moved into place once complete and verified. When the connection
+drops, the download picks up where it left off with a Range request, both within a run and across runs (the partial
+file is resumed). The file's ETag is saved next to it and sent as `If-Range`, so that a file that changed on the
+server in the meantime is downloaded again from the start instead of being appended to the old bytes. Servers that
+advertise range support and the archive's size can also be downloaded in several ranges at once.
+"""
+
+CHUNK_SIZE = 1024 * 1024
+POOL_SIZE = 16
+TIMEOUT = 30
+# Consecutive reconnections without receiving anything before giving up
+RESUME_ATTEMPTS = 5
+# Ranges smaller than this are not worth their own connection
+MIN_PART_SIZE = 4 * 1024 * 1024
+CONTENT_RANGE_SIZE = re.compile(r"/(\d+)$")
+
+
+class DownloadError(Exception):
+    """The download could not be completed, or does not match its checksum."""
+
+
+class ChecksumError(DownloadError):
+    """The downloaded file does not match its checksum."""
+
+
+class RemoteChangedError(DownloadError):
+    """The file changed on the server since its download started, so what was downloaded so far can't be resumed."""
+
+
+_session: Optional["requests.Session"] = None
+_session_lock = threading.Lock()
+
+
+def get_session() -> "requests.Session":
+    global _session
+    with _session_lock:
+        if _session is None:
+            # Only imported once something is downloaded, as requests is slow to import
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            from urllib3.util.retry import Retry
+
+            retry = Retry(
+                total=3,
+                backoff_factor=0.5,
+                status_forcelist=(429, 500, 502, 503, 504),
+                allowed_methods=("GET", "HEAD"),
+            )
+            adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=retry)
+            _session = requests.Session()
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+        return _session
+
+
+def get_etag_path(path: Path) -> Path:
+    return path.with_name(f"{path.name}.etag")
+
+
+def get_part_paths(path: Path) -> list[Path]:
+    return sorted(path.parent.glob(f"{glob.escape(path.name.removesuffix('.partial'))}.*-*.partial"))
+
+
+def discard_partial(path: Path) -> None:
+    """Delete a partial download, with its ETag and the ranges downloaded for it."""
+    for partial_path in [path, get_etag_path(path), *get_part_paths(path)]:
+        partial_path.unlink(missing_ok=True)
+
+
+def _read_etag(etag_path: Optional[Path]) -> Optional[str]:
+    if etag_path is None:
+        return None
+    try:
+        return etag_path.read_text() or None
+    except FileNotFoundError:
+        return None
+
+
+def iter_download(
+    url: str, offset: int = 0, end: Optional[int] = None, etag_path: Optional[Path] = None
+) -> Iterator[bytes]:
+    """
+    Yield the body of `url` from `offset` up to `end` (inclusive, or the end of the file). If the connection drops,
+    the download is resumed from the last byte received. Resumed requests are sent with the file's ETag (read from
+    and saved to `etag_path`) as `If-Range`, and `RemoteChangedError` is raised if the file changed meanwhile.
+    """
+    import requests
+
+    session = get_session()
+    attempts = 0
+    # Only a strong ETag can tell that the bytes we have are still those of the file
+    etag = _read_etag(etag_path) if offset else None
+    while end is None or offset <= end:
+        headers = {}
+        if offset or end is not None:
+            headers["Range"] = f"bytes={offset}-{'' if end is None else end}"
+            if etag is not None:
+                headers["If-Range"] = etag
+        try:
+            with session.get(url, headers=headers, stream=True, timeout=TIMEOUT) as response:
+                if response.status_code == 416:
+                    # Nothing left past the offset: the file was already complete
+                    size = CONTENT_RANGE_SIZE.search(response.headers.get("Content-Range", ""))
+                    if size is not None and int(size.group(1)) == offset:
+                        return
+                response.raise_for_status()
+                response_etag = response.headers.get("ETag")
+                skip = 0
+                if response.status_code == 200 and offset:
+                    if etag is None or response_etag != etag:
+                        # Either the file changed, or nothing proves it did not
+                        raise RemoteChangedError(f"{url} changed since its download started.")
+                    # The server ignored the range of the same file: skip what we already have
+                    skip = offset
+                if etag is None and response_etag and not response_etag.startswith("W/"):
+                    etag = response_etag
+                    if etag_path is not None:
+                        etag_path.write_text(etag)
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    if skip:
+                        dropped = min(skip, len(chunk))
+                        chunk = chunk[dropped:]
+                        skip -= dropped
+                    if end is not None:
+                        chunk = chunk[: end + 1 - offset]
+                    if not chunk:
+                        continue
+                    offset += len(chunk)
+                    attempts = 0
+                    yield chunk
+                    if end is not None and offset > end:
+                        return
+            return
+        except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+            attempts += 1
+            if attempts > RESUME_ATTEMPTS:
+                raise DownloadError(f"Download of {url} failed: {e}") from e
+            time.sleep(attempts)
+
+
+def get_range_size(url: str) -> Optional[int]:
+    """Size of the file at `url` if the server supports downloading it by ranges."""
+    response = get_session().head(url, allow_redirects=True, timeout=TIMEOUT)
+    if not response.ok or response.headers.get("Accept-Ranges") != "bytes":
+        return None
+    length = response.headers.get("Content-Length")
+    return int(length) if length and length.isdigit() else None
+
+
+def _download_parts(url: str, path: Path, size: int, parts: int) -> None:
+    part_size = -(-size // parts)
+    ranges = [(start, min(start + part_size, size) - 1) for start in range(0, size, part_size)]
+    # Each range goes to its own file, so that every one of them can be resumed
+    part_paths = [
+        path.with_name(f"{path.name.removesuffix('.partial')}.{start}-{end}.partial") for start, end in ranges
+    ]
+    etag_path = get_etag_path(path)
+
+    def download_part(index: int) -> None:
+        start, end = ranges[index]
+        part_path = part_paths[index]
+        offset = part_path.stat().st_size if part_path.exists() else 0
+        with open(part_path, "ab") as part_file:
+            for chunk in iter_download(url, start + offset, end, etag_path):
+                part_file.write(chunk)
+
+    with ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+        list(executor.map(download_part, range(len(ranges))))
+
+    with open(path, "wb") as out_file:
+        for part_path in part_paths:
+            with open(part_path, "rb") as part_file:
+                shutil.copyfileobj(part_file, out_file, CHUNK_SIZE)
+    for part_path in part_paths:
+        part_path.unlink()
+
+
+def download_file(url: str, path: Path, parts: int = 1) -> None:
+    """
+    Download `url` into `path`, resuming what is already there. A fresh download is split into up to `parts`
+    parallel ranges when the server allows it. If the file changed on the server since the download started, it is
+    downloaded again from the start.
+    """
+    try:
+        _download_file(url, path, parts)
+    except RemoteChangedError:
+        discard_partial(path)
+        _download_file(url, path, parts)
+
+
+def _download_file(url: str, path: Path, parts: int) -> None:
+    offset = path.stat().st_size if path.exists() else 0
+    if offset == 0 and parts > 1:
+        size = get_range_size(url)
+        if size is not None:
+            parts = min(parts, POOL_SIZE, max(1, size // MIN_PART_SIZE))
+            if parts > 1:
+                _download_parts(url, path, size, parts)
+                return
+
+    with open(path, "ab") as out_file:
+        for chunk in iter_download(url, offset, etag_path=get_etag_path(path)):
+            out_file.write(chunk)
+
+
+def verify_file(path: Path, expected_sha256: Optional[str]) -> str:
+    """Check the file against its expected SHA-256 (if known), returning its actual one. Mismatching files are deleted."""
+    digest = hash_file(path)
+    if expected_sha256 is not None and digest != expected_sha256:
+        path.unlink()
+        raise ChecksumError(f"Checksum mismatch for {path.name}: expected {expected_sha256}, got {digest}.")
+    return digest
@@ -1,11 +1,38 @@
-import requests
+import json
+import os
 import shutil
 import zipfile
+from contextlib import closing
 from pathlib import Path
-from typing import TypedDict
+from typing import Collection, Optional, TypedDict
 
+from cli.archive import ArchiveError, extract_archive, prefetch, stream_extract
+from cli.cache import (
+    cache_options,
+    collect_garbage,
+    get_version_folder,
+    ingest_version,
+    is_version_stored,
+    object_path,
+    read_version_manifest,
+    restore_version,
+    touch_version,
+)
 from cli.config import ProjectConfig
-from cli.utils import CACHE_DIR, error, success, warning
+from cli.download import (
+    TIMEOUT,
+    ChecksumError,
+    DownloadError,
+    RemoteChangedError,
+    discard_partial,
+    download_file,
+    get_etag_path,
+    get_session,
+    iter_download,
+    verify_file,
+)
+from cli.trace import span
+from cli.utils import CACHE_DIR, EnsurePath, error, log, success, warning
 
 
 class CommitData(TypedDict):
@@ -23,52 +50,310 @@ class TagData(TypedDict):
     node_id: str
 
 
+class ResolvedTag(TypedDict):
+    zipball_url: str
+    sha: str
+    # Recorded on the first download, and checked against on the next ones
+    archive_sha256: Optional[str]
+
+
+class TagsPage(TypedDict):
+    etag: Optional[str]
+    next_url: Optional[str]
+    tags: list[TagData]
+
+
+class TagsCache(TypedDict):
+    # Page URL -> last response, to revalidate it with its ETag
+    pages: dict[str, TagsPage]
+    versions: dict[str, ResolvedTag]
+
+
+class DownloadOptions(TypedDict):
+    # Keep the downloaded zipball in cache next to the extracted version
+    keep_archive: bool
+    jobs: int
+    # Parallel ranges to download archives in, when the server supports it
+    chunks: int
+    # Never use the network, only what is already in cache
+    offline: bool
+
+
+download_options: DownloadOptions = {
+    "keep_archive": False,
+    "jobs": os.cpu_count() or 1,
+    "chunks": 1,
+    "offline": False,
+}
+
+
+def get_tags_cache_path(project_data: ProjectConfig) -> EnsurePath:
+    return CACHE_DIR / project_data["name"] / "tags.json"
+
+
+def read_tags_cache(project_data: ProjectConfig) -> TagsCache:
+    try:
+        with open(get_tags_cache_path(project_data), "r") as cache_file:
+            tags_cache: TagsCache = json.load(cache_file)
+    except (OSError, ValueError):
+        return {"pages": {}, "versions": {}}
+    return tags_cache
+
+
+def write_tags_cache(project_data: ProjectConfig, tags_cache: TagsCache) -> None:
+    cache_path = get_tags_cache_path(project_data)
+    cache_path.parent.ensure()
+    temporary_path = cache_path.with_suffix(".tmp")
+    with open(temporary_path, "w") as cache_file:
+        json.dump(tags_cache, cache_file)
+    os.replace(temporary_path, cache_path)
+
+
+def fetch_tags_page(url: str, cached_page: Optional[TagsPage]) -> TagsPage:
+    """Fetch a page of tags, reusing the cached one if the server says it didn't change."""
+    headers = {"Accept": "application/vnd.github+json"}
+    if cached_page is not None and cached_page["etag"]:
+        headers["If-None-Match"] = cached_page["etag"]
+    tags_res = get_session().get(url, headers=headers, timeout=TIMEOUT)
+    if tags_res.status_code == 304 and cached_page is not None:
+        return cached_page
+    tags_res.raise_for_status()
+    return {
+        "etag": tags_res.headers.get("ETag"),
+        "next_url": tags_res.links.get("next", {}).get("url"),
+        "tags": tags_res.json(),
+    }
+
+
+@span("tags")
+def resolve_version(project_data: ProjectConfig) -> ResolvedTag:
+    """
+    Find the download link for the configured version. Versions already resolved are answered from cache; otherwise the
+    tag pages are walked (revalidating the cached ones) until the version shows up.
+    """
+    name = project_data["name"]
+    version = project_data["version"]
+    tags_cache = read_tags_cache(project_data)
+    if version in tags_cache["versions"]:
+        return tags_cache["versions"][version]
+    if download_options["offline"]:
+        error(f"Version '{version}' of {name} is not in cache, and we are offline.")
+        raise ValueError(f"Version {version} not found in the cache.")
+
+    url: Optional[str] = project_data["tags_url"]
+    if "per_page=" not in project_data["tags_url"]:
+        separator = "&" if "?" in project_data["tags_url"] else "?"
+        url = f"{project_data['tags_url']}{separator}per_page=100"
+    visited: set[str] = set()
+    while url is not None and url not in visited and version not in tags_cache["versions"]:
+        visited.add(url)
+        page = fetch_tags_page(url, tags_cache["pages"].get(url))
+        tags_cache["pages"][url] = page
+        for tag in page["tags"]:
+            resolved = tags_cache["versions"].get(tag["name"])
+            # Keep the recorded checksum, unless the tag was moved to another commit
+            checksum = resolved.get("archive_sha256") if resolved and resolved["sha"] == tag["commit"]["sha"] else None
+            tags_cache["versions"][tag["name"]] = {
+                "zipball_url": tag["zipball_url"],
+                "sha": tag["commit"]["sha"],
+                "archive_sha256": checksum,
+            }
+        url = page["next_url"]
+    write_tags_cache(project_data, tags_cache)
+
+    if version not in tags_cache["versions"]:
+        error(f"Version '{version}' not found in the {name} repository!")
+        raise ValueError(f"Version {version} not found in the repository.")
+    return tags_cache["versions"][version]
+
+
+def get_archive_checksum(project_data: ProjectConfig) -> Optional[str]:
+    resolved = read_tags_cache(project_data)["versions"].get(project_data["version"])
+    return resolved.get("archive_sha256") if resolved else None
+
+
+def record_archive_checksum(project_data: ProjectConfig, checksum: str) -> None:
+    tags_cache = read_tags_cache(project_data)
+    resolved = tags_cache["versions"].get(project_data["version"])
+    if resolved is None or resolved.get("archive_sha256") == checksum:
+        return
+    resolved["archive_sha256"] = checksum
+    write_tags_cache(project_data, tags_cache)
+
+
+def verify_archive_commit(zip_path: Path, commit: str) -> None:
+    """Check that a zipball was made from `commit`, which Github writes as the archive's comment."""
+    with zipfile.ZipFile(zip_path) as zip_file:
+        comment = zip_file.comment.decode("ascii", errors="replace")
+    if comment != commit:
+        zip_path.unlink()
+        raise ChecksumError(f"{zip_path.name} was made from commit '{comment}' instead of {commit}.")
+
+
+def _download_then_extract(url: str, destination: Path, partial_zip_path: Path, checksum: Optional[str]) -> str:
+    download_file(url, partial_zip_path, download_options["chunks"])
+    actual_checksum = verify_file(partial_zip_path, checksum)
+    extract_archive(partial_zip_path, destination, download_options["jobs"])
+    return actual_checksum
+
+
+def _download_while_extracting(url: str, destination: Path, partial_zip_path: Path, checksum: Optional[str]) -> str:
+    chunks_iterator = iter_download(url, etag_path=get_etag_path(partial_zip_path))
+    with open(partial_zip_path, "wb") as out_file, closing(prefetch(chunks_iterator, out_file)) as chunks:
+        try:
+            stream_extract(chunks, destination)
+            extracted = True
+        except (ArchiveError, RemoteChangedError) as e:
+            warning(f"Could not extract the archive while downloading ({e}). Extracting it afterwards instead.")
+            extracted = False
+    if not extracted:
+        # Finish the download from where the extraction stopped reading it
+        shutil.rmtree(destination, ignore_errors=True)
+        destination.mkdir(parents=True)
+        download_file(url, partial_zip_path)
+    actual_checksum = verify_file(partial_zip_path, checksum)
+    if not extracted:
+        extract_archive(partial_zip_path, destination, download_options["jobs"])
+    return actual_checksum
+
+
+@span("download")
+def download_archive(
+    url: str, destination: Path, zip_path: EnsurePath, checksum: Optional[str], commit: Optional[str] = None
+) -> str:
+    """
+    Download a zipball while extracting it, returning its SHA-256. The archive is only kept (and moved into place
+    atomically) if asked to, and once it matches its `checksum` and was made from `commit` (when given). A previous
+    download that can't be completed into a valid archive is started over once.
+    """
+    # The archive is always written, so that an interrupted download can be resumed
+    partial_zip_path = zip_path.with_suffix(".zip.partial")
+    zip_path.parent.ensure()
+    # Resumed or split downloads can't be extracted as they come
+    download = _download_then_extract if download_options["chunks"] > 1 else _download_while_extracting
+
+    if partial_zip_path.exists():
+        log("Resuming the previous download...")
+        try:
+            actual_checksum = _download_then_extract(url, destination, partial_zip_path, checksum)
+        except (ArchiveError, zipfile.BadZipFile) as e:
+            # Such as the end of a newer archive appended to an older one, by a resume that could not be validated
+            warning(f"The resumed download is not a valid archive ({e}). Downloading it again from the start.")
+            discard_partial(partial_zip_path)
+            shutil.rmtree(destination, ignore_errors=True)
+            destination.mkdir(parents=True)
+            actual_checksum = download(url, destination, partial_zip_path, checksum)
+    else:
+        actual_checksum = download(url, destination, partial_zip_path, checksum)
+    if commit is not None:
+        verify_archive_commit(partial_zip_path, commit)
+
+    if download_options["keep_archive"]:
+        os.replace(partial_zip_path, zip_path)
+    else:
+        partial_zip_path.unlink()
+    get_etag_path(partial_zip_path).unlink(missing_ok=True)
+    return actual_checksum
+
+
 def download_and_extract_repo(project_data: ProjectConfig) -> None:
     name = project_data["name"]
     version = project_data["version"]
 
-    # Get the version from the repository tags
-    tags_res = requests.get(project_data["tags_url"])
-    tags_data: list[TagData] = tags_res.json()
+    # Extract into a temporary folder first, so that an interrupted extraction is never taken as cached
+    destination = get_version_folder(name, version)
+    partial_destination = CACHE_DIR / name / f"{version}.partial"
 
     # Check if we need to download it
     zip_path = CACHE_DIR / name / f"{version}.zip"
+    if zip_path.exists():
+        log(f"Extracting {name} version '{version}'...")
+        shutil.rmtree(partial_destination, ignore_errors=True)
+        partial_destination.ensure()
+        try:
+            checksum = verify_file(zip_path, get_archive_checksum(project_data))
+            extract_archive(zip_path, partial_destination, download_options["jobs"])
+            record_archive_checksum(project_data, checksum)
+        except (DownloadError, zipfile.BadZipFile) as e:
+            warning(f"The cached archive is corrupted ({e}).")
+            zip_path.unlink(missing_ok=True)
+
     if not zip_path.exists():
+        if download_options["offline"]:
+            shutil.rmtree(partial_destination, ignore_errors=True)
+            error(f"Version '{version}' of {name} is not in cache, and we are offline.")
+            raise ValueError(f"Version {version} not found in the cache.")
+
+        # Get the version from the repository tags
+        version_data = resolve_version(project_data)
         warning(f"Downloading {name} version '{version}'...")
-        version_data = next((tag for tag in tags_data if tag["name"] == version), None)
-        if not version_data:
-            error(f"Version '{version}' not found in the {name} repository!")
-            raise ValueError(f"Version {version} not found in the repository.")
-
-        # Download it
-        download = requests.get(version_data["zipball_url"], stream=True)
-        if not download.ok:
-            error(f"Download failed with status code {download.status_code}.")
-            download.raise_for_status()
-        zip_path.parent.ensure()
-        with open(zip_path, "+wb") as out_file:
-            shutil.copyfileobj(download.raw, out_file)
-
-    # Extract it
-    destination = CACHE_DIR / name / version
-    destination.ensure()
-    with zipfile.ZipFile(zip_path, "r") as zip_file:
-        files = zip_file.infolist()
-        for file_path in files[1:]:
-            if file_path.is_dir():
-                continue
-            file_path.filename = "/".join(file_path.filename.split("/")[1:])
-            zip_file.extract(file_path, destination)
+        shutil.rmtree(partial_destination, ignore_errors=True)
+        partial_destination.ensure()
+
+        # Download and extract it at the same time
+        try:
+            try:
+                checksum = download_archive(
+                    version_data["zipball_url"], partial_destination, zip_path, version_data.get("archive_sha256")
+                )
+            except ChecksumError as e:
+                # Github generates zipballs on demand, so the same tag can give a different archive later on. A new
+                # archive is only taken if it was made from the tag's commit.
+                warning(f"{e} Downloading it again to check it against the commit of the tag.")
+                shutil.rmtree(partial_destination)
+                partial_destination.ensure()
+                checksum = download_archive(
+                    version_data["zipball_url"], partial_destination, zip_path, None, version_data["sha"]
+                )
+        except DownloadError as e:
+            error(str(e))
+            raise
+        record_archive_checksum(project_data, checksum)
+
+    os.replace(partial_destination, destination)
 
 
 def get_project_folder(project_data: ProjectConfig) -> Path:
     name = project_data["name"]
     version = project_data["version"]
 
-    folder_path = CACHE_DIR / name / version
+    folder_path = get_version_folder(name, version)
+    manifest = read_version_manifest(name, version)
     if folder_path.exists():
         success(f"Version '{version}' for {name} found in cache.")
+        if manifest is None:
+            # Cached before the store existed - deduplicate it
+            manifest = ingest_version(name, version, folder_path)
+    elif manifest is not None and is_version_stored(manifest):
+        restore_version(manifest)
+        success(f"Version '{version}' for {name} restored from cache.")
     else:
         warning(f"Version '{version}' for {name} not found in cache.")
         download_and_extract_repo(project_data)
+        manifest = ingest_version(name, version, folder_path)
+    touch_version(manifest)
+
+    if cache_options["size_limit"] is not None:
+        collected = collect_garbage(cache_options["size_limit"], keep={(name, version)})
+        for evicted in collected["evicted"]:
+            warning(f"Evicted {evicted['name']} version '{evicted['version']}' from cache.", bold=False)
     return folder_path
+
+
+def get_project_files(project_data: ProjectConfig, relative_paths: Collection[str]) -> dict[str, Path]:
+    """
+    Paths to the given files of the project version. They are read straight from the cache store when they are all in
+    it, so that the whole version folder doesn't need to be restored. Files that aren't in the version are left out.
+    """
+    name = project_data["name"]
+    version = project_data["version"]
+    manifest = read_version_manifest(name, version)
+    if manifest is not None:
+        stored = {path: object_path(manifest["files"][path]) for path in relative_paths if path in manifest["files"]}
+        if all(path.exists() for path in stored.values()):
+            success(f"Version '{version}' for {name} found in cache.")
+            touch_version(manifest)
+            return stored
+
+    folder_path = get_project_folder(project_data)
+    return {path: folder_path / path for path in relative_paths if (folder_path / path).is_file()}
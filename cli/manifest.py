@@ -0,0 +1,99 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Optional, TypedDict
+
+from cli.classify import classify_file
+from cli.config import ProjectConfig
+from cli.utils import CACHE_DIR, EnsurePath
+
+"""
+The manifest records the state of every file materialised in a project's local directory right after `init`, so that
+later commands can tell which files were edited since by comparing stat signatures, without reading them.
+"""
+
+
+class FileFingerprint(TypedDict):
+    size: int
+    mtime_ns: int
+    hash: str
+
+
+class Manifest(TypedDict):
+    version: str
+    # Relative POSIX path -> fingerprint
+    files: dict[str, FileFingerprint]
+
+
+def get_manifest_path(project_config: ProjectConfig) -> EnsurePath:
+    return CACHE_DIR / project_config["name"] / "local.manifest.json"
+
+
+def hash_file(path: Path) -> str:
+    with open(path, "rb") as file:
+        return hashlib.file_digest(file, "sha256").hexdigest()
+
+
+def fingerprint_file(path: Path) -> FileFingerprint:
+    info = classify_file(path)
+    return {"size": info["size"], "mtime_ns": info["mtime_ns"], "hash": info["hash"]}
+
+
+def is_stat_unchanged(fingerprint: FileFingerprint, stat: os.stat_result) -> bool:
+    return fingerprint["size"] == stat.st_size and fingerprint["mtime_ns"] == stat.st_mtime_ns
+
+
+def read_manifest(project_config: ProjectConfig, *, any_version: bool = False) -> Optional[Manifest]:
+    """Read the manifest of the local directory, if there is one for the configured version (or any, if asked)."""
+    manifest_path = get_manifest_path(project_config)
+    if not manifest_path.exists():
+        return None
+    try:
+        with open(manifest_path, "r") as manifest_file:
+            manifest: Manifest = json.load(manifest_file)
+    except (OSError, ValueError):
+        return None
+    if not any_version and manifest.get("version") != project_config["version"]:
+        return None
+    return manifest
+
+
+def write_manifest(project_config: ProjectConfig, manifest: Manifest) -> None:
+    manifest_path = get_manifest_path(project_config)
+    manifest_path.parent.ensure()
+    temporary_path = manifest_path.with_suffix(".tmp")
+    with open(temporary_path, "w") as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(temporary_path, manifest_path)
+
+
+def build_manifest(project_config: ProjectConfig, relative_paths: list[str], jobs: int = 1) -> Manifest:
+    """Fingerprint the given files of the local directory. Missing files are left out."""
+    local_dir = project_config["local_dir"]
+
+    def try_fingerprint(relative_path: str) -> Optional[FileFingerprint]:
+        try:
+            return fingerprint_file(local_dir / relative_path)
+        except OSError:
+            return None
+
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        fingerprints = list(executor.map(try_fingerprint, relative_paths))
+
+    files = {
+        path: fingerprint
+        for path, fingerprint in zip(relative_paths, fingerprints, strict=True)
+        if fingerprint is not None
+    }
+    return {"version": project_config["version"], "files": files}
+
+
+def list_files(directory: Path) -> list[str]:
+    """List every file under `directory` as sorted relative POSIX paths."""
+    files: list[str] = []
+    for root, _, filenames in os.walk(directory):
+        relative_root = Path(root).relative_to(directory)
+        files.extend((relative_root / filename).as_posix() for filename in filenames)
+    return sorted(files)
@@ -0,0 +1,126 @@
+import os
+import shutil
+import stat
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Iterable, Literal
+
+from cli.trace import span
+
+MaterializeMode = Literal["auto", "reflink", "hardlink", "copy"]
+
+# Linux's FICLONE ioctl, supported by btrfs, xfs and other copy-on-write filesystems
+FICLONE = 0x40049409
+
+"""
+Materializing a cached release means getting a working copy of it somewhere else. Copying every file doubles the disk
+usage and I/O, so when possible files are instead:
+- Reflinked: the copy shares its blocks with the cached file until either is written to (copy-on-write).
+- Hardlinked: the copy *is* the cached file. Writing to it in place would corrupt the cache, so files that are known
+  to be written to afterwards (patched or linked files) are detached into real copies first. Anything else that edits
+  files in place would still write through, so this mode is only used for build workspaces, never for local copies.
+
+Cached files are read-only so that writing through a hardlink fails instead; copies are made writable again.
+"""
+
+
+def make_writable(path: Path) -> None:
+    mode = os.stat(path).st_mode
+    if not mode & stat.S_IWUSR:
+        os.chmod(path, mode | stat.S_IWUSR)
+
+
+def reflink_file(source: Path, destination: Path) -> None:
+    import fcntl
+
+    with open(source, "rb") as source_file, open(destination, "wb") as destination_file:
+        fcntl.ioctl(destination_file.fileno(), FICLONE, source_file.fileno())
+    shutil.copystat(source, destination)
+    make_writable(destination)
+
+
+def hardlink_file(source: Path, destination: Path) -> None:
+    os.link(source, destination)
+
+
+def copy_file(source: Path, destination: Path) -> None:
+    shutil.copy2(source, destination, follow_symlinks=False)
+    if not destination.is_symlink():
+        make_writable(destination)
+
+
+def detach_file(path: Path) -> None:
+    """Turn a hardlinked file into an independent copy, so it can be written to without affecting its other links."""
+    if path.is_symlink() or not path.is_file() or os.stat(path).st_nlink <= 1:
+        return
+    temporary_path = path.with_name(f".{path.name}.detach")
+    copy_file(path, temporary_path)
+    os.replace(temporary_path, path)
+
+
+def _supports(link_file: Callable[[Path, Path], None], source_dir: Path, target_dir: Path) -> bool:
+    """Try the linking function on a throwaway file, as support depends on both filesystems."""
+    probe_source = source_dir / ".materialize-probe"
+    probe_destination = target_dir / ".materialize-probe"
+    try:
+        probe_source.write_bytes(b"probe")
+        link_file(probe_source, probe_destination)
+        return True
+    except (OSError, ImportError):
+        return False
+    finally:
+        probe_source.unlink(missing_ok=True)
+        probe_destination.unlink(missing_ok=True)
+
+
+def resolve_mode(mode: MaterializeMode, source_dir: Path, target_dir: Path) -> MaterializeMode:
+    """Find the cheapest mode available for the given folders, falling back to copies."""
+    target_dir.mkdir(parents=True, exist_ok=True)
+    if mode in ("auto", "reflink") and _supports(reflink_file, source_dir, target_dir):
+        return "reflink"
+    if mode == "hardlink" and _supports(hardlink_file, source_dir, target_dir):
+        return "hardlink"
+    return "copy"
+
+
+@span("copy")
+def materialize_tree(
+    source_dir: Path,
+    target_dir: Path,
+    mode: MaterializeMode = "auto",
+    *,
+    detached: Iterable[str] = (),
+    jobs: int = 1,
+) -> MaterializeMode:
+    """
+    Replicate `source_dir` into `target_dir` using the given mode, returning the one that was actually used. With
+    hardlinks, the `detached` relative paths are turned into real copies, as they are going to be written to.
+    """
+    used_mode = resolve_mode(mode, source_dir, target_dir)
+    link_file = {"reflink": reflink_file, "hardlink": hardlink_file}.get(used_mode, copy_file)
+
+    files: list[tuple[Path, Path]] = []
+    for root, directories, filenames in os.walk(source_dir):
+        relative_root = Path(root).relative_to(source_dir)
+        for directory in directories:
+            (target_dir / relative_root / directory).mkdir(parents=True, exist_ok=True)
+        for filename in filenames:
+            source_file = Path(root) / filename
+            destination = target_dir / relative_root / filename
+            files.append((source_file, destination))
+
+    def materialize(paths: tuple[Path, Path]) -> None:
+        source_file, destination = paths
+        if source_file.is_symlink():
+            copy_file(source_file, destination)
+        else:
+            link_file(source_file, destination)
+
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        # Consume the results so that errors are raised
+        list(executor.map(materialize, files))
+
+    if used_mode == "hardlink":
+        for relative_path in detached:
+            detach_file(target_dir / relative_path)
+    return used_mode
@@ -0,0 +1,86 @@
+from typing import Sequence
+
+from cli.diff import DiffAlgorithm, matching_blocks
+
+# (base_start, base_end, ours_start, ours_end, theirs_start, theirs_end) of a region unchanged on both sides
+SyncRegion = tuple[int, int, int, int, int, int]
+
+"""
+Three-way line merges, as done by diff3: both sides are diffed against their common base, and the regions of the base
+left unchanged by both are used as synchronization points. Between them, a chunk changed on one side only takes that
+side's version, and a chunk changed the same way on both sides is taken once. Chunks changed differently on each side
+are conflicts, and are written out between git-style conflict markers.
+"""
+
+CONFLICT_START = "<<<<<<<"
+CONFLICT_SEPARATOR = "======="
+CONFLICT_END = ">>>>>>>"
+
+
+def _sync_regions(
+    base: Sequence[str], ours: Sequence[str], theirs: Sequence[str], algorithm: DiffAlgorithm
+) -> list[SyncRegion]:
+    ours_blocks = matching_blocks(base, ours, algorithm)
+    theirs_blocks = matching_blocks(base, theirs, algorithm)
+    regions: list[SyncRegion] = []
+    ours_index = theirs_index = 0
+    while ours_index < len(ours_blocks) and theirs_index < len(theirs_blocks):
+        ours_base, ours_start, ours_size = ours_blocks[ours_index]
+        theirs_base, theirs_start, theirs_size = theirs_blocks[theirs_index]
+        # Part of the base matched on both sides
+        start = max(ours_base, theirs_base)
+        end = min(ours_base + ours_size, theirs_base + theirs_size)
+        if start < end:
+            ours_match = ours_start + start - ours_base
+            theirs_match = theirs_start + start - theirs_base
+            regions.append(
+                (start, end, ours_match, ours_match + end - start, theirs_match, theirs_match + end - start)
+            )
+        if ours_base + ours_size < theirs_base + theirs_size:
+            ours_index += 1
+        else:
+            theirs_index += 1
+    regions.append((len(base), len(base), len(ours), len(ours), len(theirs), len(theirs)))
+    return regions
+
+
+def _with_newline(lines: Sequence[str]) -> list[str]:
+    # Conflict markers must start on their own line
+    if lines and not lines[-1].endswith("\n"):
+        return [*lines[:-1], lines[-1] + "\n"]
+    return list(lines)
+
+
+def merge3(
+    base: Sequence[str],
+    ours: Sequence[str],
+    theirs: Sequence[str],
+    *,
+    ours_label: str = "ours",
+    theirs_label: str = "theirs",
+    algorithm: DiffAlgorithm = "patience",
+) -> tuple[list[str], int]:
+    """Merge the changes made to `base` by both sides, returning the merged lines and how many conflicts they hold."""
+    merged: list[str] = []
+    conflicts = 0
+    base_index = ours_index = theirs_index = 0
+    for base_start, base_end, ours_start, ours_end, theirs_start, theirs_end in _sync_regions(
+        base, ours, theirs, algorithm
+    ):
+        base_chunk = base[base_index:base_start]
+        ours_chunk = ours[ours_index:ours_start]
+        theirs_chunk = theirs[theirs_index:theirs_start]
+        if ours_chunk == theirs_chunk or theirs_chunk == base_chunk:
+            merged.extend(ours_chunk)
+        elif ours_chunk == base_chunk:
+            merged.extend(theirs_chunk)
+        else:
+            conflicts += 1
+            merged.append(f"{CONFLICT_START} {ours_label}\n")
+            merged.extend(_with_newline(ours_chunk))
+            merged.append(f"{CONFLICT_SEPARATOR}\n")
+            merged.extend(_with_newline(theirs_chunk))
+            merged.append(f"{CONFLICT_END} {theirs_label}\n")
+        merged.extend(base[base_start:base_end])
+        base_index, ours_index, theirs_index = base_end, ours_end, theirs_end
+    return merged, conflicts
@@ -1,25 +1,580 @@
-import difflib
-import filecmp
-import subprocess
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from pathlib import Path
-from typing import Iterable
+from typing import TYPE_CHECKING, Iterable, Literal, Optional, TypedDict
 
-from cli.utils import read_lines
+from cli.bundle import PatchStore
+from cli.classify import classify_file, is_content_equal
+from cli.delta import apply_delta, is_delta, make_delta
+from cli.diff import DiffAlgorithm, unified_diff
+from cli.merge import merge3
+from cli.trace import span, tracer
+from cli.utils import decode_lines, read_lines, write_lines
+
+if TYPE_CHECKING:
+    from concurrent.futures import ProcessPoolExecutor
+
+PatchBackend = Literal["python", "gnu"]
+
+# Same default as GNU patch: up to 2 context lines may be ignored at each end of a hunk
+DEFAULT_FUZZ = 2
+
+HUNK_HEADER = re.compile(r"^@@ -(\d+)(?:,(\d+))? \+(\d+)(?:,(\d+))? @@")
+NO_NEWLINE_MARKER = "\\ No newline at end of file"
+
+
+class Hunk(TypedDict):
+    old_start: int
+    old_length: int
+    new_start: int
+    new_length: int
+    # Body lines, each prefixed with " ", "-" or "+"
+    lines: list[str]
+
+
+class HunkResult(TypedDict):
+    index: int
+    applied: bool
+    # Line in the original file where the hunk was expected / found (1-indexed)
+    line: int
+    offset: int
+    fuzz: int
+
+
+class PatchError(Exception):
+    """A patch could not be parsed or one of its hunks failed to apply."""
+
+    def __init__(self, message: str, results: Optional[list[HunkResult]] = None) -> None:
+        super().__init__(message)
+        self.results = results or []
+
+    def __reduce__(self) -> tuple[type["PatchError"], tuple[str, list[HunkResult]]]:
+        # Keep the hunk results when sent back from a worker process
+        return PatchError, (str(self), self.results)
+
+    def failed_hunks(self) -> list[HunkResult]:
+        return [result for result in self.results if not result["applied"]]
 
 
 def is_file_equal(file1: Path, file2: Path) -> bool:
-    return filecmp.cmp(file1, file2)
+    return is_content_equal(file1, file2)
+
+
+def parse_patch(patch_lines: list[str]) -> list[Hunk]:
+    """Parse the hunks of a single-file unified diff. File headers and any other preamble are ignored."""
+    hunks: list[Hunk] = []
+    index = 0
+    while index < len(patch_lines):
+        match = HUNK_HEADER.match(patch_lines[index])
+        index += 1
+        if match is None:
+            continue
+
+        old_start, old_length, new_start, new_length = match.groups()
+        hunk: Hunk = {
+            "old_start": int(old_start),
+            "old_length": 1 if old_length is None else int(old_length),
+            "new_start": int(new_start),
+            "new_length": 1 if new_length is None else int(new_length),
+            "lines": [],
+        }
+
+        old_left = hunk["old_length"]
+        new_left = hunk["new_length"]
+        while old_left > 0 or new_left > 0:
+            if index >= len(patch_lines):
+                raise PatchError(f"Unexpected end of patch in hunk #{len(hunks) + 1}.")
+            line = patch_lines[index]
+            index += 1
+            if line.startswith(NO_NEWLINE_MARKER):
+                _strip_last_newline(hunk["lines"])
+                continue
+            if line in ("\n", "\r\n"):
+                # Some editors strip the trailing space of empty context lines
+                line = " " + line
+            kind = line[0]
+            if kind == " ":
+                old_left -= 1
+                new_left -= 1
+            elif kind == "-":
+                old_left -= 1
+            elif kind == "+":
+                new_left -= 1
+            else:
+                raise PatchError(f"Malformed line in hunk #{len(hunks) + 1}: {line!r}.")
+            if old_left < 0 or new_left < 0:
+                raise PatchError(f"Hunk #{len(hunks) + 1} is longer than its header states.")
+            hunk["lines"].append(line)
+
+        # A trailing marker belongs to the last line of the hunk
+        if index < len(patch_lines) and patch_lines[index].startswith(NO_NEWLINE_MARKER):
+            _strip_last_newline(hunk["lines"])
+            index += 1
+
+        hunks.append(hunk)
+    return hunks
+
+
+def _strip_last_newline(lines: list[str]) -> None:
+    if lines and lines[-1].endswith("\n"):
+        lines[-1] = lines[-1][:-1]
+
 
+def _context_size(lines: list[str], *, reverse: bool = False) -> int:
+    count = 0
+    for line in reversed(lines) if reverse else lines:
+        if line[0] != " ":
+            break
+        count += 1
+    return count
 
-def apply_patch_file(patch_file: Path, file: Path) -> None:
+
+def _locate(lines: list[str], pattern: list[str], guess: int, lower_bound: int) -> Optional[int]:
+    """Find `pattern` in `lines`, searching outwards from `guess` without going before `lower_bound`."""
+    last = len(lines) - len(pattern)
+    if last < lower_bound:
+        return None
+    guess = min(max(guess, lower_bound), last)
+    for distance in range(max(guess - lower_bound, last - guess) + 1):
+        for position in (guess + distance, guess - distance):
+            if lower_bound <= position <= last and lines[position : position + len(pattern)] == pattern:
+                return position
+    return None
+
+
+def _match_at(lines: list[str], pattern: list[str], position: int, lower_bound: int) -> Optional[int]:
+    """`position` if `pattern` is found there in `lines`, without going before `lower_bound`."""
+    if lower_bound <= position and lines[position : position + len(pattern)] == pattern:
+        return position
+    return None
+
+
+def apply_hunks(lines: list[str], hunks: list[Hunk], fuzz: int = DEFAULT_FUZZ) -> tuple[list[str], list[HunkResult]]:
+    """
+    Apply the hunks in memory with GNU patch's offset / fuzz semantics: each hunk is first looked up at its expected
+    position (adjusted by previous offsets), then searched outwards, then retried ignoring up to `fuzz` context lines
+    at each end.
+
+    As in GNU patch, a hunk with less trailing than leading context can only be at the end of the file, and one with
+    less leading context, starting on the first line, can only be at its start, until the fuzz reaches the shorter side.
+    """
+    result = list(lines)
+    results: list[HunkResult] = []
+    delta = 0  # Lines added so far by applied hunks
+    last_offset = 0
+    lower_bound = 0  # Hunks cannot apply before the end of the previous one
+
+    for index, hunk in enumerate(hunks, start=1):
+        old = [line[1:] for line in hunk["lines"] if line[0] != "+"]
+        new = [line[1:] for line in hunk["lines"] if line[0] != "-"]
+        leading = _context_size(hunk["lines"])
+        trailing = _context_size(hunk["lines"], reverse=True)
+        context = max(leading, trailing)
+        # Pure insertions reference the line they go after
+        expected = hunk["old_start"] if hunk["old_length"] == 0 else hunk["old_start"] - 1
+
+        applied: Optional[HunkResult] = None
+        for used_fuzz in range(min(fuzz, context) + 1):
+            # Context lines ignored at each end, negative when the hunk is anchored to that end of the file
+            top = used_fuzz + leading - context
+            bottom = used_fuzz + trailing - context
+            anchored_start = top < 0 and expected == 0
+            anchored_end = bottom < 0
+            top = max(top, 0)
+            bottom = max(bottom, 0)
+            pattern = old[top : len(old) - bottom]
+            if anchored_start:
+                found = _match_at(result, pattern, 0, lower_bound)
+            elif anchored_end:
+                found = _match_at(result, pattern, len(result) - len(pattern), lower_bound)
+            else:
+                # The ignored context lines must still be within the file
+                found = _locate(result, pattern, expected + delta + last_offset + top, max(lower_bound, top))
+            if found is None:
+                continue
+            start = found - top
+            result[found : found + len(pattern)] = new[top : len(new) - bottom]
+            last_offset = start - (expected + delta)
+            lower_bound = found + len(new) - top - bottom
+            delta += len(new) - len(old)
+            applied = {
+                "index": index,
+                "applied": True,
+                "line": expected + last_offset + 1,
+                "offset": last_offset,
+                "fuzz": used_fuzz,
+            }
+            break
+
+        if applied is None:
+            applied = {"index": index, "applied": False, "line": expected + 1, "offset": 0, "fuzz": 0}
+        results.append(applied)
+
+    return result, results
+
+
+def describe_hunk_result(result: HunkResult) -> str:
+    """Describe a hunk result in the same terms as GNU patch does."""
+    if not result["applied"]:
+        return f"Hunk #{result['index']} FAILED at {result['line']}."
+    message = f"Hunk #{result['index']} succeeded at {result['line']}"
+    if result["fuzz"]:
+        message += f" with fuzz {result['fuzz']}"
+    if result["offset"]:
+        message += f" (offset {result['offset']} line{'' if abs(result['offset']) == 1 else 's'})"
+    return message + "."
+
+
+def apply_patch_lines(patch_lines: list[str], lines: list[str], fuzz: int = DEFAULT_FUZZ) -> list[str]:
+    """Apply a unified diff to the given lines, raising `PatchError` with per hunk results if any hunk fails."""
+    patched, results = apply_hunks(lines, parse_patch(patch_lines), fuzz)
+    failed = [result for result in results if not result["applied"]]
+    if failed:
+        raise PatchError(f"{len(failed)} out of {len(results)} hunks FAILED.", results)
+    return patched
+
+
+def _apply_patch_gnu(patch: bytes, file: Path) -> None:
+    import subprocess
+
+    # The patch is given through stdin, as it may not be a file of its own
     subprocess.run(
-        ["patch", "-f", "-r -", "--no-backup-if-mismatch", file.as_posix(), patch_file.as_posix()],
+        ["patch", "-f", "-r -", "--no-backup-if-mismatch", file.as_posix()],
+        input=patch,
         check=True,
         stdout=subprocess.DEVNULL,
     )
 
 
-def generate_patch(source_file: Path, original_file: Path) -> Iterable[str]:
+def apply_patch(patch: bytes, file: Path, backend: PatchBackend = "python") -> None:
+    if backend == "gnu":
+        _apply_patch_gnu(patch, file)
+        return
+    # The file is left untouched if any hunk fails
+    write_lines(file, apply_patch_lines(decode_lines(patch), read_lines(file)))
+
+
+class PatchTarget(TypedDict):
+    # Path of the patched file, relative to the project root
+    relative_path: Path
+    # Where to read the patch from, and its path in there
+    store: PatchStore
+    patch_path: str
+    file: Path
+
+
+class PatchOutcome(TypedDict):
+    relative_path: Path
+    binary: bool
+    error: Optional[Exception]
+
+
+def _process_pool(workers: int) -> "ProcessPoolExecutor":
+    # Only imported when a pool is needed, as multiprocessing is slow to import
+    from concurrent.futures import ProcessPoolExecutor
+
+    return ProcessPoolExecutor(max_workers=workers)
+
+
+def apply_binary_patch(patch: bytes, file: Path) -> None:
+    if is_delta(patch):
+        file.write_bytes(apply_delta(file.read_bytes(), patch))
+    else:
+        file.write_bytes(patch)
+
+
+def make_binary_patch(source_file: Path, local_file: Path, delta: bool = False) -> bytes:
+    """
+    Patch of a binary file: the whole local file, or a delta against the upstream one if asked for and smaller.
+    """
+    target = local_file.read_bytes()
+    if delta:
+        patch = make_delta(source_file.read_bytes(), target)
+        if len(patch) < len(target):
+            return patch
+    return target
+
+
+def _apply_patch_data(
+    relative_path: Path, patch: bytes, binary: bool, file: Path, backend: PatchBackend = "python"
+) -> tuple[PatchOutcome, float, float, int]:
+    # Timed in the worker, as the time spent waiting in the pool doesn't count
+    start = time.perf_counter()
+    outcome: PatchOutcome = {"relative_path": relative_path, "binary": binary, "error": None}
+    try:
+        if binary:
+            # It's binary; copy it instead, or rebuild it if it is a delta
+            apply_binary_patch(patch, file)
+        else:
+            apply_patch(patch, file, backend)
+    except Exception as e:
+        outcome["error"] = e
+    return outcome, start, time.perf_counter() - start, os.getpid()
+
+
+def apply_patch_target(target: PatchTarget, backend: PatchBackend = "python") -> PatchOutcome:
+    """Apply a single patch, copying it over the file instead if it is binary. Errors are returned, not raised."""
+    store = target["store"]
+    try:
+        binary = store.is_binary(target["patch_path"])
+        patch = store.read(target["patch_path"])
+    except Exception as e:
+        return {"relative_path": target["relative_path"], "binary": False, "error": e}
+    outcome, start, duration, _ = _apply_patch_data(target["relative_path"], patch, binary, target["file"], backend)
+    tracer.add_file("patch apply", target["relative_path"].as_posix(), start, duration)
+    return outcome
+
+
+def _apply_patch_targets_in_processes(targets: list[PatchTarget], jobs: int) -> list[PatchOutcome]:
+    # Stores can't be shared with the worker processes, so the patches are read here
+    outcomes: list[Optional[PatchOutcome]] = [None] * len(targets)
+    indices: list[int] = []
+    patches: list[bytes] = []
+    binary: list[bool] = []
+    for index, target in enumerate(targets):
+        store = target["store"]
+        try:
+            is_binary = store.is_binary(target["patch_path"])
+            patch = store.read(target["patch_path"])
+        except Exception as e:
+            outcomes[index] = {"relative_path": target["relative_path"], "binary": False, "error": e}
+            continue
+        indices.append(index)
+        patches.append(patch)
+        binary.append(is_binary)
+
+    if indices:
+        relative_paths = [targets[index]["relative_path"] for index in indices]
+        files = [targets[index]["file"] for index in indices]
+        workers = min(jobs, len(indices))
+        with _process_pool(workers) as executor:
+            chunksize = max(1, len(indices) // (workers * 4))
+            timed = executor.map(_apply_patch_data, relative_paths, patches, binary, files, chunksize=chunksize)
+            for index, (outcome, start, duration, worker) in zip(indices, timed, strict=True):
+                tracer.add_file("patch apply", outcome["relative_path"].as_posix(), start, duration, worker)
+                outcomes[index] = outcome
+    return [outcome for outcome in outcomes if outcome is not None]
+
+
+def apply_patch_targets(
+    targets: list[PatchTarget], backend: PatchBackend = "python", jobs: int = 1
+) -> list[PatchOutcome]:
+    """
+    Apply every patch across a pool of `jobs` workers. Each patch touches a single file, so they are independent of
+    each other. Outcomes are returned in the same order as the targets.
+
+    Patches are applied in memory in worker processes, as that is bound by the CPU; the GNU backend waits on the patch
+    executable instead, so it runs in threads.
+    """
+    with span("patch", files=len(targets)):
+        if jobs <= 1 or len(targets) <= 1:
+            return [apply_patch_target(target, backend) for target in targets]
+        if backend == "python":
+            return _apply_patch_targets_in_processes(targets, jobs)
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            return list(executor.map(partial(apply_patch_target, backend=backend), targets))
+
+
+class PatchCheck(TypedDict):
+    relative_path: str
+    binary: bool
+    # How every hunk applied, for text patches
+    hunks: list[HunkResult]
+    # Why the patch can't apply at all, if it can't
+    error: Optional[str]
+
+
+def is_check_failed(check: PatchCheck) -> bool:
+    return check["error"] is not None or any(not result["applied"] for result in check["hunks"])
+
+
+def check_patch(relative_path: str, patch: bytes, binary: bool, source_file: Optional[Path]) -> PatchCheck:
+    """Apply a patch over the upstream file in memory, recording how every hunk applied. Nothing is written."""
+    check: PatchCheck = {"relative_path": relative_path, "binary": binary, "hunks": [], "error": None}
+    if source_file is None:
+        check["error"] = "File missing from the upstream version."
+        return check
+    try:
+        if not binary:
+            _, check["hunks"] = apply_hunks(read_lines(source_file), parse_patch(decode_lines(patch)))
+        elif is_delta(patch):
+            apply_delta(source_file.read_bytes(), patch)
+    except Exception as e:
+        check["error"] = str(e)
+    return check
+
+
+@span("check")
+def check_patches(
+    relative_paths: list[str],
+    patches: list[bytes],
+    binary: list[bool],
+    source_files: list[Optional[Path]],
+    jobs: int = 1,
+) -> list[PatchCheck]:
+    """Check the given patches across a pool of `jobs` processes, returning the results in the same order."""
+    if jobs <= 1 or len(relative_paths) <= 1:
+        return list(map(check_patch, relative_paths, patches, binary, source_files))
+    workers = min(jobs, len(relative_paths))
+    with _process_pool(workers) as executor:
+        chunksize = max(1, len(relative_paths) // (workers * 4))
+        return list(executor.map(check_patch, relative_paths, patches, binary, source_files, chunksize=chunksize))
+
+
+class RebasedPatch(TypedDict):
+    relative_path: str
+    binary: bool
+    # The patch against the new version, or None if it is no longer needed
+    patch: Optional[bytes]
+    conflicts: int
+    # Why the patch couldn't be rebased, in which case it is kept as is
+    error: Optional[str]
+
+
+def _rebase_binary_patch(patch: bytes, old_file: Path, new_file: Path, rebased: RebasedPatch) -> None:
+    if not is_delta(patch):
+        # The whole file is replaced, whatever upstream did to it
+        rebased["conflicts"] = 1
+        return
+    target = apply_delta(old_file.read_bytes(), patch)
+    source = new_file.read_bytes()
+    if target == source:
+        rebased["patch"] = None
+        return
+    # Both sides changed the file, and its contents can't be merged: keep ours
+    rebased["conflicts"] = 1
+    delta = make_delta(source, target)
+    rebased["patch"] = delta if len(delta) < len(target) else target
+
+
+def rebase_patch(
+    relative_path: str,
+    patch: bytes,
+    binary: bool,
+    old_file: Optional[Path],
+    new_file: Optional[Path],
+    labels: tuple[str, str] = ("patched", "upstream"),
+    algorithm: DiffAlgorithm = "patience",
+) -> RebasedPatch:
+    """
+    Move a patch from the old upstream version of a file to the new one, with a three-way merge of the patched file
+    and the new upstream file over the old upstream file. Conflicts are left in the patched file between markers.
+    """
+    rebased: RebasedPatch = {
+        "relative_path": relative_path,
+        "binary": binary,
+        "patch": patch,
+        "conflicts": 0,
+        "error": None,
+    }
+    if old_file is None:
+        rebased["error"] = "File missing from the current upstream version."
+        return rebased
+    if new_file is None:
+        rebased["error"] = "File removed from the new upstream version."
+        return rebased
+    try:
+        if is_content_equal(old_file, new_file):
+            return rebased
+        if binary:
+            _rebase_binary_patch(patch, old_file, new_file, rebased)
+            return rebased
+
+        base = read_lines(old_file)
+        ours = apply_patch_lines(decode_lines(patch), base)
+        theirs = read_lines(new_file)
+        merged, rebased["conflicts"] = merge3(
+            base, ours, theirs, ours_label=labels[0], theirs_label=labels[1], algorithm=algorithm
+        )
+        new_patch = unified_diff(theirs, merged, algorithm)
+        rebased["patch"] = "".join(new_patch).encode() if "".join(new_patch).strip() != "" else None
+    except Exception as e:
+        rebased["error"] = str(e)
+    return rebased
+
+
+@span("rebase")
+def rebase_patches(
+    relative_paths: list[str],
+    patches: list[bytes],
+    binary: list[bool],
+    old_files: list[Optional[Path]],
+    new_files: list[Optional[Path]],
+    labels: tuple[str, str] = ("patched", "upstream"),
+    jobs: int = 1,
+    algorithm: DiffAlgorithm = "patience",
+) -> list[RebasedPatch]:
+    """Rebase the given patches across a pool of `jobs` processes, returning the results in the same order."""
+    rebase = partial(rebase_patch, labels=labels, algorithm=algorithm)
+    if jobs <= 1 or len(relative_paths) <= 1:
+        return list(map(rebase, relative_paths, patches, binary, old_files, new_files))
+    workers = min(jobs, len(relative_paths))
+    with _process_pool(workers) as executor:
+        chunksize = max(1, len(relative_paths) // (workers * 4))
+        return list(executor.map(rebase, relative_paths, patches, binary, old_files, new_files, chunksize=chunksize))
+
+
+def generate_patch(source_file: Path, original_file: Path, algorithm: DiffAlgorithm = "patience") -> Iterable[str]:
     original_lines = read_lines(original_file)
     source_lines = read_lines(source_file)
-    return list(difflib.unified_diff(source_lines, original_lines))
+    return unified_diff(source_lines, original_lines, algorithm)
+
+
+class FileDiff(TypedDict):
+    relative_path: str
+    binary: bool
+    # Empty when there is nothing to patch
+    patch: list[str]
+
+
+def diff_file(
+    relative_path: str, source_dir: Path, local_dir: Path, algorithm: DiffAlgorithm = "patience"
+) -> FileDiff:
+    """Diff a local file against its upstream version. Binary files are only flagged, as they are copied whole."""
+    source_file = source_dir / relative_path
+    local_file = local_dir / relative_path
+    result: FileDiff = {"relative_path": relative_path, "binary": False, "patch": []}
+    if is_file_equal(source_file, local_file):
+        return result
+    if classify_file(source_file)["binary"] or classify_file(local_file)["binary"]:
+        result["binary"] = True
+        return result
+    patch = list(generate_patch(source_file, local_file, algorithm))
+    # Files may be considered different and yet have no patch
+    if "".join(patch).strip() != "":
+        result["patch"] = patch
+    return result
+
+
+def _timed_diff_file(
+    relative_path: str, source_dir: Path, local_dir: Path, algorithm: DiffAlgorithm
+) -> tuple[FileDiff, float, float, int]:
+    # Timed in the worker, as the time spent waiting in the pool doesn't count
+    start = time.perf_counter()
+    result = diff_file(relative_path, source_dir, local_dir, algorithm)
+    return result, start, time.perf_counter() - start, os.getpid()
+
+
+def diff_files(
+    relative_paths: list[str],
+    source_dir: Path,
+    local_dir: Path,
+    jobs: int = 1,
+    algorithm: DiffAlgorithm = "patience",
+) -> list[FileDiff]:
+    """Diff the given files across a pool of `jobs` processes, returning the results in the same order."""
+    diff = partial(_timed_diff_file, source_dir=source_dir, local_dir=local_dir, algorithm=algorithm)
+    with span("diff", files=len(relative_paths)):
+        if jobs <= 1 or len(relative_paths) <= 1:
+            timed = [diff(relative_path) for relative_path in relative_paths]
+        else:
+            workers = min(jobs, len(relative_paths))
+            with _process_pool(workers) as executor:
+                chunksize = max(1, len(relative_paths) // (workers * 4))
+                timed = list(executor.map(diff, relative_paths, chunksize=chunksize))
+    for result, start, duration, worker in timed:
+        tracer.add_file("file diff", result["relative_path"], start, duration, worker)
+    return [result for result, _, _, _ in timed]
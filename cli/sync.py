@@ -0,0 +1,86 @@
+import filecmp
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Iterable, Optional, TypedDict
+
+from cli.materialize import copy_file
+from cli.trace import span
+
+
+class SyncResult(TypedDict):
+    written: list[str]
+    deleted: list[str]
+    unchanged: int
+
+
+def _is_excluded(relative_path: str, excluded: Iterable[str]) -> bool:
+    return any(relative_path == prefix or relative_path.startswith(prefix + "/") for prefix in excluded)
+
+
+def sync_file(source_file: Path, target_file: Path) -> bool:
+    """Copy the file over the target if their contents differ. Returns whether it was written."""
+    # Unpatched files keep the cached file's stat signature, so most of them are not even read
+    if not target_file.is_symlink() and target_file.is_file() and filecmp.cmp(source_file, target_file):
+        return False
+    if target_file.is_symlink() or target_file.is_file():
+        target_file.unlink()
+    elif target_file.is_dir():
+        shutil.rmtree(target_file)
+    target_file.parent.mkdir(parents=True, exist_ok=True)
+    copy_file(source_file, target_file)
+    return True
+
+
+def _remove_empty_parents(file: Path, root: Path) -> None:
+    parent = file.parent
+    while parent != root and parent.is_relative_to(root):
+        try:
+            parent.rmdir()
+        except OSError:
+            return
+        parent = parent.parent
+
+
+@span("sync")
+def sync_tree(
+    source_dir: Path,
+    target_dir: Path,
+    relative_paths: list[str],
+    *,
+    overlay_dir: Optional[Path] = None,
+    previous_paths: Iterable[str] = (),
+    excluded: Iterable[str] = (),
+    jobs: int = 1,
+) -> SyncResult:
+    """
+    Make the given files of `target_dir` match `source_dir`, taking a file from `overlay_dir` instead when it has it.
+    Only files whose contents differ are written, and only files that were previously synced (`previous_paths`) and
+    are no longer expected are deleted; anything else in `target_dir` (dependencies, build output) is left alone.
+    Paths under `excluded` are never touched.
+    """
+    excluded = list(excluded)
+    paths = [path for path in relative_paths if not _is_excluded(path, excluded)]
+
+    def sync(relative_path: str) -> bool:
+        source_file = source_dir / relative_path
+        if overlay_dir is not None and (overlay_dir / relative_path).exists():
+            source_file = overlay_dir / relative_path
+        return sync_file(source_file, target_dir / relative_path)
+
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        written_flags = list(executor.map(sync, paths))
+    written = [path for path, was_written in zip(paths, written_flags, strict=True) if was_written]
+
+    expected = set(relative_paths)
+    deleted: list[str] = []
+    for relative_path in sorted(previous_paths):
+        if relative_path in expected or _is_excluded(relative_path, excluded):
+            continue
+        target_file = target_dir / relative_path
+        if target_file.is_symlink() or target_file.is_file():
+            target_file.unlink()
+            _remove_empty_parents(target_file, target_dir)
+            deleted.append(relative_path)
+
+    return {"written": written, "deleted": deleted, "unchanged": len(paths) - len(written)}
@@ -0,0 +1,147 @@
+import contextlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Iterator, NotRequired, Optional, TypedDict
+
+"""
+Timings of what the CLI spends its time on. Phases (downloading, extracting, copying, patching, building...) are
+recorded as nested spans, and per-file work (applying a patch, diffing a file) as one event per file, so that a slow
+run can be broken down without a profiler.
+
+Everything is recorded by the global `tracer`, which library callers can read from directly. The events follow the
+Chrome trace event format, and can be written to a file that opens in `chrome://tracing` or Perfetto.
+"""
+
+# Number of slowest files kept for each kind of per-file work
+SLOWEST_FILES = 5
+
+
+class TraceEvent(TypedDict):
+    name: str
+    cat: str
+    # Always "X": a complete event, with its duration
+    ph: str
+    # Microseconds since the tracer started
+    ts: float
+    dur: NotRequired[float]
+    pid: int
+    tid: int
+    args: NotRequired[dict[str, object]]
+
+
+class PhaseTiming(TypedDict):
+    count: int
+    # Seconds
+    total: float
+    # Nesting level of its first span
+    depth: int
+
+
+class FileTimings(TypedDict):
+    count: int
+    total: float
+    # (relative path, seconds), the slowest first
+    slowest: list[tuple[str, float]]
+
+
+class Tracer:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        self.origin = time.perf_counter()
+        self.events: list[TraceEvent] = []
+        self.phases: dict[str, PhaseTiming] = {}
+        self.files: dict[str, FileTimings] = {}
+        self.local = threading.local()
+
+    def _add_event(self, name: str, category: str, start: float, duration: float, tid: int, **args: object) -> None:
+        event: TraceEvent = {
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": (start - self.origin) * 1e6,
+            "dur": duration * 1e6,
+            "pid": os.getpid(),
+            "tid": tid,
+        }
+        if args:
+            event["args"] = args
+        self.events.append(event)
+
+    @contextlib.contextmanager
+    def span(self, name: str, **args: object) -> Iterator[None]:
+        """Time the enclosed block as a phase of the given name."""
+        depth: int = getattr(self.local, "depth", 0)
+        self.local.depth = depth + 1
+        with self.lock:
+            # Listed in the order they start
+            phase = self.phases.setdefault(name, {"count": 0, "total": 0.0, "depth": depth})
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            self.local.depth = depth
+            with self.lock:
+                self._add_event(name, "phase", start, duration, threading.get_ident(), **args)
+                phase["count"] += 1
+                phase["total"] += duration
+
+    def add_file(
+        self, category: str, relative_path: str, start: float, duration: float, worker: Optional[int] = None
+    ) -> None:
+        """
+        Record the work done on a single file. `start` is a `time.perf_counter()` value, which is shared by the worker
+        processes of a pool; `worker` identifies the thread or process the file was handled in (this thread if None).
+        """
+        with self.lock:
+            self._add_event(
+                relative_path, category, start, duration, threading.get_ident() if worker is None else worker
+            )
+            timings = self.files.setdefault(category, {"count": 0, "total": 0.0, "slowest": []})
+            timings["count"] += 1
+            timings["total"] += duration
+            slowest = timings["slowest"]
+            if len(slowest) < SLOWEST_FILES or duration > slowest[-1][1]:
+                slowest.append((relative_path, duration))
+                slowest.sort(key=lambda item: item[1], reverse=True)
+                del slowest[SLOWEST_FILES:]
+
+    @contextlib.contextmanager
+    def time_file(self, category: str, relative_path: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_file(category, relative_path, start, time.perf_counter() - start)
+
+    def write(self, path: Path) -> None:
+        """Write the events as a Chrome trace."""
+        with self.lock:
+            events = list(self.events)
+        with open(path, "w") as trace_file:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, trace_file)
+
+    def summary(self) -> list[str]:
+        """Table of the time spent in every phase, then in per-file work."""
+        lines: list[str] = []
+        width = max((len(name) + 2 * phase["depth"] for name, phase in self.phases.items()), default=0)
+        width = max([width, *(len(category) for category in self.files)])
+        for name, phase in self.phases.items():
+            label = f"{'  ' * phase['depth']}{name}"
+            count = f"  ({phase['count']} times)" if phase["count"] > 1 else ""
+            lines.append(f"{label.ljust(width)}  {phase['total']:9.3f} s{count}")
+        for category, timings in self.files.items():
+            files = f"{timings['count']} file{'s' if timings['count'] != 1 else ''}"
+            lines.append(f"{category.ljust(width)}  {timings['total']:9.3f} s  ({files})")
+            lines.extend(f"  {path}: {seconds:.3f} s" for path, seconds in timings["slowest"])
+        return lines
+
+
+tracer = Tracer()
+span = tracer.span
@@ -1,10 +1,13 @@
-import platform
+import contextlib
+import io
+import sys
+import threading
 from pathlib import Path
-from typing import Iterable
+from typing import Iterable, Iterator
 
 import click
 
-is_windows = platform.system() == "Windows"
+is_windows = sys.platform == "win32"
 
 
 class EnsurePath(Path):
@@ -16,29 +19,55 @@ class EnsurePath(Path):
 
 
 CACHE_DIR = EnsurePath(__file__).parent / ".cache"
-CACHE_DIR.ensure(with_ignore=True)
 
 
 PROJECT_DIR = EnsurePath(__file__).parent.parent
 
 
+def ensure_cache_dir() -> None:
+    """Create the cache folder, ignored by git, unless it already exists."""
+    if not (CACHE_DIR / ".gitignore").exists():
+        CACHE_DIR.ensure(with_ignore=True)
+
+
 # Colored prints
 
+# Per thread, so that projects set up in parallel each tag their own messages
+_log_context = threading.local()
+
+
+@contextlib.contextmanager
+def log_prefix(prefix: str) -> Iterator[None]:
+    """Start every line printed by this thread with `prefix` until the context exits."""
+    previous = getattr(_log_context, "prefix", "")
+    _log_context.prefix = prefix
+    try:
+        yield
+    finally:
+        _log_context.prefix = previous
+
+
+def _prefixed(message: str) -> str:
+    prefix: str = getattr(_log_context, "prefix", "")
+    if not prefix:
+        return message
+    return "\n".join(f"{prefix}{line}" for line in message.split("\n"))
+
 
 def log(message: str, *, bold: bool = False) -> None:
-    click.echo(click.style(message, bold=bold))
+    click.echo(click.style(_prefixed(message), bold=bold))
 
 
 def success(message: str, *, bold: bool = True) -> None:
-    click.echo(click.style(message, fg="green", bold=bold))
+    click.echo(click.style(_prefixed(message), fg="green", bold=bold))
 
 
 def warning(message: str, *, bold: bool = True) -> None:
-    click.echo(click.style(message, fg="yellow", bold=bold))
+    click.echo(click.style(_prefixed(message), fg="yellow", bold=bold))
 
 
 def error(message: str, *, bold: bool = True) -> None:
-    click.echo(click.style(message, fg="red", bold=bold), err=True)
+    click.echo(click.style(_prefixed(message), fg="red", bold=bold), err=True)
 
 
 # Read / Write to files
@@ -55,6 +84,11 @@ def read_lines(path: Path) -> list[str]:
         return [l.decode() for l in file.readlines()]
 
 
+def decode_lines(data: bytes) -> list[str]:
+    """Same as `read_lines`, for contents already in memory."""
+    return [l.decode() for l in io.BytesIO(data).readlines()]
+
+
 def write_lines(path: Path, lines: Iterable[str]) -> None:
     with open(path, "wb+") as file:
         file.writelines([l.encode() for l in lines])
@@ -0,0 +1,200 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import time
+from pathlib import Path
+from typing import Collection, Optional, Protocol
+
+from cli.utils import warning
+
+"""
+Watchers report which files of the local copy changed. Only the files that exist upstream can have a patch, so only
+those are reported, and only the folders holding them are watched: `node_modules`, build output and any other folder
+created locally are never looked at.
+
+On Linux, folders are watched with inotify. Elsewhere, or if inotify can't be used (for example when the limit of
+watches is reached), the files are polled for changes in their size and modification time instead.
+"""
+
+# inotify(7)
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_CLOSE_WRITE | IN_ATTRIB | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+EVENT_HEADER = struct.Struct("iIII")
+READ_SIZE = 64 * 1024
+
+POLL_INTERVAL = 1.0
+
+
+class Watcher(Protocol):
+    def read_changes(self, timeout: Optional[float]) -> Optional[set[str]]:
+        """
+        Wait up to `timeout` seconds (or forever) for changes, returning the relative paths of the changed files, or
+        None if changes were lost and every file should be checked again.
+        """
+        ...
+
+    def close(self) -> None: ...
+
+
+def _parent_dirs(files: Collection[str]) -> set[str]:
+    directories = {""}
+    for path in files:
+        parts = path.split("/")[:-1]
+        directories.update("/".join(parts[:index]) for index in range(1, len(parts) + 1))
+    return directories
+
+
+def _join(directory: str, name: str) -> str:
+    return f"{directory}/{name}" if directory else name
+
+
+class InotifyWatcher:
+    def __init__(self, root: Path, files: Collection[str]) -> None:
+        self.root = root
+        self.files = set(files)
+        self.directories = _parent_dirs(self.files)
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            error_number = ctypes.get_errno()
+            raise OSError(error_number, os.strerror(error_number))
+        self.watches: dict[int, str] = {}
+        try:
+            for directory in sorted(self.directories):
+                self._add_watch(directory)
+        except OSError:
+            self.close()
+            raise
+
+    def _add_watch(self, directory: str) -> None:
+        path = self.root / directory
+        descriptor = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if descriptor < 0:
+            error_number = ctypes.get_errno()
+            if error_number == errno.ENOENT:
+                # Deleted locally: watched again if it comes back
+                return
+            raise OSError(error_number, f"Can't watch '{path.as_posix()}': {os.strerror(error_number)}")
+        self.watches[descriptor] = directory
+
+    def _files_under(self, directory: str) -> set[str]:
+        prefix = f"{directory}/"
+        return {path for path in self.files if path.startswith(prefix)}
+
+    def read_changes(self, timeout: Optional[float]) -> Optional[set[str]]:
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set()
+        data = os.read(self.fd, READ_SIZE)
+        changes: set[str] = set()
+        position = 0
+        while position < len(data):
+            descriptor, mask, _, name_size = EVENT_HEADER.unpack_from(data, position)
+            position += EVENT_HEADER.size
+            name = os.fsdecode(data[position : position + name_size].rstrip(b"\0"))
+            position += name_size
+            if mask & IN_Q_OVERFLOW:
+                return None
+            if mask & IN_IGNORED:
+                self.watches.pop(descriptor, None)
+                continue
+            directory = self.watches.get(descriptor)
+            if directory is None or not name:
+                continue
+            path = _join(directory, name)
+            if not mask & IN_ISDIR:
+                if path in self.files:
+                    changes.add(path)
+                continue
+            if path in self.directories:
+                # A whole folder came or went: its files changed too
+                subdirectories = [d for d in sorted(self.directories) if d == path or d.startswith(f"{path}/")]
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    for subdirectory in subdirectories:
+                        self._add_watch(subdirectory)
+                elif mask & IN_MOVED_FROM:
+                    # Its watches would follow it wherever it was moved to
+                    for watched, subdirectory in list(self.watches.items()):
+                        if subdirectory in subdirectories:
+                            self.libc.inotify_rm_watch(self.fd, watched)
+                            del self.watches[watched]
+                changes.update(self._files_under(path))
+        return changes
+
+    def close(self) -> None:
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+
+class PollingWatcher:
+    def __init__(self, root: Path, files: Collection[str], interval: float = POLL_INTERVAL) -> None:
+        self.root = root
+        self.files = sorted(files)
+        self.interval = interval
+        self.snapshot = self._scan()
+
+    def _scan(self) -> dict[str, Optional[tuple[int, int]]]:
+        snapshot: dict[str, Optional[tuple[int, int]]] = {}
+        for path in self.files:
+            try:
+                stat = os.stat(self.root / path)
+                snapshot[path] = (stat.st_size, stat.st_mtime_ns)
+            except OSError:
+                snapshot[path] = None
+        return snapshot
+
+    def read_changes(self, timeout: Optional[float]) -> Optional[set[str]]:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            time.sleep(
+                self.interval if deadline is None else max(0.0, min(self.interval, deadline - time.monotonic()))
+            )
+            snapshot = self._scan()
+            changes = {path for path, signature in snapshot.items() if self.snapshot.get(path) != signature}
+            self.snapshot = snapshot
+            if changes or (deadline is not None and time.monotonic() >= deadline):
+                return changes
+
+    def close(self) -> None:
+        pass
+
+
+def get_watcher(root: Path, files: Collection[str], polling: bool = False) -> Watcher:
+    """Watch the given files with inotify when possible, polling them otherwise."""
+    if not polling and sys.platform == "linux":
+        try:
+            return InotifyWatcher(root, files)
+        except (OSError, AttributeError) as e:
+            warning(f"Could not watch with inotify ({e}). Polling for changes instead.", bold=False)
+    return PollingWatcher(root, files)
+
+
+def wait_for_changes(watcher: Watcher, debounce: float) -> Optional[set[str]]:
+    """Wait for changes, then keep collecting them until nothing changes for `debounce` seconds."""
+    changes: Optional[set[str]] = set()
+    while not changes:
+        changes = watcher.read_changes(None)
+        if changes is None:
+            break
+    while True:
+        more = watcher.read_changes(debounce)
+        if more is None:
+            changes = None
+        elif not more:
+            return changes
+        elif changes is not None:
+            changes.update(more)
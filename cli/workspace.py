@@ -0,0 +1,88 @@
+import hashlib
+import json
+import os
+from pathlib import Path
+from typing import Optional, TypedDict
+
+from cli.config import ProjectConfig
+from cli.utils import CACHE_DIR, EnsurePath
+
+"""
+`generate-asar` builds in a persistent workspace per project version instead of a throwaway copy. The workspace keeps
+its `node_modules`, the bundler's cache and the last build output, and the state file records what was put in it, so
+that the next run only rewrites the patched and linked files that changed, only reinstalls dependencies when
+`package.json` / `yarn.lock` change, and only rebuilds when something was written or `replace_vars.sh` changed.
+"""
+
+# Files that decide what gets installed in node_modules
+DEPENDENCY_FILES = ("package.json", "yarn.lock")
+
+
+class PatchedFile(TypedDict):
+    # SHA-256 of the patch that was applied
+    patch: str
+    # Stat of the patched file, to notice if it was changed since
+    size: int
+    mtime_ns: int
+
+
+class WorkspaceState(TypedDict):
+    # Relative path -> patch applied to it
+    patched: dict[str, PatchedFile]
+    # Link destination -> relative paths copied under it (for folders)
+    links: dict[str, list[str]]
+    # Hash of the dependency files when dependencies were last installed
+    dependencies: Optional[str]
+    # Whether the build output matches the current files
+    built: bool
+    # Hash of replace_vars.sh when it was last applied to the build output
+    replace_script: Optional[str]
+
+
+def get_workspace_dir(project_config: ProjectConfig) -> EnsurePath:
+    return CACHE_DIR / project_config["name"] / f"{project_config['version']}.workspace"
+
+
+def get_workspace_state_path(project_config: ProjectConfig) -> EnsurePath:
+    return CACHE_DIR / project_config["name"] / f"{project_config['version']}.workspace.json"
+
+
+def new_workspace_state() -> WorkspaceState:
+    return {"patched": {}, "links": {}, "dependencies": None, "built": False, "replace_script": None}
+
+
+def read_workspace_state(project_config: ProjectConfig) -> Optional[WorkspaceState]:
+    try:
+        with open(get_workspace_state_path(project_config), "r") as state_file:
+            state: WorkspaceState = json.load(state_file)
+    except (OSError, ValueError):
+        return None
+    return state
+
+
+def write_workspace_state(project_config: ProjectConfig, state: WorkspaceState) -> None:
+    state_path = get_workspace_state_path(project_config)
+    state_path.parent.ensure()
+    temporary_path = state_path.with_suffix(".tmp")
+    with open(temporary_path, "w") as state_file:
+        json.dump(state, state_file)
+    os.replace(temporary_path, state_path)
+
+
+def is_patched_file_unchanged(patched: PatchedFile, path: Path) -> bool:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return False
+    return patched["size"] == stat.st_size and patched["mtime_ns"] == stat.st_mtime_ns
+
+
+def hash_dependency_files(workspace_dir: Path) -> str:
+    digest = hashlib.sha256()
+    for filename in DEPENDENCY_FILES:
+        try:
+            digest.update((workspace_dir / filename).read_bytes())
+        except FileNotFoundError:
+            pass
+        digest.update(b"\0")
+    return digest.hexdigest()
@@ -0,0 +1,101 @@
+import contextlib
+import http.server
+import io
+import os
+import tempfile
+import threading
+import unittest
+from pathlib import Path
+from unittest import mock
+
+from cli.artifacts import TOKEN_ENV_VAR, HttpArtifactBackend, fetch_artifact, store_artifact
+
+"""
+Tests of the HTTP artifact backend against a local stand-in for the shared cache server, which stores what is PUT in
+memory and serves it back on GET.
+"""
+
+
+class _CacheHandler(http.server.BaseHTTPRequestHandler):
+    artifacts: dict[str, bytes]
+    authorizations: list[str]
+
+    def log_message(self, format: str, *args: object) -> None:
+        pass
+
+    def _respond(self, status: int, body: bytes = b"") -> None:
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self) -> None:
+        self.authorizations.append(self.headers.get("Authorization", ""))
+        if self.path in self.artifacts:
+            self._respond(200, self.artifacts[self.path])
+        else:
+            self._respond(404)
+
+    def do_PUT(self) -> None:
+        self.authorizations.append(self.headers.get("Authorization", ""))
+        self.artifacts[self.path] = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self._respond(201)
+
+
+class HttpArtifactBackendTest(unittest.TestCase):
+    def setUp(self) -> None:
+        # A subclass per test, so that each server starts empty
+        class Handler(_CacheHandler):
+            artifacts = {}
+            authorizations = []
+
+        self.handler = Handler
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/cache/"
+
+        temporary_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temporary_dir.cleanup)
+        self.directory = Path(temporary_dir.name)
+        self.artifact = self.directory / "webapp.asar"
+        self.artifact.write_bytes(os.urandom(256 * 1024))
+        self.output = self.directory / "output.asar"
+
+    def test_miss(self) -> None:
+        backend = HttpArtifactBackend(self.url)
+        self.assertIsNone(fetch_artifact([backend], "key", self.output))
+        self.assertFalse(self.output.exists())
+
+    def test_store_then_hit(self) -> None:
+        backend = HttpArtifactBackend(self.url)
+        store_artifact([backend], "key", self.artifact)
+        self.assertEqual(list(self.handler.artifacts), ["/cache/key.asar"])
+
+        self.assertIs(fetch_artifact([backend], "key", self.output), backend)
+        self.assertEqual(self.output.read_bytes(), self.artifact.read_bytes())
+        self.assertEqual([path.name for path in self.directory.iterdir() if path.name.endswith(".partial")], [])
+
+    def test_token(self) -> None:
+        with mock.patch.dict(os.environ, {TOKEN_ENV_VAR: "secret"}):
+            backend = HttpArtifactBackend(self.url)
+        store_artifact([backend], "key", self.artifact)
+        fetch_artifact([backend], "key", self.output)
+        self.assertEqual(self.handler.authorizations, ["Bearer secret", "Bearer secret"])
+
+    def test_server_down(self) -> None:
+        backend = HttpArtifactBackend(self.url)
+        self.server.shutdown()
+        self.server.server_close()
+        # Only warns, as a build can still be made without the shared cache
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            self.assertIsNone(fetch_artifact([backend], "key", self.output))
+            store_artifact([backend], "key", self.artifact)
+        self.assertIn("Could not look up the build", output.getvalue())
+        self.assertIn("Could not store the build", output.getvalue())
+        self.assertFalse(self.output.exists())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,181 @@
+import http.server
+import io
+import os
+import re
+import tempfile
+import threading
+import unittest
+import zipfile
+from pathlib import Path
+from typing import Optional
+from unittest import mock
+
+from cli.download import ChecksumError, download_file, get_etag_path, verify_file
+from cli.github import download_archive, download_options
+from cli.utils import EnsurePath
+
+"""
+Tests of the resumable downloads against a local stand-in for the archive host, which serves a single file with an
+ETag and can drop the connection, ignore ranges or have the file change between requests.
+"""
+
+RANGE = re.compile(r"bytes=(\d+)-(\d*)")
+
+
+class _FileHandler(http.server.BaseHTTPRequestHandler):
+    content: bytes
+    etag: str
+    # Whether Range requests are honoured
+    ranges: bool
+    # Number of body bytes sent before dropping the connection, once
+    drop_after: Optional[int]
+    # Headers of every request received
+    received: list[dict[str, str]]
+
+    def log_message(self, format: str, *args: object) -> None:
+        pass
+
+    def _send_headers(self, status: int, length: int, content_range: Optional[str] = None) -> None:
+        self.send_response(status)
+        self.send_header("Content-Length", str(length))
+        self.send_header("ETag", self.etag)
+        if self.ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        if content_range is not None:
+            self.send_header("Content-Range", content_range)
+        self.end_headers()
+
+    def do_HEAD(self) -> None:
+        self._send_headers(200, len(self.content))
+
+    def do_GET(self) -> None:
+        self.received.append(dict(self.headers))
+        size = len(self.content)
+        match = RANGE.fullmatch(self.headers.get("Range", ""))
+        if_range = self.headers.get("If-Range")
+        if not self.ranges or match is None or (if_range is not None and if_range != self.etag):
+            self._send_headers(200, size)
+            body = self.content
+        else:
+            start = int(match.group(1))
+            end = int(match.group(2)) if match.group(2) else size - 1
+            if start >= size:
+                self._send_headers(416, 0, f"bytes */{size}")
+                return
+            body = self.content[start : end + 1]
+            self._send_headers(206, len(body), f"bytes {start}-{end}/{size}")
+        drop_after = self.drop_after
+        if drop_after is not None:
+            type(self).drop_after = None
+            self.wfile.write(body[:drop_after])
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+
+def make_archive(commit: str = "") -> bytes:
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
+        zip_file.comment = commit.encode()
+        for index in range(20):
+            zip_file.writestr(f"repo-{commit}/files/file{index}.txt", os.urandom(16 * 1024).hex())
+    return buffer.getvalue()
+
+
+class DownloadTest(unittest.TestCase):
+    def setUp(self) -> None:
+        # A subclass per test, so that each server starts afresh
+        class Handler(_FileHandler):
+            content = os.urandom(512 * 1024)
+            etag = '"v1"'
+            ranges = True
+            drop_after: Optional[int] = None
+            received = []
+
+        self.handler = Handler
+        self.server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/archive.zip"
+
+        temporary_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(temporary_dir.cleanup)
+        self.directory = Path(temporary_dir.name)
+        self.path = self.directory / "archive.zip.partial"
+
+        # Reconnections don't need to wait in tests
+        sleep_patch = mock.patch("cli.download.time.sleep")
+        sleep_patch.start()
+        self.addCleanup(sleep_patch.stop)
+
+    def test_resume_after_drop(self) -> None:
+        self.handler.drop_after = 96 * 1024
+        with mock.patch("cli.download.CHUNK_SIZE", 16 * 1024):
+            download_file(self.url, self.path)
+        self.assertEqual(self.path.read_bytes(), self.handler.content)
+        resumed = self.handler.received[1]
+        self.assertEqual(resumed["Range"], f"bytes={96 * 1024}-")
+        self.assertEqual(resumed["If-Range"], '"v1"')
+
+    def test_resume_across_runs(self) -> None:
+        self.path.write_bytes(self.handler.content[:1000])
+        get_etag_path(self.path).write_text('"v1"')
+        download_file(self.url, self.path)
+        self.assertEqual(self.path.read_bytes(), self.handler.content)
+        self.assertEqual(self.handler.received[0]["Range"], "bytes=1000-")
+
+    def test_server_ignores_range(self) -> None:
+        self.handler.ranges = False
+        self.path.write_bytes(self.handler.content[:1000])
+        get_etag_path(self.path).write_text('"v1"')
+        download_file(self.url, self.path)
+        self.assertEqual(self.path.read_bytes(), self.handler.content)
+        self.assertEqual(len(self.handler.received), 1)
+
+    def test_changed_file_starts_over(self) -> None:
+        self.path.write_bytes(os.urandom(1000))
+        get_etag_path(self.path).write_text('"v0"')
+        download_file(self.url, self.path)
+        self.assertEqual(self.path.read_bytes(), self.handler.content)
+        self.assertEqual(get_etag_path(self.path).read_text(), '"v1"')
+
+    def test_already_complete(self) -> None:
+        self.path.write_bytes(self.handler.content)
+        download_file(self.url, self.path)
+        self.assertEqual(self.path.read_bytes(), self.handler.content)
+        self.assertEqual(len(self.handler.received), 1)
+
+    def test_parts(self) -> None:
+        with mock.patch("cli.download.MIN_PART_SIZE", 64 * 1024):
+            download_file(self.url, self.path, parts=4)
+        self.assertEqual(self.path.read_bytes(), self.handler.content)
+        self.assertEqual(len(self.handler.received), 4)
+        self.assertTrue(all(headers["Range"] for headers in self.handler.received))
+        self.assertEqual(
+            sorted(path.name for path in self.directory.iterdir()), [self.path.name, "archive.zip.partial.etag"]
+        )
+
+    def test_checksum_mismatch(self) -> None:
+        download_file(self.url, self.path)
+        with self.assertRaises(ChecksumError):
+            verify_file(self.path, "0" * 64)
+        self.assertFalse(self.path.exists())
+
+    def test_corrupt_partial_is_downloaded_again(self) -> None:
+        self.handler.content = make_archive("abc")
+        # Left by a resume that appended the end of another archive
+        self.path.write_bytes(os.urandom(1000))
+        destination = self.directory / "extracted"
+        destination.mkdir()
+        with mock.patch.dict(download_options, {"keep_archive": True}), mock.patch("cli.github.log"):
+            with mock.patch("cli.github.warning") as warning:
+                download_archive(self.url, destination, EnsurePath(self.directory / "archive.zip"), None, "abc")
+        self.assertIn("not a valid archive", warning.call_args.args[0])
+        self.assertEqual((self.directory / "archive.zip").read_bytes(), self.handler.content)
+        self.assertEqual(len(list(destination.glob("files/*.txt"))), 20)
+        self.assertFalse(self.path.exists())
+
+
+if __name__ == "__main__":
+    unittest.main()